@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#checkpoint_functions.py
+'''
+Resumable sampling runs. Completed sample squares (center, per-flight FlightPath statistics and SampleSquare metrics)
+are appended to an HDF5 table file as they finish, so a restarted run skips them. Parallel workers each write
+their own shard, which merge_checkpoints combines.
+'''
+
+import os
+import re
+import glob
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+
+import point_density_functions as pdf
+import profiling_functions as prof
+
+logger = logging.getLogger(__name__)
+
+SQUARE_KEY = 'squares'
+FLIGHT_KEY = 'flights'
+DATASETS = ['laefer','nyc','usgs']
+METRIC_COLUMNS = [dataset+'_'+metric for dataset in DATASETS
+                  for metric in ['C','W','rmse','phi_total','phi_sample','cosine_sim_mean']]
+SQUARE_COLUMNS = ['square_id','x','y','z','feet_from_point','accepted'] + METRIC_COLUMNS
+FLIGHT_COLUMNS = ['square_id','dataset','flight_id','num_points','h','sd_dist','square_dist',
+                  'norm_x','norm_y','norm_z']
+# Width reserved for string columns of the HDF tables
+MIN_ITEMSIZE = {'dataset': 16, 'flight_id': 32}
+
+
+def square_id(center_point,feet_from_point,decimals=4):
+    '''
+    Stable 63-bit identifier of a sample square from its rounded center and half width,
+    so the same square gets the same id across restarts and workers.
+    '''
+    key = "%.*f,%.*f,%.*f" % (decimals,center_point[0],decimals,center_point[1],decimals,feet_from_point)
+    return int.from_bytes(hashlib.blake2b(key.encode(),digest_size=8).digest(),'little') >> 1
+
+def shard_path(path,worker):
+    '''Checkpoint file written by one parallel worker, e.g. run.h5 -> run.shard3.h5'''
+    base,ext = os.path.splitext(path)
+    return "%s.shard%d%s" % (base,worker,ext or '.h5')
+
+def existing_shards(path):
+    '''Shard files of path already on disk (from any number of workers), in worker order'''
+    base,ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(base) + r'\.shard(\d+)' + re.escape(ext or '.h5') + '$')
+    matches = [pattern.match(p) for p in glob.glob(glob.escape(base) + '.shard*' + (ext or '.h5'))]
+    return [m.group(0) for m in sorted((m for m in matches if m),key=lambda m: int(m.group(1)))]
+
+def flatten_sample_square(sample_square,center_point,feet_from_point):
+    '''
+    Converts a SampleSquare (or None for a rejected square) into one square row and a list of flight rows.
+    Output:
+    square_row - dict with SQUARE_COLUMNS keys (metrics of missing datasets are nan)
+    flight_rows - list of dicts with FLIGHT_COLUMNS keys, one per FlightPath of every dataset
+    '''
+    sid = square_id(center_point,feet_from_point)
+    square_row = dict.fromkeys(METRIC_COLUMNS,np.nan)
+    square_row.update({'square_id': sid,
+                       'x': center_point[0],
+                       'y': center_point[1],
+                       'z': center_point[2] if len(center_point) > 2 else np.nan,
+                       'feet_from_point': feet_from_point,
+                       'accepted': sample_square is not None})
+    flight_rows = []
+    if sample_square is None:
+        return square_row,flight_rows
+    square_row.update(pdf.square_metrics(sample_square))
+    for dataset in DATASETS:
+        for flight in getattr(sample_square,'flight_list_'+dataset,None) or []:
+            norm_vector = np.asarray(flight.norm_vector,dtype=np.float64)
+            flight_rows.append({'square_id': sid,
+                                'dataset': dataset,
+                                'flight_id': str(flight.flight_id),
+                                'num_points': flight.num_points,
+                                'h': flight.h,
+                                'sd_dist': flight.sd_dist,
+                                'square_dist': flight.square_dist,
+                                'norm_x': norm_vector[0],
+                                'norm_y': norm_vector[1],
+                                'norm_z': norm_vector[2]})
+    return square_row,flight_rows
+
+
+class SamplingCheckpoint(object):
+    '''
+    SamplingCheckpoint is an append-only HDF5 file of completed sample squares.
+
+    Attributes:
+    path - String, file path
+    Tables:
+    'flights' - one row per FlightPath (FLIGHT_COLUMNS), appended before the square row
+    'squares' - one row per processed square (SQUARE_COLUMNS), rejected squares included with accepted=False.
+        A square counts as done only once its square row is written, so a crash between the two appends
+        leaves orphan flight rows that load() ignores.
+    '''
+    def __init__(self,path):
+        self.path = path
+
+    def completed_ids(self):
+        '''Set of square ids already recorded in the file'''
+        if not os.path.isfile(self.path):
+            return set()
+        with pd.HDFStore(self.path,mode='r') as store:
+            if '/'+SQUARE_KEY not in store.keys():
+                return set()
+            return set(store.select_column(SQUARE_KEY,'square_id').tolist())
+
+    @prof.timed('SamplingCheckpoint.append')
+    def append(self,square_rows,flight_rows):
+        if not square_rows:
+            return
+        squares = pd.DataFrame(square_rows,columns=SQUARE_COLUMNS)
+        squares['square_id'] = squares['square_id'].astype(np.int64)
+        squares['accepted'] = squares['accepted'].astype(bool)
+        with pd.HDFStore(self.path,mode='a') as store:
+            if flight_rows:
+                flights = pd.DataFrame(flight_rows,columns=FLIGHT_COLUMNS)
+                flights['square_id'] = flights['square_id'].astype(np.int64)
+                store.append(FLIGHT_KEY,flights,format='table',index=False,min_itemsize=MIN_ITEMSIZE)
+            store.append(SQUARE_KEY,squares,format='table',index=False,data_columns=['square_id'])
+
+    def load(self):
+        '''
+        Output:
+        squares - DataFrame of recorded squares (duplicates dropped)
+        flights - DataFrame of FlightPath rows belonging to recorded squares
+        '''
+        if not os.path.isfile(self.path):
+            return pd.DataFrame(columns=SQUARE_COLUMNS),pd.DataFrame(columns=FLIGHT_COLUMNS)
+        with pd.HDFStore(self.path,mode='r') as store:
+            keys = store.keys()
+            squares = store.select(SQUARE_KEY) if '/'+SQUARE_KEY in keys else pd.DataFrame(columns=SQUARE_COLUMNS)
+            flights = store.select(FLIGHT_KEY) if '/'+FLIGHT_KEY in keys else pd.DataFrame(columns=FLIGHT_COLUMNS)
+        squares = squares.drop_duplicates('square_id').reset_index(drop=True)
+        flights = flights[flights['square_id'].isin(squares['square_id'])]
+        flights = flights.drop_duplicates(['square_id','dataset','flight_id']).reset_index(drop=True)
+        return squares,flights
+
+
+@prof.timed('run_sampling')
+def run_sampling(center_points,process_square,checkpoint_path,feet_from_point,
+                 flush_every=50,worker=None,num_workers=None):
+    '''
+    Processes sample squares, appending each result to a checkpoint file and skipping squares already in it.
+    Inputs:
+    center_points - (n x 2+) numpy array of square centers (output of center_point_sample)
+    process_square - function center_point -> SampleSquare, or None if the square is rejected
+    checkpoint_path - String, checkpoint file; with worker given, the worker's shard_path is written instead.
+        Squares recorded in checkpoint_path or in any of its shards are skipped, so a restart may change num_workers.
+    feet_from_point - scalar 1/2 length of one side of square (part of the square id)
+    flush_every - squares buffered in memory between appends
+    worker, num_workers - optional Int, process only center_points[worker::num_workers] into shard `worker`
+    Output:
+    SamplingCheckpoint of the file written
+    '''
+    done = set()
+    for path in [checkpoint_path] + existing_shards(checkpoint_path):
+        done.update(SamplingCheckpoint(path).completed_ids())
+    if worker is not None:
+        center_points = center_points[worker::num_workers]
+        checkpoint_path = shard_path(checkpoint_path,worker)
+    checkpoint = SamplingCheckpoint(checkpoint_path)
+    square_rows,flight_rows = [],[]
+    skipped = 0
+    for center_point in center_points:
+        if square_id(center_point,feet_from_point) in done:
+            skipped += 1
+            continue
+        square_row,flights = flatten_sample_square(process_square(center_point),center_point,feet_from_point)
+        square_rows.append(square_row)
+        flight_rows.extend(flights)
+        if len(square_rows) >= flush_every:
+            checkpoint.append(square_rows,flight_rows)
+            square_rows,flight_rows = [],[]
+    checkpoint.append(square_rows,flight_rows)
+    logger.info("run_sampling file=%s skipped=%d", checkpoint_path, skipped)
+    return checkpoint
+
+def merge_checkpoints(shard_paths,out_path):
+    '''
+    Merges checkpoint shards written by parallel workers (and/or earlier runs) into one checkpoint file.
+    Squares present in several shards are kept once.
+    Output: SamplingCheckpoint of out_path
+    '''
+    merged = SamplingCheckpoint(out_path)
+    done = merged.completed_ids()
+    for path in shard_paths:
+        squares,flights = SamplingCheckpoint(path).load()
+        squares = squares[~squares['square_id'].isin(done)]
+        flights = flights[flights['square_id'].isin(squares['square_id'])]
+        merged.append(squares.to_dict('records'),flights.to_dict('records'))
+        done.update(squares['square_id'].tolist())
+    return merged
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+#flight_segmentation.py
+'''
+Out-of-core GPS-time sort and flight segmentation of point stores too large for memory
+(the num_flights_nyc / num_flights_usgs notebooks, which sort the whole DataFrame first).
+Chunks of the HDF or Parquet point store are sorted by gps_time and spilled to disk as runs, the runs are
+k-way merged in blocks, and flight_id is assigned while the merged points stream out: a new flight starts
+after every gap in gps_time longer than gap_seconds. Only one chunk (or the merge buffers) is in memory at a time.
+
+Usage:
+    flights = segment_flights('las_points_NYC_975172.lz','las_points_nyc_flight_id.lz','/scratch/runs')
+'''
+
+import os
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+
+import profiling_functions as prof
+
+logger = logging.getLogger(__name__)
+
+TIME_COLUMN = 'gps_time'
+# Gap between consecutive points (seconds) that starts a new flight, as in the notebooks
+GAP_SECONDS = 30.
+
+
+def _is_parquet(path):
+    return os.path.splitext(path)[1].lower() in ('.parquet','.pq')
+
+def iter_point_chunks(path,chunk_size=5000000,key=None):
+    '''
+    Reads an HDF (any key format) or Parquet point store chunk_size rows at a time.
+    Inputs:
+    path - String, .parquet/.pq file, otherwise an HDF file (e.g. written by create_df_hd5)
+    key (optional) - HDF key, the first key if None
+    Output:
+    generator of DataFrames; a compact table's scale/offset or origin is kept in .attrs
+    '''
+    if _is_parquet(path):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+        return
+    with pd.HDFStore(path,mode='r') as store:
+        key = key or store.keys()[0]
+        storer = store.get_storer(key)
+        attrs = getattr(storer.attrs,'point_table',None) or {}
+        num_rows = storer.nrows if storer.is_table else storer.shape[0]
+        for start in range(0,num_rows,chunk_size):
+            chunk = store.select(key,start=start,stop=start+chunk_size)
+            chunk.attrs.update(attrs)
+            yield chunk
+
+@prof.timed('sort_runs')
+def sort_runs(chunks,run_dir):
+    '''
+    Sorts each chunk by gps_time and spills it to run_dir as a .npy record array.
+    Inputs:
+    chunks - iterable of DataFrames (e.g. iter_point_chunks), all numeric columns
+    run_dir - String, directory for the runs (created if missing)
+    Output:
+    run_paths - list of run files, in chunk order
+    attrs - dict, .attrs of the first chunk (compact table scale/offset or origin)
+    '''
+    os.makedirs(run_dir,exist_ok=True)
+    run_paths = []
+    attrs = {}
+    for i,chunk in enumerate(chunks):
+        if i == 0:
+            attrs = dict(chunk.attrs)
+        non_numeric = [c for c in chunk.columns if not np.issubdtype(chunk[c].dtype,np.number)]
+        if non_numeric:
+            raise ValueError("runs hold numeric columns only, found %s" % non_numeric)
+        records = chunk.sort_values(TIME_COLUMN,kind='stable').to_records(index=False)
+        path = os.path.join(run_dir,'run%05d.npy' % i)
+        np.save(path,records)
+        run_paths.append(path)
+        logger.info("sort_runs run=%s points=%d", path, records.shape[0])
+    return run_paths,attrs
+
+def merge_runs(run_paths,merge_rows=5000000):
+    '''
+    k-way merge of sorted runs, read through memory maps in blocks of about merge_rows/len(run_paths) rows per run.
+    Each step emits every buffered point up to the smallest last buffered time of the runs, which no
+    unread point can precede.
+    Output:
+    generator of record arrays sorted by gps_time, consecutive arrays continuing the order
+    '''
+    runs = [np.load(path,mmap_mode='r') for path in run_paths]
+    block_rows = max(1,merge_rows // max(len(runs),1))
+    positions = [0]*len(runs)
+    buffers = [run[:0] for run in runs]
+    while True:
+        for r,run in enumerate(runs):
+            if buffers[r].shape[0] == 0 and positions[r] < run.shape[0]:
+                buffers[r] = np.array(run[positions[r]:positions[r]+block_rows])
+                positions[r] += buffers[r].shape[0]
+        active = [r for r in range(len(runs)) if buffers[r].shape[0]]
+        if not active:
+            return
+        bound = min(buffers[r][TIME_COLUMN][-1] for r in active)
+        parts = []
+        for r in active:
+            split = np.searchsorted(buffers[r][TIME_COLUMN],bound,side='right')
+            parts.append(buffers[r][:split])
+            buffers[r] = buffers[r][split:]
+        block = np.concatenate(parts)
+        yield block[np.argsort(block[TIME_COLUMN],kind='stable')]
+
+class FlightSegmenter(object):
+    '''
+    FlightSegmenter assigns flight ids to points arriving in gps_time order, one block at a time.
+
+    Attributes:
+    gap_seconds - scalar, a larger gap between consecutive points starts a new flight
+    flight_id - Int, id of the current flight (-1 before the first point)
+    last_time - scalar, gps_time of the last point seen
+    flights - list of [flight_id, start_time, end_time, num_points]
+    '''
+    def __init__(self,gap_seconds=GAP_SECONDS,first_flight_id=0):
+        self.gap_seconds = gap_seconds
+        self.flight_id = first_flight_id - 1
+        self.last_time = None
+        self.flights = []
+
+    def assign(self,times):
+        # Int64 flight id of each time, times sorted and continuing the previous call
+        if times.shape[0] == 0:
+            return np.zeros(0,dtype=np.int64)
+        gaps = np.diff(times) > self.gap_seconds
+        new_flight = np.r_[self.last_time is None or times[0] - self.last_time > self.gap_seconds,gaps]
+        flight_ids = self.flight_id + np.cumsum(new_flight)
+        # Per-flight extents of this block, the first one possibly continuing the last recorded flight
+        starts = np.flatnonzero(np.r_[True,gaps])
+        ends = np.r_[starts[1:],times.shape[0]]
+        for start,end in zip(starts,ends):
+            if flight_ids[start] == self.flight_id:
+                self.flights[-1][2] = times[end-1]
+                self.flights[-1][3] += end - start
+            else:
+                self.flights.append([flight_ids[start],times[start],times[end-1],end - start])
+        self.flight_id = flight_ids[-1]
+        self.last_time = times[-1]
+        return flight_ids
+
+    def summary(self):
+        return pd.DataFrame(self.flights,columns=['flight_id','start_time','end_time','num_points'])
+
+class _ChunkWriter(object):
+    # Appends DataFrames to a Parquet file or an HDF table
+    def __init__(self,path,key='df',attrs=None):
+        self.path = path
+        self.key = key
+        self.attrs = attrs or {}
+        self._writer = None
+        self._store = None
+
+    def write(self,df):
+        if _is_parquet(self.path):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df,preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path,table.schema)
+            self._writer.write_table(table)
+        else:
+            if self._store is None:
+                self._store = pd.HDFStore(self.path,mode='w',complevel=1,complib='lzo')
+            self._store.append(self.key,df,format='table',index=False)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._store is not None:
+            if self.key in self._store:
+                # Same attribute create_df_hd5 writes, restored by read_flight_file
+                self._store.get_storer(self.key).attrs.point_table = dict(self.attrs)
+            self._store.close()
+
+@prof.timed('segment_flights')
+def segment_flights(in_path,out_path,run_dir,gap_seconds=GAP_SECONDS,chunk_size=5000000,merge_rows=None,
+                    key=None,keep_runs=False):
+    '''
+    Sorts a point store by gps_time out of core and writes it with a flight_id column.
+    Inputs:
+    in_path - String, HDF or Parquet point store (see iter_point_chunks)
+    out_path - String, output file, Parquet if it ends in .parquet/.pq, otherwise an HDF table under 'df'
+    run_dir - String, directory for the sorted runs (needs about the size of the data)
+    gap_seconds - scalar, gps_time gap starting a new flight
+    chunk_size - Int, rows per sorted run
+    merge_rows (optional) - Int, rows buffered during the merge, chunk_size if None
+    key (optional) - HDF key of in_path
+    keep_runs - False deletes the runs afterwards
+    Output:
+    DataFrame with flight_id, start_time, end_time, num_points of every flight
+    '''
+    # flight_id is reassigned (and a string flight_id from read_flight_file cannot go in the runs)
+    chunks = (chunk.drop(columns='flight_id',errors='ignore') for chunk in iter_point_chunks(in_path,chunk_size,key))
+    run_paths,attrs = sort_runs(chunks,run_dir)
+    segmenter = FlightSegmenter(gap_seconds)
+    writer = _ChunkWriter(out_path,attrs=attrs)
+    try:
+        for block in merge_runs(run_paths,merge_rows or chunk_size):
+            df = pd.DataFrame(block)
+            df['flight_id'] = segmenter.assign(block[TIME_COLUMN])
+            writer.write(df)
+    finally:
+        writer.close()
+    if not keep_runs:
+        for path in run_paths:
+            os.remove(path)
+        if not os.listdir(run_dir):
+            shutil.rmtree(run_dir)
+    flights = segmenter.summary()
+    logger.info("segment_flights file=%s runs=%d flights=%d points=%d",
+                in_path, len(run_paths), flights.shape[0], flights['num_points'].sum())
+    return flights
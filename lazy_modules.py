@@ -0,0 +1,41 @@
+#!/usr/bin/python
+#lazy_modules.py
+'''
+Deferred imports for the heavy optional dependencies (matplotlib, scipy, laspy, rtree).
+A LazyModule stands in for a module and imports it on first attribute access, so the readers and the
+sampling math load with NumPy (and pandas) alone and pool workers / command line runs start quickly.
+
+Usage:
+    from lazy_modules import LazyModule
+    plt = LazyModule('matplotlib.pyplot')
+    ...
+    plt.plot(x, y)    # matplotlib is imported here
+'''
+
+import importlib
+
+
+class LazyModule(object):
+    '''
+    Placeholder for the module name, imported on first attribute access.
+    A missing optional dependency raises its ImportError at that point instead of at import time.
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        # only called for attributes not set in __init__
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<LazyModule %s (%s)>" % (self._name, state)
@@ -1,11 +1,21 @@
 #!/usr/bin/python
 #point_density_functions.py
 
+import os
+import pickle
+import logging
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
-from scipy import stats
-from laspy.file import File
-import matplotlib.pyplot as plt
+
+import profiling_functions as prof
+from lazy_modules import LazyModule
+
+# Optional dependencies, imported on first use
+stats = LazyModule('scipy.stats')
+plt = LazyModule('matplotlib.pyplot')
+
+logger = logging.getLogger(__name__)
 
 def raw_to_df(raw,column_names):
     '''function takes raw output of laspy.File.get_points() and column names, and returns a pandas Dataframe'''
@@ -30,30 +40,40 @@ def scale_and_offset(df,header,append_to_df=False):
     else:
         return scaled_xyz
 
-def read_las_file(file_dir,filename,column_names):
+def read_las_file(file_dir,filename,column_names,compact=False):
     '''
     takes .las file as input, generates dataframe
     Inputs:
     file_dir, filename: corresponding to the .las file
     columns_names: dependent on the LAS version
+    compact (optional): False, 'grid' (or True) or 'local', see compact_point_table
     
     Output:
-    df: Dataframe containing original columns plus scaled xyz coords
+    df: Dataframe containing original columns plus scaled xyz coords (compact point table if compact)
     '''
+    from laspy.file import File
     inFile = File(file_dir+filename, mode='r')
     raw = inFile.get_points()
     df = raw_to_df(raw,column_names)
+    if compact:
+        mode = 'grid' if compact is True else compact
+        return compact_point_table(df,mode,inFile.header.scale,inFile.header.offset)
     df = scale_and_offset(df,inFile.header,append_to_df=True)
     return df
 
-def create_df_hd5(file_dir,filename,column_names):
+def create_df_hd5(file_dir,filename,column_names,compact=False):
+    from laspy.file import File
     inFile = File(file_dir+filename, mode='r')
     raw = inFile.get_points()
     df = raw_to_df(raw,column_names)
     del(raw)
-    df = scale_and_offset(df,inFile.header,append_to_df=True)
+    if compact:
+        mode = 'grid' if compact is True else compact
+        df = compact_point_table(df,mode,inFile.header.scale,inFile.header.offset)
+    else:
+        df = scale_and_offset(df,inFile.header,append_to_df=True)
     hdf_name = 'las_points_'+filename[2:15]+'.lz'
-    df.to_hdf(file_dir + hdf_name,key='df',complevel=1,complib='lzo')
+    write_flight_file(df,file_dir + hdf_name)
 #    return df
 
 def label_returns(las_df):
@@ -70,6 +90,103 @@ def label_returns(las_df):
     first_return_df = first_return_df.reset_index(drop=True)
     return first_return_df, las_df
 
+### COMPACT POINT TABLES
+# A compact point table stores coordinates either as
+#   'grid':  int32 X,Y,Z with the LAS header scale/offset in df.attrs (x_scaled = X*scale + offset), or
+#   'local': float32 x_local,y_local,z_local relative to df.attrs['origin'],
+# and the small LAS fields in their narrow dtypes. point_xyz / point_coord decode float64 coordinates on demand
+# from either representation (or from the usual x_scaled,y_scaled,z_scaled fields).
+
+XYZ_COLUMNS = ['x_scaled','y_scaled','z_scaled']
+GRID_COLUMNS = ['X','Y','Z']
+LOCAL_COLUMNS = ['x_local','y_local','z_local']
+# Narrowest dtype of each LAS field, applied by compact_point_table when the field is present
+COMPACT_DTYPES = {'intensity': np.uint16,
+                  'flag_byte': np.uint8,
+                  'classification_flags': np.uint8,
+                  'classification_byte': np.uint8,
+                  'classification': np.uint8,
+                  'user_data': np.uint8,
+                  'scan_angle_rank': np.int8,
+                  'scan_angle': np.int16,
+                  'pt_src_id': np.uint16,
+                  'num_returns': np.uint8,
+                  'return_num': np.uint8}
+
+def point_coord(las_points,axis):
+    '''
+    Float64 numpy array of one scaled coordinate ('x', 'y' or 'z') of a point table, whatever its representation.
+    '''
+    i = 'xyz'.index(axis)
+    if XYZ_COLUMNS[i] in las_points.columns:
+        return las_points[XYZ_COLUMNS[i]].to_numpy(dtype=np.float64)
+    if LOCAL_COLUMNS[i] in las_points.columns:
+        return las_points[LOCAL_COLUMNS[i]].to_numpy(dtype=np.float64) + las_points.attrs['origin'][i]
+    if GRID_COLUMNS[i] in las_points.columns and 'scale' in las_points.attrs:
+        return las_points[GRID_COLUMNS[i]].to_numpy(dtype=np.float64)*las_points.attrs['scale'][i] + las_points.attrs['offset'][i]
+    raise ValueError("point table has no decodable %s coordinate" % axis)
+
+def point_xyz(las_points):
+    '''(n x 3) float64 numpy array of the scaled x,y,z coordinates of a point table'''
+    xyz = np.empty((las_points.shape[0],3),dtype=np.float64)
+    for i,axis in enumerate('xyz'):
+        xyz[:,i] = point_coord(las_points,axis)
+    return xyz
+
+def compact_point_table(las_points,mode='grid',scale=None,offset=None,origin=None):
+    '''
+    Converts a point table into a compact point table (see above).
+    Inputs:
+    las_points - DataFrame from raw_to_df, read_las_file, read_flight_file or another compact table
+    mode - 'grid' or 'local'
+    scale, offset - (3,) header scale and offset; default las_points.attrs. Used by 'grid' mode, and by 'local' mode
+        to decode raw X,Y,Z fields.
+        X,Y,Z fields, when present, are taken to be on this grid already.
+    origin - (3,) local origin for 'local' mode; default the minimum of each coordinate
+    Output:
+    DataFrame with the coordinate fields replaced and small fields downcast, representation described in .attrs
+    '''
+    if mode == 'grid':
+        if scale is None:
+            if 'scale' not in las_points.attrs:
+                raise ValueError("compact_point_table: grid mode needs the header scale and offset")
+            scale,offset = las_points.attrs['scale'],las_points.attrs['offset']
+        scale = np.asarray(scale,dtype=np.float64)
+        offset = np.asarray(offset,dtype=np.float64)
+        if all(column in las_points.columns for column in GRID_COLUMNS):
+            grid = las_points[GRID_COLUMNS].to_numpy(dtype=np.int64)
+        else:
+            grid = np.round((point_xyz(las_points) - offset) / scale).astype(np.int64)
+        if grid.size and (grid.min() < np.iinfo(np.int32).min or grid.max() > np.iinfo(np.int32).max):
+            raise ValueError("compact_point_table: coordinates do not fit an int32 grid with this scale/offset")
+        new_columns = dict(zip(GRID_COLUMNS,grid.astype(np.int32).T))
+        attrs = {'scale': scale.tolist(), 'offset': offset.tolist()}
+    elif mode == 'local':
+        if scale is None and 'scale' in las_points.attrs:
+            scale,offset = las_points.attrs['scale'],las_points.attrs['offset']
+        if scale is not None and all(column in las_points.columns for column in GRID_COLUMNS) \
+           and not all(column in las_points.columns for column in XYZ_COLUMNS):
+            # Raw X,Y,Z (e.g. from raw_to_df) decoded with the header scale/offset
+            xyz = las_points[GRID_COLUMNS].to_numpy(dtype=np.float64)*np.asarray(scale,dtype=np.float64) \
+                  + np.asarray(offset,dtype=np.float64)
+        else:
+            xyz = point_xyz(las_points)
+        origin = xyz.min(axis=0) if origin is None else np.asarray(origin,dtype=np.float64)
+        new_columns = dict(zip(LOCAL_COLUMNS,(xyz - origin).astype(np.float32).T))
+        attrs = {'origin': origin.tolist()}
+    else:
+        raise ValueError("compact_point_table: unknown mode %r" % (mode,))
+
+    coordinate_columns = XYZ_COLUMNS + GRID_COLUMNS + LOCAL_COLUMNS
+    compact = las_points.drop(columns=[column for column in las_points.columns if column in coordinate_columns])
+    for column,values in new_columns.items():
+        compact[column] = values
+    for column,dtype in COMPACT_DTYPES.items():
+        if column in compact.columns:
+            compact[column] = compact[column].astype(dtype)
+    compact.attrs = attrs
+    return compact
+
 def calc_bottom_right_pt(top_left_pt,bottom_left_pt,other_pt):
     '''
     Given the top left point, bottom left point and one other point on plane,
@@ -84,7 +201,74 @@ def calc_bottom_right_pt(top_left_pt,bottom_left_pt,other_pt):
     brp = bottom_vec*v_length + bottom_left_pt
     return brp
 
+def read_flight_file(file_dir,pick):
+    '''
+    Reads one .lz point file (created by create_df_hd5 function), adding flight_id from the filename if missing.
+    The scale/offset or origin of a compact point table is restored into .attrs.
+    '''
+    with pd.HDFStore(file_dir+pick,mode='r') as store:
+        key = store.keys()[0]
+        las_points = store[key]
+        las_points.attrs.update(getattr(store.get_storer(key).attrs,'point_table',None) or {})
+    if 'flight_id' not in las_points.columns:
+        las_points['flight_id'] = pick[11:-3]
+    prof.count('points_read', las_points.shape[0])
+    return las_points
+
+def write_flight_file(las_points,path,complevel=1,complib='lzo'):
+    '''
+    Writes a point table to an HDF file under key 'df', read back by read_flight_file.
+    The scale/offset or origin of a compact table is kept in the 'point_table' attribute of the key.
+    '''
+    with pd.HDFStore(path,mode='w',complevel=complevel,complib=complib) as store:
+        store.put('df',las_points)
+        store.get_storer('df').attrs.point_table = dict(las_points.attrs)
+
+def concat_point_tables(frames,**kwargs):
+    '''
+    pd.concat of point tables (kwargs passed on) keeping their coordinate representation in .attrs.
+    Compact tables on different grids/origins are re-encoded on one local origin first so they can be stacked.
+    '''
+    if any(frame.attrs != frames[0].attrs for frame in frames):
+        nonempty = [frame for frame in frames if frame.shape[0]]
+        origin = np.min([point_xyz(frame).min(axis=0) for frame in nonempty],axis=0) if nonempty else np.zeros(3)
+        frames = [compact_point_table(frame,'local',origin=origin) for frame in frames]
+    points = pd.concat(frames,**kwargs)
+    points.attrs = dict(frames[0].attrs)
+    return points
+
+def concat_chunks(chunks):
+    '''
+    Concatenates (pick, DataFrame) chunks (output of iter_grab_points / iter_grab_points_big_rect) once,
+    with the same column handling as the DataFrame.append(sort=True) accumulation it replaces.
+    '''
+    frames = [chunk for _,chunk in chunks]
+    if not frames:
+        return pd.DataFrame()
+    return concat_point_tables(frames,sort=True)
+
+def iter_grab_points(pt_files,file_dir,pt_x,pt_y,feet_from_point):
+    '''
+    Generator version of grab_points: yields (pick, square points of that file) one flight file at a time,
+    so only one file's points are held in memory. Inputs as in grab_points.
+    '''
+    for pick in pt_files:
+        with prof.timer('grab_points.read_hdf'):
+            las_points = read_flight_file(file_dir,pick)
+        with prof.timer('grab_points.filter'):
+            x = point_coord(las_points,'x')
+            y = point_coord(las_points,'y')
+            new_square_points = las_points[ (x < pt_x + feet_from_point)
+                    &(x > pt_x - feet_from_point) 
+                    &(y < pt_y + feet_from_point)
+                    &(y > pt_y - feet_from_point)
+                  ]
+        prof.count('points_filtered', new_square_points.shape[0])
+        logger.info("grab_points file=%s points_in_square=%d", pick, new_square_points.shape[0])
+        yield pick,new_square_points
+
 # Load pickle, extract points around square, iterate
+@prof.timed('grab_points')
 def grab_points(pt_files,file_dir,pt_x,pt_y,feet_from_point):
     '''
     Function extracts all points in all pt_files within feet_from_point of (pt_x,pt_y)
@@ -98,50 +282,42 @@ def grab_points(pt_files,file_dir,pt_x,pt_y,feet_from_point):
         square_points - DataFrame, contains only points within the bounds described, full LAS fields
     '''
     size_of_square = (2*feet_from_point)**2
-    square_points = pd.DataFrame()
-    for pick in pt_files:
-        las_points = pd.read_hdf(file_dir+pick)
-        if 'flight_id' not in las_points.columns:
-            las_points['flight_id'] = pick[11:-3]
-        new_square_points = las_points[ (las_points['x_scaled'] < pt_x + feet_from_point)
-                &(las_points['x_scaled'] > pt_x - feet_from_point) 
-                &(las_points['y_scaled'] < pt_y + feet_from_point)
-                &(las_points['y_scaled'] > pt_y - feet_from_point)
-              ]
-        print("Point count in new square from {:s}: {:d}".format(pick,new_square_points.shape[0]))
-        #pts_from_scan.append((pick,new_square_points.shape[0]))
-        square_points = square_points.append(new_square_points,sort=True)
-
-    print("Total point count in square: {:d}".format(square_points.shape[0]))
-    print("Size of square: {:2.2f} sq ft".format(size_of_square))
-    print("Point density: {:2.2f} points / sq ft".format(square_points.shape[0]/size_of_square))
+    square_points = concat_chunks(iter_grab_points(pt_files,file_dir,pt_x,pt_y,feet_from_point))
+
+    logger.info("grab_points total_points=%d square_sqft=%.2f density_pts_per_sqft=%.2f",
+                square_points.shape[0], size_of_square, square_points.shape[0]/size_of_square)
     return square_points
 
+def iter_grab_points_big_rect(pt_files,file_dir,uv_inv,w):
+    '''
+    Generator version of grab_points_big_rect: yields (pick, rectangle points of that file) one flight file at a time.
+    Inputs as in grab_points_big_rect.
+    '''
+    for pick in pt_files:
+        with prof.timer('grab_points_big_rect.read_hdf'):
+            las_points = read_flight_file(file_dir,pick)
+        with prof.timer('grab_points_big_rect.filter'):
+            new_rectangle_points = las_points.iloc[in_rectangle_index(las_points,uv_inv,w)]
+        prof.count('points_filtered', new_rectangle_points.shape[0])
+        logger.info("grab_points_big_rect file=%s points_in_rectangle=%d", pick, new_rectangle_points.shape[0])
+        yield pick,new_rectangle_points
+
+@prof.timed('grab_points_big_rect')
 def grab_points_big_rect(pt_files,file_dir,uv_inv,w):
     '''
-    Function extracts all points in all pt_files within feet_from_point of (pt_x,pt_y)
+    Function extracts all points in all pt_files within the rectangle described by uv_inv and w
     Note: This function currently only works in 2-D (horizontal plane)
     Inputs:
         pt_files - List of strings, filenames of .lz files (created by create_df_hd5 function)
         file_dir - String, directory name containing pt_files
-        uv_inv - 
-        w - 
+        uv_inv, w - rectangle description, output of rectangle()
         
     Output:
         square_points - DataFrame, contains only points within the bounds described, full LAS fields
     '''
-    rectangle_points = pd.DataFrame()
-    for pick in pt_files:
-        las_points = pd.read_hdf(file_dir+pick)
-        if 'flight_id' not in las_points.columns:
-            las_points['flight_id'] = pick[11:-3]
-        unit_square = (las_points[['x_scaled','y_scaled']]-w)@(uv_inv.T)
-        new_rectangle_points = las_points[(unit_square[0]<=1) & (unit_square[0]>=0) & (unit_square[1]<=1) & (unit_square[1]>=0)]
-        print("Point count in new square from {:s}: {:d}".format(pick,new_rectangle_points.shape[0]))
-        #pts_from_scan.append((pick,new_square_points.shape[0]))
-        rectangle_points = rectangle_points.append(new_rectangle_points,sort=True)
-
-    print("Total point count in square: {:d}".format(rectangle_points.shape[0]))
+    rectangle_points = concat_chunks(iter_grab_points_big_rect(pt_files,file_dir,uv_inv,w))
+
+    logger.info("grab_points_big_rect total_points=%d", rectangle_points.shape[0])
     return rectangle_points
 
 def rectangle(pt1,pt2,y_length,x_length):
@@ -168,11 +344,58 @@ def rectangle(pt1,pt2,y_length,x_length):
     w = pt1
     return uv_inv,w,unit_u,unit_v
 
+def rectangle_bounds(uv_inv,w):
+    '''
+    Axis-aligned bounding box of the rectangle described by rectangle() output.
+    Inputs:
+    uv_inv, w - output of rectangle()
+    Output:
+    (x_min, x_max, y_min, y_max)
+    '''
+    uv = np.linalg.inv(uv_inv)
+    corners = np.asarray(w,dtype=np.float64).reshape(2,1) + uv @ np.array([[0,1,0,1],[0,0,1,1]])
+    return corners[0].min(), corners[0].max(), corners[1].min(), corners[1].max()
+
+def in_rectangle_index(las_points,uv_inv,w,chunk_size=1000000):
+    '''
+    Function returns the positional indices of the points inside the rectangle described by rectangle() output.
+    Points are first pruned with the rectangle's bounding box (a binary search when x is sorted),
+    then only the candidates are transformed into rectangle coordinates, in float32 chunks relative to w.
+    Note: This function only works in 2D (horizontal plane)
+    Inputs:
+    las_points - (n x 2+) point table (x_scaled, y_scaled fields or a compact point table)
+    uv_inv, w - output of rectangle()
+    chunk_size - number of candidate points transformed at once
+    Output:
+    Int numpy array of positional (iloc) indices, in increasing order
+    '''
+    x = point_coord(las_points,'x')
+    y = point_coord(las_points,'y')
+    x_min,x_max,y_min,y_max = rectangle_bounds(uv_inv,w)
+    if pd.Index(x).is_monotonic_increasing:
+        lo = np.searchsorted(x,x_min,side='left')
+        hi = np.searchsorted(x,x_max,side='right')
+        candidates = lo + np.flatnonzero((y[lo:hi]>=y_min) & (y[lo:hi]<=y_max))
+    else:
+        candidates = np.flatnonzero((x>=x_min) & (x<=x_max) & (y>=y_min) & (y<=y_max))
+
+    transform = np.asarray(uv_inv,dtype=np.float32).T
+    inside = [np.zeros(0,dtype=np.int64)]
+    for start in range(0,candidates.shape[0],chunk_size):
+        idx = candidates[start:start+chunk_size]
+        relative = np.empty((idx.shape[0],2),dtype=np.float32)
+        relative[:,0] = x[idx] - w[0]
+        relative[:,1] = y[idx] - w[1]
+        unit_square = relative @ transform
+        inside.append(idx[(unit_square>=0).all(axis=1) & (unit_square<=1).all(axis=1)])
+    return np.concatenate(inside)
+
+@prof.timed('plane_fit')
 def plane_fit(square_points,norm_vector_full=None,shift=None):
     '''
     Fits a plane via SVD to the provided points.
     Input: 
-        (n x 3+) dataframe with fields x_scaled, y_scaled, and z_scaled
+        (n x 3+) dataframe with fields x_scaled, y_scaled, and z_scaled (or a compact point table)
     Output: 
         normal vector - normal vector to plane fitted via MLS (3x1 numpy array)
         points - provided x,y,z points with zero mean (n x 3 numpy array)
@@ -181,7 +404,7 @@ def plane_fit(square_points,norm_vector_full=None,shift=None):
         pts_on_plane - projection of x,y,z points onto the fitted plane (n x 3 numpy array)
     '''
     
-    raw_points = np.array(square_points[['x_scaled','y_scaled','z_scaled']]).T
+    raw_points = point_xyz(square_points).T
     points = raw_points.T - raw_points.mean(axis=1)
     svd = np.linalg.svd(points.T)
     norm_vector = np.transpose(svd[0])[2]    
@@ -201,8 +424,148 @@ def plane_fit(square_points,norm_vector_full=None,shift=None):
         dist_from_full_plane = [np.dot(point-shift, norm_vector_full) for point in raw_points.T]
         square_points.loc[:,'dist_from_full_plane'] = dist_from_full_plane
 
+    prof.count('planes_fit')
     return norm_vector,points,square_points,pts_on_plane
 
+def group_moments(xyz,codes,num_groups):
+    '''
+    Columnar PlaneMoments of every group of points in one pass.
+    Inputs: xyz - (n x 3) numpy array, codes - Int array of group codes 0..num_groups-1
+    Output: counts (num_groups,), means (num_groups x 3), scatter (num_groups x 3 x 3) numpy arrays
+    '''
+    # Sums are taken about the overall mean so squared coordinates stay small
+    reference = xyz.mean(axis=0)
+    centered = xyz - reference
+    counts = np.bincount(codes,minlength=num_groups)
+    sums = np.stack([np.bincount(codes,centered[:,k],num_groups) for k in range(3)],axis=1)
+    outer = np.empty((num_groups,3,3))
+    for i in range(3):
+        for j in range(i,3):
+            outer[:,i,j] = outer[:,j,i] = np.bincount(codes,centered[:,i]*centered[:,j],num_groups)
+    means = sums / np.maximum(counts,1)[:,None]
+    scatter = outer - counts[:,None,None]*means[:,:,None]*means[:,None,:]
+    prof.count('planes_fit',num_groups)
+    return counts,means+reference,scatter
+
+def merge_group_moments(keys,counts,means,scatter):
+    '''
+    Merges columnar moments that share a key (the vectorized PlaneMoments.merge).
+    Inputs: keys - Int array (k,), counts, means, scatter - columnar moments as from group_moments
+    Output: unique keys (sorted) and their merged counts, means, scatter
+    '''
+    order = np.argsort(keys,kind='stable')
+    keys,counts,means,scatter = keys[order],counts[order],means[order],scatter[order]
+    starts = np.flatnonzero(np.r_[True,keys[1:] != keys[:-1]])
+    group = np.cumsum(np.r_[True,keys[1:] != keys[:-1]]) - 1
+    total = np.add.reduceat(counts,starts)
+    total_mean = np.add.reduceat(counts[:,None]*means,starts) / np.maximum(total,1)[:,None]
+    # Parallel-axis term moves every scatter matrix to the merged mean
+    delta = means - total_mean[group]
+    total_scatter = np.add.reduceat(scatter + counts[:,None,None]*delta[:,:,None]*delta[:,None,:],starts)
+    return keys[starts],total,total_mean,total_scatter
+
+class PlaneMoments(object):
+    '''
+    PlaneMoments summarizes a set of points by the moments a least-squares plane fit needs.
+    The plane through mean with normal norm_vector() is the same plane plane_fit finds via SVD.
+    
+    Attributes:
+    count - number of points
+    mean - (3,) numpy array, centroid of the points
+    scatter - 3x3 numpy array, sum of outer products of the centered points
+    sd_replicates - None, or for a subsample fit the SD of every replicate drawn with it (see create_flight_list)
+    '''
+    def __init__(self,count,mean,scatter,sd_replicates=None):
+        self.count = count
+        self.mean = mean
+        self.scatter = scatter
+        self.sd_replicates = sd_replicates
+
+    @classmethod
+    def from_points(cls,xyz):
+        # xyz - (n x 3) numpy array
+        mean = xyz.mean(axis=0)
+        centered = xyz - mean
+        prof.count('planes_fit')
+        return cls(xyz.shape[0],mean,centered.T @ centered)
+
+    @classmethod
+    def from_groups(cls,xyz,codes,num_groups):
+        '''
+        PlaneMoments of every group of points in one pass.
+        Inputs: xyz - (n x 3) numpy array, codes - Int array of group codes 0..num_groups-1 (e.g. from pd.factorize)
+        Output: list of num_groups PlaneMoments
+        '''
+        counts,means,scatter = group_moments(xyz,codes,num_groups)
+        return [cls(counts[g],means[g],scatter[g]) for g in range(num_groups)]
+
+    def merge(self,other):
+        # Moments of the union of both point sets
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta*other.count/count
+        scatter = self.scatter + other.scatter + np.outer(delta,delta)*self.count*other.count/count
+        return PlaneMoments(count,mean,scatter)
+
+    __add__ = merge
+
+    @classmethod
+    def combine(cls,moments_list):
+        combined = moments_list[0]
+        for moments in moments_list[1:]:
+            combined = combined.merge(moments)
+        return combined
+
+    def norm_vector(self):
+        # Eigenvector of the smallest eigenvalue of the scatter matrix (smallest singular vector in plane_fit)
+        return np.linalg.eigh(self.scatter)[1][:,0]
+
+    def dist_stats(self,norm_vector,shift):
+        '''
+        Statistics of the points' signed distances (p - shift) @ norm_vector from a plane, without the points.
+        Output: (mean, standard deviation, sum of squares) of the distances
+        '''
+        h = (self.mean - shift) @ norm_vector
+        var = max(norm_vector @ self.scatter @ norm_vector / self.count,0.)
+        return h,np.sqrt(var),self.count*(var + h**2)
+
+def subsample_replicates(num_points,sample_size,num_replicates,rng,replace=False):
+    '''
+    Draws num_replicates subsamples of sample_size point indices out of num_points.
+    Inputs:
+    rng - numpy.random.Generator (or seed), all draws come from it so results are reproducible
+    replace - False for subsamples without replacement, True for bootstrap replicates
+    Output:
+    (num_replicates x sample_size) Int numpy array of indices
+    '''
+    rng = np.random.default_rng(rng)
+    if replace:
+        return rng.integers(0,num_points,(num_replicates,sample_size))
+    # The sample_size smallest of num_points uniform keys form a uniform subsample without replacement
+    keys = rng.random((num_replicates,num_points))
+    return np.argpartition(keys,sample_size-1,axis=1)[:,:sample_size]
+
+def replicate_plane_fits(xyz,idx):
+    '''
+    Plane fits of many subsamples of the same points at once, from batched moments.
+    Inputs:
+    xyz - (n x 3) numpy array
+    idx - (num_replicates x sample_size) Int numpy array (output of subsample_replicates)
+    Output:
+    norm_vectors - (num_replicates x 3) numpy array
+    sd_dist - (num_replicates,) numpy array, SD of each subsample's distances from its own fitted plane
+    moments - list of PlaneMoments, one per replicate
+    '''
+    points = xyz[idx]
+    means = points.mean(axis=1)
+    centered = points - means[:,None,:]
+    scatter = np.einsum('rmi,rmj->rij',centered,centered)
+    eigenvalues,eigenvectors = np.linalg.eigh(scatter)
+    prof.count('planes_fit',idx.shape[0])
+    sd_dist = np.sqrt(np.maximum(eigenvalues[:,0],0)/idx.shape[1])
+    moments = [PlaneMoments(idx.shape[1],means[r],scatter[r]) for r in range(idx.shape[0])]
+    return eigenvectors[:,:,0],sd_dist,moments
+
 def prep_square_for_plotting(square_points,min_list=None):
     '''
     Function removes the min value in each coordinate from _plot fields, appends new fields
@@ -219,12 +582,10 @@ def prep_square_for_plotting(square_points,min_list=None):
         y_min = min_list[1] 
         z_min = min_list[2]
     else:
-        x_min = square_points['x_scaled'].min()
-        y_min = square_points['y_scaled'].min()
-        z_min = square_points['z_scaled'].min()
-    square_points['x_plot'] = square_points['x_scaled'] - x_min
-    square_points['y_plot'] = square_points['y_scaled'] - y_min
-    square_points['z_plot'] = square_points['z_scaled'] - z_min
+        x_min,y_min,z_min = point_xyz(square_points).min(axis=0)
+    square_points['x_plot'] = point_coord(square_points,'x') - x_min
+    square_points['y_plot'] = point_coord(square_points,'y') - y_min
+    square_points['z_plot'] = point_coord(square_points,'z') - z_min
     min_list = [x_min,y_min,z_min]
     return square_points, min_list
 
@@ -242,9 +603,9 @@ def grab_wall_face(square_points,norm_vector,pt_1,z_low,z_high,epsilon=1e-2):
     Output:
         wall_face - dataframe subset of square_points satisfying the above criteria
     '''
-    xyz_array = square_points[['x_scaled','y_scaled','z_scaled']]
+    xyz_array = point_xyz(square_points)
     dist_from_plane = norm_vector@(xyz_array - pt_1).T
-    wall_face = square_points[(abs(dist_from_plane)<epsilon)&(square_points['z_scaled']>z_low) & (square_points['z_scaled']<z_high)]
+    wall_face = square_points[(abs(dist_from_plane)<epsilon)&(xyz_array[:,2]>z_low) & (xyz_array[:,2]<z_high)]
     return wall_face
 
 def in_horizontal_square(rectangle_points,center_point,feet_from_point):
@@ -260,10 +621,12 @@ def in_horizontal_square(rectangle_points,center_point,feet_from_point):
     Output:
     square_points - (n x 3+) filtered dataframe
     '''
-    square_points = rectangle_points[ (rectangle_points['x_scaled'] < center_point[0] + feet_from_point)
-            &(rectangle_points['x_scaled'] > center_point[0] - feet_from_point) 
-            &(rectangle_points['y_scaled'] < center_point[1] + feet_from_point)
-            &(rectangle_points['y_scaled'] > center_point[1] - feet_from_point)
+    x = point_coord(rectangle_points,'x')
+    y = point_coord(rectangle_points,'y')
+    square_points = rectangle_points[ (x < center_point[0] + feet_from_point)
+            &(x > center_point[0] - feet_from_point) 
+            &(y < center_point[1] + feet_from_point)
+            &(y > center_point[1] - feet_from_point)
           ]
     return square_points
 
@@ -286,14 +649,15 @@ def in_vertical_square(square_points,norm_vector,center_pt,horizontal_feet_from_
 
 
     # Project each point onto the plane
+    xyz = point_xyz(square_points)
     orth_component = [dist*norm_vector for dist in square_points['dist_from_plane']]
-    proj_on_plane = square_points[['x_scaled','y_scaled','z_scaled']] - np.array(orth_component)
+    proj_on_plane = xyz - np.array(orth_component)
 
-    xy_dist_from_center_pt = np.linalg.norm(proj_on_plane[['x_scaled','y_scaled']] - center_pt[:2],axis=1)
+    xy_dist_from_center_pt = np.linalg.norm(proj_on_plane[:,:2] - center_pt[:2],axis=1)
     
     vertical_square = square_points[(xy_dist_from_center_pt<horizontal_feet_from_pt)
-                                        &(square_points['z_scaled']<center_pt[2]+vertical_feet_from_pt) &
-                                        (square_points['z_scaled']>center_pt[2]-vertical_feet_from_pt)]
+                                        &(xyz[:,2]<center_pt[2]+vertical_feet_from_pt) &
+                                        (xyz[:,2]>center_pt[2]-vertical_feet_from_pt)]
 
 
     rect_area = ((vertical_feet_from_pt*2)*(horizontal_feet_from_pt*2))
@@ -303,6 +667,264 @@ def in_vertical_square(square_points,norm_vector,center_pt,horizontal_feet_from_
     return vertical_square,density
 
 
+### SCAN AND INCIDENCE ANGLES
+# The beam of a point leaves the sensor scan_angle degrees off nadir, across track (positive to the right of the
+# flight direction, as in the LAS spec). The flight direction is estimated per flight from x,y vs gps_time.
+
+SCAN_ANGLE_UNIT = .006 # degrees per LAS 1.4 scan_angle count
+ANGLE_BINS = np.arange(0,91,5)
+
+def scan_angle_degrees(las_points):
+    '''Float64 numpy array of the scan angle in degrees, from scan_angle_deg, scan_angle or scan_angle_rank'''
+    if 'scan_angle_deg' in las_points.columns:
+        return las_points['scan_angle_deg'].to_numpy(dtype=np.float64)
+    if 'scan_angle' in las_points.columns:
+        return las_points['scan_angle'].to_numpy(dtype=np.float64)*SCAN_ANGLE_UNIT
+    if 'scan_angle_rank' in las_points.columns:
+        return las_points['scan_angle_rank'].to_numpy(dtype=np.float64)
+    raise ValueError("point table has no scan angle field")
+
+def flight_headings(las_points):
+    '''
+    Estimates each flight's horizontal direction of travel by a least-squares fit of x and y against gps_time.
+    Best called on whole flight files, a small square spans only a few scan lines.
+    Inputs:
+    las_points - point table with gps_time and flight_id fields
+    Output:
+    DataFrame indexed by flight_id with heading_x, heading_y (unit vector, nan if gps_time is constant)
+    '''
+    codes,flight_ids = pd.factorize(las_points['flight_id'])
+    t = las_points['gps_time'].to_numpy(dtype=np.float64)
+    counts = np.bincount(codes,minlength=len(flight_ids))
+    t_centered = t - (np.bincount(codes,weights=t,minlength=len(flight_ids))/counts)[codes]
+    var_t = np.bincount(codes,weights=t_centered**2,minlength=len(flight_ids))
+    velocity = np.empty((len(flight_ids),2))
+    for i,axis in enumerate('xy'):
+        coord = point_coord(las_points,axis)
+        coord_centered = coord - (np.bincount(codes,weights=coord,minlength=len(flight_ids))/counts)[codes]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            velocity[:,i] = np.bincount(codes,weights=t_centered*coord_centered,minlength=len(flight_ids)) / var_t
+    with np.errstate(invalid='ignore'):
+        heading = velocity / np.linalg.norm(velocity,axis=1,keepdims=True)
+    return pd.DataFrame(heading,index=pd.Index(flight_ids,name='flight_id'),columns=['heading_x','heading_y'])
+
+def view_vectors(scan_angle_deg,heading_xy):
+    '''
+    Unit beam directions (sensor to ground) from scan angles and flight headings.
+    Inputs:
+    scan_angle_deg - (n,) numpy array
+    heading_xy - (n x 2) numpy array of unit flight directions (or a single (2,) direction)
+    Output:
+    (n x 3) numpy array
+    '''
+    theta = np.radians(scan_angle_deg)
+    heading_xy = np.broadcast_to(heading_xy,(theta.shape[0],2))
+    view = np.empty((theta.shape[0],3))
+    # Across-track direction is the heading turned 90 degrees clockwise
+    view[:,0] = np.sin(theta)*heading_xy[:,1]
+    view[:,1] = -np.sin(theta)*heading_xy[:,0]
+    view[:,2] = -np.cos(theta)
+    return view
+
+def incidence_angles(view,norm_vector):
+    '''
+    Angle in degrees between each beam and the surface normal (0 = beam hits the surface head on).
+    norm_vector - (3,) normal of the square (plane_fit output) or (n x 3) normal per point
+    '''
+    cos_incidence = np.abs(np.einsum('ij,ij->i',view,np.broadcast_to(norm_vector,view.shape)))
+    return np.degrees(np.arccos(np.clip(cos_incidence,0,1)))
+
+@prof.timed('add_angle_columns')
+def add_angle_columns(las_points,norm_vector=None,headings=None):
+    '''
+    Adds the derived angle fields to a point table in one vectorized pass:
+    scan_angle_deg, view_x, view_y, view_z (beam direction) and, if norm_vector is given, incidence_deg.
+    Inputs:
+    las_points - point table with a scan angle field, flight_id and (unless headings is given) gps_time
+    norm_vector (optional) - (3,) fitted normal of the square (plane_fit / PlaneMoments.norm_vector),
+        or (n x 3) per point normals, e.g. norm_vectors[square_codes] to cover many squares at once
+    headings (optional) - flight_headings output, typically computed on the whole flight files
+    Output:
+    las_points with the fields added (float32)
+    '''
+    if headings is None:
+        headings = flight_headings(las_points)
+    heading_xy = headings.reindex(las_points['flight_id'])[['heading_x','heading_y']].to_numpy()
+    scan_angle_deg = scan_angle_degrees(las_points)
+    view = view_vectors(scan_angle_deg,heading_xy)
+    las_points['scan_angle_deg'] = scan_angle_deg.astype(np.float32)
+    las_points['view_x'] = view[:,0].astype(np.float32)
+    las_points['view_y'] = view[:,1].astype(np.float32)
+    las_points['view_z'] = view[:,2].astype(np.float32)
+    if norm_vector is not None:
+        las_points['incidence_deg'] = incidence_angles(view,norm_vector).astype(np.float32)
+    return las_points
+
+def angle_histograms(las_points,column='incidence_deg',bins=ANGLE_BINS):
+    '''
+    Per-flight histogram of an angle field (e.g. incidence_deg or scan_angle_deg, see add_angle_columns).
+    Output: DataFrame indexed by flight_id, one column per bin (labelled by the bin's left edge), point counts
+    '''
+    codes,flight_ids = pd.factorize(las_points['flight_id'])
+    angle_bin = np.digitize(las_points[column].to_numpy(),bins) - 1
+    in_range = (angle_bin >= 0) & (angle_bin < len(bins)-1)
+    counts = np.bincount(codes[in_range]*(len(bins)-1) + angle_bin[in_range],minlength=len(flight_ids)*(len(bins)-1))
+    return pd.DataFrame(counts.reshape(len(flight_ids),len(bins)-1),
+                        index=pd.Index(flight_ids,name='flight_id'),columns=bins[:-1])
+
+
+### SHARED SPATIAL INDEX FOR MULTI-DATASET SAMPLING
+
+class MultiDatasetIndex(object):
+    '''
+    MultiDatasetIndex is one uniform grid index over the points of several datasets (e.g. laefer, nyc, usgs).
+    The datasets are concatenated, tagged with a 'dataset' column and sorted by grid cell, so the points of
+    a row of cells are contiguous and a square query reads a few slices instead of filtering every dataset.
+    
+    Attributes:
+    points - concatenated DataFrame (sorted by cell, index reset) with an added 'dataset' column
+    cell_size - scalar side length of a grid cell, ideally close to the square side (2*feet_from_point)
+    x0,y0 - scalar origin of the grid
+    nx,ny - number of cells in x and y
+    cell_start - Int numpy array, the points of cell k = iy*nx + ix are points.iloc[cell_start[k]:cell_start[k+1]]
+    group - Int numpy array, per point code of its (dataset, flight_id) pair
+    groups - DataFrame of the (dataset, flight_id) pairs, row i describes group code i
+    '''
+    def __init__(self,datasets,cell_size):
+        frames = []
+        for name,dataset_points in datasets.items():
+            frame = dataset_points.copy()
+            frame['dataset'] = name
+            frames.append(frame)
+        points = concat_point_tables(frames,sort=True,ignore_index=True)
+
+        x = point_coord(points,'x')
+        y = point_coord(points,'y')
+        self.cell_size = cell_size
+        self.x0 = x.min()
+        self.y0 = y.min()
+        self.nx = int((x.max() - self.x0) // cell_size) + 1
+        self.ny = int((y.max() - self.y0) // cell_size) + 1
+        cell = ((y - self.y0) // cell_size).astype(np.int64)*self.nx + ((x - self.x0) // cell_size).astype(np.int64)
+        order = np.argsort(cell,kind='stable')
+        self.points = points.iloc[order].reset_index(drop=True)
+        self.cell_start = np.searchsorted(cell[order],np.arange(self.nx*self.ny+1))
+
+        self.group = self.points.groupby(['dataset','flight_id'],sort=True).ngroup().to_numpy()
+        self.groups = self.points[['dataset','flight_id']].drop_duplicates().sort_values(['dataset','flight_id'])
+        self.groups = self.groups.reset_index(drop=True)
+        self._x = x[order]
+        self._y = y[order]
+
+    def query_square(self,center_point,feet_from_point):
+        '''
+        Positional indices into self.points of the points strictly within feet_from_point of center_point
+        in x and y (the same test as in_horizontal_square).
+        '''
+        cx,cy = center_point[0],center_point[1]
+        ix0 = max(int((cx - feet_from_point - self.x0) // self.cell_size),0)
+        ix1 = min(int((cx + feet_from_point - self.x0) // self.cell_size),self.nx-1)
+        iy0 = max(int((cy - feet_from_point - self.y0) // self.cell_size),0)
+        iy1 = min(int((cy + feet_from_point - self.y0) // self.cell_size),self.ny-1)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.zeros(0,dtype=np.int64)
+        # cells ix0..ix1 of one cell row are contiguous in self.points
+        slices = [np.arange(self.cell_start[iy*self.nx+ix0],self.cell_start[iy*self.nx+ix1+1]) for iy in range(iy0,iy1+1)]
+        candidates = np.concatenate(slices)
+        x = self._x[candidates]
+        y = self._y[candidates]
+        return candidates[(x < cx + feet_from_point) & (x > cx - feet_from_point)
+                          & (y < cy + feet_from_point) & (y > cy - feet_from_point)]
+
+    def membership(self,center_points,feet_from_point,batch_size=1024):
+        '''
+        Batched square query for all center points: the candidate points of every cell row each square overlaps
+        are gathered with array operations, batch_size centers at a time, and filtered as in query_square.
+        Output:
+        square_index - list with one Int numpy array of positional indices per center point (as query_square)
+        counts - (num centers x num groups) numpy array, point count of each (dataset, flight_id) group (see self.groups)
+        '''
+        center_points = np.asarray(center_points,dtype=np.float64).reshape(len(center_points),-1)
+        num_groups = self.groups.shape[0]
+        square_index = []
+        counts = np.zeros((center_points.shape[0],num_groups),dtype=np.int64)
+        for batch_start in range(0,center_points.shape[0],batch_size):
+            cx = center_points[batch_start:batch_start+batch_size,0]
+            cy = center_points[batch_start:batch_start+batch_size,1]
+            ix0 = np.maximum(((cx - feet_from_point - self.x0) // self.cell_size).astype(np.int64),0)
+            ix1 = np.minimum(((cx + feet_from_point - self.x0) // self.cell_size).astype(np.int64),self.nx-1)
+            iy0 = np.maximum(((cy - feet_from_point - self.y0) // self.cell_size).astype(np.int64),0)
+            iy1 = np.minimum(((cy + feet_from_point - self.y0) // self.cell_size).astype(np.int64),self.ny-1)
+            num_rows = np.where(ix0 <= ix1,np.maximum(iy1 - iy0 + 1,0),0)
+            # One segment of contiguous points per (center, overlapped cell row)
+            segment_center = np.repeat(np.arange(cx.shape[0]),num_rows)
+            iy = iy0[segment_center] + np.arange(num_rows.sum()) - np.repeat(np.cumsum(num_rows) - num_rows,num_rows)
+            starts = self.cell_start[iy*self.nx + ix0[segment_center]]
+            lengths = self.cell_start[iy*self.nx + ix1[segment_center] + 1] - starts
+            candidate_center = np.repeat(segment_center,lengths)
+            candidates = np.repeat(starts,lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,lengths)
+            x = self._x[candidates]
+            y = self._y[candidates]
+            inside = (x < cx[candidate_center] + feet_from_point) & (x > cx[candidate_center] - feet_from_point) \
+                     & (y < cy[candidate_center] + feet_from_point) & (y > cy[candidate_center] - feet_from_point)
+            candidates = candidates[inside]
+            candidate_center = candidate_center[inside]
+            per_center = np.bincount(candidate_center,minlength=cx.shape[0])
+            square_index.extend(np.split(candidates,np.cumsum(per_center)[:-1]))
+            counts[batch_start:batch_start+cx.shape[0]] = np.bincount(
+                candidate_center*num_groups + self.group[candidates],
+                minlength=cx.shape[0]*num_groups).reshape(cx.shape[0],num_groups)
+        return square_index,counts
+
+    def flight_counts(self,counts,min_points_per_flight=1):
+        '''
+        Number of flights per dataset with at least min_points_per_flight points, from membership() counts.
+        Output: DataFrame (num centers x num datasets)
+        '''
+        has_flight = pd.DataFrame(counts >= min_points_per_flight,columns=self.groups['dataset'])
+        return has_flight.T.groupby(level=0).sum().T
+
+    def square_points(self,idx):
+        '''
+        Splits the points of one square (positional indices from query_square) by dataset.
+        Output: dict dataset name -> DataFrame with the same fields as the input datasets (plus 'dataset')
+        '''
+        square = self.points.iloc[idx]
+        return {name: square[square['dataset']==name] for name in self.groups['dataset'].unique()}
+
+@prof.timed('select_sample_squares')
+def select_sample_squares(index,center_points,feet_from_point,min_flights=1,min_points_per_flight=1,max_z=None):
+    '''
+    Runs one batched membership query for all center points and rejects the squares that fail the flight criteria,
+    before any plane fitting is done.
+    Inputs:
+    index - MultiDatasetIndex
+    center_points - (n x 2+) numpy array of square centers (output of center_point_sample)
+    feet_from_point - scalar 1/2 length of one side of square
+    min_flights - Int, or dict dataset name -> Int, minimum number of flights a dataset must have in the square
+    min_points_per_flight - Int, points a flight needs in the square to count toward min_flights
+    max_z - optional scalar, squares with any point at or above max_z are rejected (e.g. mean_z + 3)
+    Output:
+    accepted - boolean numpy array, one entry per center point
+    square_index - list of positional index arrays into index.points, one per center point
+    flight_counts - DataFrame (num centers x num datasets) of qualifying flight counts
+    '''
+    square_index,counts = index.membership(center_points,feet_from_point)
+    flight_counts = index.flight_counts(counts,min_points_per_flight)
+    if not isinstance(min_flights,dict):
+        min_flights = {name: min_flights for name in flight_counts.columns}
+    accepted = np.ones(len(center_points),dtype=bool)
+    for name,minimum in min_flights.items():
+        accepted &= flight_counts[name].to_numpy() >= minimum
+    if max_z is not None:
+        z = point_coord(index.points,'z')
+        for i in np.flatnonzero(accepted):
+            # an empty square (min_flights 0) has no point above max_z
+            accepted[i] = not square_index[i].size or z[square_index[i]].max() < max_z
+    logger.info("select_sample_squares centers=%d accepted=%d", len(center_points), accepted.sum())
+    return accepted,square_index,flight_counts
+
+
 ### CLASSES FOR STATISTICAL SAMPLING
 
 class FlightPath(object):
@@ -314,16 +936,35 @@ class FlightPath(object):
     norm_vector - 3x1 numpy array of the xyz coordinates of the norm vector
     avg_dist_from_plane - scalar average distance from fitted plane (plane fitted over all flight paths)
         for all points in the flight path
+    sd_dist_replicates - None, or for the -200 flight the sd_dist of every subsample replicate drawn
     
     '''
     def __init__(self,flight_id,norm_vector,square_points,avg_dist_from_plane=None):
         self.flight_id = flight_id
         self.norm_vector = norm_vector
         self.avg_dist_from_plane = avg_dist_from_plane # Probably can remove
+        self.sd_dist_replicates = None
         self.num_points = square_points.shape[0]
         self.sd_dist = self.sd_dist_from_plane_f(square_points)
         self.h = self.calculate_h(square_points)
         self.square_dist = self.square_dist_from_plane(square_points)
+
+    @classmethod
+    def from_moments(cls,flight_id,moments,norm_vector_full=None,shift=None,avg_dist_from_plane=None):
+        '''
+        Builds a FlightPath from PlaneMoments instead of the square's points.
+        Distances are taken from the plane (norm_vector_full, shift); by default from the flight's own fitted plane.
+        '''
+        flightpath = cls.__new__(cls)
+        flightpath.flight_id = flight_id
+        flightpath.norm_vector = moments.norm_vector()
+        flightpath.avg_dist_from_plane = avg_dist_from_plane
+        flightpath.num_points = moments.count
+        if norm_vector_full is None:
+            norm_vector_full,shift = flightpath.norm_vector,moments.mean
+        flightpath.h,flightpath.sd_dist,flightpath.square_dist = moments.dist_stats(norm_vector_full,shift)
+        flightpath.sd_dist_replicates = moments.sd_replicates
+        return flightpath
     
     # Calculate h = mean "height" from plane of all flight passes
     def calculate_h(self,square_points):
@@ -367,6 +1008,7 @@ class SampleSquare(object):
             self.cosine_sim_sd_laefer = self.cosine_sim_sd_f(self.cosine_sim_matrix_laefer)        
             self.phi_laefer_total = self.phi_internal(self.flight_list_laefer,sample=False)
             self.phi_laefer_sample = self.phi_internal(self.flight_list_laefer,sample=True)
+            self.phi_laefer_sample_replicates = self.phi_replicates(self.flight_list_laefer)
         else:
             pass
         # 2017 scan
@@ -381,6 +1023,7 @@ class SampleSquare(object):
             self.cosine_sim_sd_nyc = self.cosine_sim_sd_f(self.cosine_sim_matrix_nyc)
             self.phi_nyc_total = self.phi_internal(self.flight_list_nyc,sample=False)
             self.phi_nyc_sample = self.phi_internal(self.flight_list_nyc,sample=True)
+            self.phi_nyc_sample_replicates = self.phi_replicates(self.flight_list_nyc)
         else:
             pass
         # 2014 scan    
@@ -396,6 +1039,7 @@ class SampleSquare(object):
                
             self.phi_usgs_total = self.phi_internal(self.flight_list_usgs,sample=False)
             self.phi_usgs_sample = self.phi_internal(self.flight_list_usgs,sample=True)
+            self.phi_usgs_sample_replicates = self.phi_replicates(self.flight_list_usgs)
         else:
             pass
     
@@ -486,14 +1130,131 @@ class SampleSquare(object):
             phi = flight_list[0].sd_dist / avg_flight_paths
         return phi
 
+    def phi_replicates(self,flight_list):
+        # phi_sample of every subsample replicate drawn for the -200 flight (see create_flight_list)
+        sd_replicates = flight_list[1].sd_dist_replicates
+        if sd_replicates is None:
+            return None
+        avg_flight_paths = np.mean([flight.sd_dist for flight in flight_list[2:]])
+        return sd_replicates / avg_flight_paths
+
+
+class PlaneFitCache(object):
+    '''
+    PlaneFitCache memoizes plane fits (PlaneMoments) of sample squares, keyed by
+    (dataset, center, half width, flight_id, data version), with least-recently-used eviction.
+    Pass it to create_flight_list so repeated runs and parameter sweeps reuse earlier fits.
+    
+    Attributes:
+    maxsize - Int, maximum number of fits kept
+    path - String or None, pickle file the cache is loaded from on creation and written to by save()
+    hits, misses - Int lookup counters
+    '''
+    def __init__(self,maxsize=100000,path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._fits = OrderedDict()
+        if path is not None and os.path.isfile(path):
+            with open(path,'rb') as f:
+                self._fits = pickle.load(f)
+
+    @staticmethod
+    def square_key(dataset,center_point,feet_from_point,data_version=None,decimals=4):
+        # Key prefix of one square; create_flight_list appends the flight_id
+        return (dataset,round(float(center_point[0]),decimals),round(float(center_point[1]),decimals),
+                round(float(feet_from_point),decimals),data_version)
+
+    def __len__(self):
+        return len(self._fits)
+
+    def get(self,key):
+        moments = self._fits.get(key)
+        if moments is None:
+            self.misses += 1
+            prof.count('plane_cache_misses')
+            return None
+        self._fits.move_to_end(key)
+        self.hits += 1
+        prof.count('plane_cache_hits')
+        return moments
+
+    def put(self,key,moments):
+        self._fits[key] = moments
+        self._fits.move_to_end(key)
+        while len(self._fits) > self.maxsize:
+            self._fits.popitem(last=False)
+
+    def get_or_fit(self,key,xyz_f):
+        # xyz_f - function returning the (n x 3) points to fit, only called on a miss
+        moments = self.get(key)
+        if moments is None:
+            moments = PlaneMoments.from_points(xyz_f())
+            self.put(key,moments)
+        return moments
+
+    def save(self,path=None):
+        path = path or self.path
+        with open(path,'wb') as f:
+            pickle.dump(self._fits,f,protocol=pickle.HIGHEST_PROTOCOL)
+
 
 ### FUNCTIONS FOR STATISTICAL SAMPLING
 
+def _stratified_unit_sample(num_points,aspect,rng):
+    # Jittered sampling: one uniform point in each of num_points randomly chosen cells of a near-square grid
+    rows = max(1,int(round(np.sqrt(num_points*aspect))))
+    cols = int(np.ceil(num_points/rows))
+    cells = rng.choice(rows*cols,num_points,replace=False)
+    s = (cells // cols + rng.random(num_points))/rows
+    t = (cells % cols + rng.random(num_points))/cols
+    return np.array([s,t])
+
+def _poisson_disk_sample(num_points,to_world,min_distance,rng,max_attempts,batch_size=1024):
+    # Dart throwing in world xy: candidates closer than min_distance (in both x and y) to an accepted point are dropped,
+    # so squares with side min_distance around accepted centers do not overlap.
+    # Accepted points are kept on a grid of min_distance cells, which holds at most one of them per cell, so each
+    # candidate is checked against the 3x3 cells around it; candidates are drawn and checked in batches.
+    corners = to_world(np.array([[0.,0.,1.,1.],[0.,1.,0.,1.]]))[:2]
+    low = corners.min(axis=1)
+    shape = (np.floor((corners.max(axis=1) - low)/min_distance)).astype(np.int64) + 3
+    occupant = np.full(tuple(shape),-1,dtype=np.int64)
+    accepted_xy = np.zeros((0,2))
+    accepted_st = np.zeros((2,0))
+    attempts = 0
+    offsets = np.array([(i,j) for i in (-1,0,1) for j in (-1,0,1)])
+    while accepted_xy.shape[0] < num_points and attempts < max_attempts:
+        count = min(batch_size,max_attempts - attempts)
+        st = rng.random((2,count))
+        attempts += count
+        xy = to_world(st)[:2].T
+        # +1 keeps the 3x3 neighbourhood of every cell inside the grid
+        cell = np.floor((xy - low)/min_distance).astype(np.int64) + 1
+        neighbours = occupant[cell[:,None,0] + offsets[:,0],cell[:,None,1] + offsets[:,1]]
+        near = accepted_xy[np.maximum(neighbours,0)] if accepted_xy.shape[0] else np.zeros(neighbours.shape + (2,))
+        blocked = ((neighbours >= 0) & (np.abs(near - xy[:,None,:]).max(axis=2) < min_distance)).any(axis=1)
+        # Within the batch a candidate is kept only if no earlier free candidate is too close
+        free = np.flatnonzero(~blocked)
+        close = np.abs(xy[free,None,:] - xy[None,free,:]).max(axis=2) < min_distance
+        keep = free[~np.tril(close,-1).any(axis=1)][:num_points - accepted_xy.shape[0]]
+        occupant[cell[keep,0],cell[keep,1]] = accepted_xy.shape[0] + np.arange(keep.shape[0])
+        accepted_xy = np.vstack([accepted_xy,xy[keep]])
+        accepted_st = np.hstack([accepted_st,st[:,keep]])
+    if accepted_xy.shape[0] < num_points:
+        logger.warning("center_point_sample poisson requested=%d placed=%d attempts=%d",
+                       num_points, accepted_xy.shape[0], attempts)
+    return accepted_st
+
 def center_point_sample(num_points,
                         bottom_left_pt,top_left_pt,bottom_right_pt=None,
                         u_length=800,v_length=-80,
                         border=[0.05,0.05],
-                        seed = 27):
+                        seed = 27,
+                        method='uniform',
+                        rng=None,
+                        min_distance=None,
+                        max_attempts=100000):
     '''
     Function returns random samples (num_points of them) within the rectangle defined by the points and lengths.
     
@@ -504,12 +1265,16 @@ def center_point_sample(num_points,
     u_length - length in the u direction (bottom_left_pt -> top_left_pt)
     v_length - length in the u direction (bottom_left_pt -> bottom_right_pt)
     border - 2x1 list [border_u,border_v], portion of unit square on each edge to avoid
+    seed - Int, seeds the sampler when rng is not given (no global random state is touched)
+    method - 'uniform' (i.i.d., same draws as before for a given seed), 'stratified' (jittered grid),
+             'sobol' or 'halton' (scrambled low-discrepancy sequences), 'poisson' (non-overlapping squares)
+    rng - optional numpy.random.Generator or seed; give each parallel worker its own (e.g. from SeedSequence.spawn)
+    min_distance - 'poisson' only, minimum x and y separation of centers, 2*feet_from_point for non-overlapping squares
+    max_attempts - 'poisson' only, candidate draws before giving up (fewer than num_points may be returned)
     
     Output:
     num_points x 2 numpy array of (x,y) values
     '''  
-    np.random.seed(seed)
-
     unit_u = (top_left_pt - bottom_left_pt)/np.linalg.norm(top_left_pt-bottom_left_pt)
     unit_v = (bottom_right_pt - bottom_left_pt)/np.linalg.norm(bottom_right_pt - bottom_left_pt)
     u = unit_u*u_length
@@ -520,59 +1285,626 @@ def center_point_sample(num_points,
     # Select random point on unit square within border
     border = np.array(border)
     square_side = np.array([1 - (2*border[0]),1 - (2*border[1])])
-    st = border.reshape(2,1) + square_side.reshape(2,1)*np.random.rand(2,num_points)
-    return (uv @ st + w.reshape((3,1))).T
 
-def create_flight_list(square_points):
+    def to_world(unit_st):
+        st = border.reshape(2,1) + square_side.reshape(2,1)*unit_st
+        return uv @ st + w.reshape((3,1))
+
+    if method == 'uniform' and rng is None:
+        # RandomState(seed) reproduces the draws of the former np.random.seed(seed) without touching global state
+        unit_st = np.random.RandomState(seed).rand(2,num_points)
+        return to_world(unit_st).T
+
+    rng = np.random.default_rng(seed if rng is None else rng)
+    if method == 'uniform':
+        unit_st = rng.random((2,num_points))
+    elif method == 'stratified':
+        aspect = abs(u_length*square_side[0])/abs(v_length*square_side[1])
+        unit_st = _stratified_unit_sample(num_points,aspect,rng)
+    elif method in ('sobol','halton'):
+        from scipy.stats import qmc
+        engine = qmc.Sobol(d=2,scramble=True,seed=rng) if method == 'sobol' else qmc.Halton(d=2,scramble=True,seed=rng)
+        if method == 'sobol':
+            # Sobol' points are drawn in powers of 2; the first num_points of the sequence are used
+            unit_st = engine.random_base2(int(np.ceil(np.log2(max(num_points,1)))))[:num_points].T
+        else:
+            unit_st = engine.random(num_points).T
+    elif method == 'poisson':
+        if min_distance is None:
+            raise ValueError("method='poisson' requires min_distance")
+        unit_st = _poisson_disk_sample(num_points,to_world,min_distance,rng,max_attempts)
+    else:
+        raise ValueError("Unknown sampling method: %s" % method)
+    return to_world(unit_st).T
+
+@prof.timed('create_flight_list')
+def create_flight_list(square_points,cache=None,square_key=None,rng=None,num_replicates=1,replace=False):
     '''
     create_flight_list creates a list of FlightPath objects, 
     1 for each unique flight_id plus 2 more (total and total_sampled). This is an input to SampleSquare.
     FlightPath object contains flight_id, norm_vector, std deviation of point distance from fitted plane.
     flight_id = -100: Full dataset
     flight_id = -200: Full dataset, sampled to the avg number of points in a single flight path
+    All fits come from one pass over the points: per-flight PlaneMoments are accumulated together and merged
+    into the full-square fit, and every distance statistic is computed from the moments.
     
     Input:
     square_points: Dataframe for the square-around-a-point, including x_scaled,y_scaled, and z_scaled
+        (or a compact point table)
+    cache (optional): PlaneFitCache, plane fits are looked up / stored there instead of refitting
+    square_key (optional): PlaneFitCache.square_key(dataset,center_point,feet_from_point,data_version) for this square
+    rng (optional): numpy.random.Generator or seed for the -200 subsample; unseeded if None.
+        With a cache the -200 fit is reused only for the same seed, num_replicates and replace
+        (never unseeded or for a Generator)
+    num_replicates (optional): number of subsamples drawn for -200. The first one is the -200 FlightPath,
+        the SD of all of them is kept in its sd_dist_replicates attribute (giving a phi distribution in SampleSquare)
+    replace (optional): True draws bootstrap replicates (with replacement) instead of subsamples
     
     Output:
     flight_list (described above)
     '''
-    
-    # fit a plane for each flight
-    flight_list = []
+    if cache is not None and square_key is None:
+        raise ValueError("create_flight_list: a cache needs the square_key of the square (PlaneFitCache.square_key)")
+    xyz = point_xyz(square_points)
+    codes,flight_ids = pd.factorize(square_points['flight_id'])
+
+    # Per-flight moments, from the cache when every flight is there
+    flight_moments = None
+    if cache is not None:
+        flight_moments = [cache.get(square_key+(flight_id,)) for flight_id in flight_ids]
+        if any(moments is None for moments in flight_moments):
+            flight_moments = None
+    if flight_moments is None:
+        flight_moments = PlaneMoments.from_groups(xyz,codes,len(flight_ids))
+        if cache is not None:
+            for flight_id,moments in zip(flight_ids,flight_moments):
+                cache.put(square_key+(flight_id,),moments)
 
     # Full dataset
-    norm_vector_full,_,square_points_total,_ = plane_fit(square_points)
-    shift = np.array(square_points[['x_scaled','y_scaled','z_scaled']]).mean(axis=0)
-
-    flightpath = FlightPath(-100,norm_vector_full,square_points_total)
-    # flightpath.sd_dist_from_plane(square_points_total)
-    flight_list.append(flightpath)
-
-    # # Print the total RMSE_S
-    # rmse = np.sqrt(np.sum(square_points_total['dist_from_full_plane']**2)/square_points_total.shape[0])
-    # print("RMSE: ",rmse)
-    # Full dataset, sampled down
-    flight_count = len(square_points['flight_id'].unique())
-    density = square_points.shape[0] / flight_count
-    square_points_sampled = square_points.sample(n=int(density))
-
-    norm_vector,_,square_points_sample,_ = plane_fit(square_points_sampled)
-    flightpath = FlightPath(-200,norm_vector,square_points_sampled)
-    # flightpath.sd_dist_from_plane(square_points_sampled)
-    flight_list.append(flightpath)
-
-
-    for flight_id in square_points['flight_id'].unique():
-        # Avg distance from total point cloud plane - filtering square_points_total
-        avg_dist_from_plane = square_points_total[square_points_total['flight_id']== \
-                                                flight_id]['dist_from_plane'].mean()
-
-        norm_vector,_,square_points_flight,_ = plane_fit( \
-                                               square_points[square_points['flight_id']==flight_id], \
-                                               norm_vector_full,shift)
-        flightpath = FlightPath(flight_id,norm_vector,square_points_flight,avg_dist_from_plane)
-        # flightpath.sd_dist_from_plane(square_points_flight)
-        flight_list.append(flightpath)       
-
-    return flight_list
\ No newline at end of file
+    full = PlaneMoments.combine(flight_moments)
+    norm_vector_full = full.norm_vector()
+    flight_list = [FlightPath.from_moments(-100,full)]
+
+    # Full dataset, sampled down to the avg number of points in a flight.
+    # Cached under all its sampling parameters; unseeded and Generator draws change between calls, so are not cached
+    sample_key = None
+    if cache is not None and rng is not None and not isinstance(rng,np.random.Generator):
+        sample_key = square_key + (-200,tuple(np.atleast_1d(rng).tolist()),num_replicates,replace)
+    sampled = cache.get(sample_key) if sample_key is not None else None
+    if sampled is None:
+        density = xyz.shape[0] / len(flight_ids)
+        idx = subsample_replicates(xyz.shape[0],int(density),num_replicates,rng,replace)
+        _,sd_replicates,replicate_moments = replicate_plane_fits(xyz,idx)
+        first = replicate_moments[0]
+        sampled = PlaneMoments(first.count,first.mean,first.scatter,sd_replicates)
+        if sample_key is not None:
+            cache.put(sample_key,sampled)
+    flight_list.append(FlightPath.from_moments(-200,sampled))
+
+    for flight_id,moments in zip(flight_ids,flight_moments):
+        # Avg distance from total point cloud plane
+        avg_dist_from_plane = moments.dist_stats(norm_vector_full,full.mean)[0]
+        flight_list.append(FlightPath.from_moments(flight_id,moments,norm_vector_full,full.mean,avg_dist_from_plane))
+
+    return flight_list
+
+
+### ADAPTIVE (SEQUENTIAL) SAMPLING
+
+def square_metrics(sample_square):
+    '''
+    Flattens the per-dataset statistics of a SampleSquare into a dict, e.g.
+    laefer_C, laefer_W, laefer_rmse, laefer_phi_total, laefer_phi_sample, laefer_cosine_sim_mean.
+    Datasets missing from the SampleSquare are skipped.
+    '''
+    metrics = {}
+    for dataset in ['laefer','nyc','usgs']:
+        if not hasattr(sample_square,'error_decomp_'+dataset):
+            continue
+        C,W,rmse = getattr(sample_square,'error_decomp_'+dataset)
+        metrics[dataset+'_C'] = C
+        metrics[dataset+'_W'] = W
+        metrics[dataset+'_rmse'] = rmse
+        metrics[dataset+'_phi_total'] = getattr(sample_square,'phi_'+dataset+'_total')
+        metrics[dataset+'_phi_sample'] = getattr(sample_square,'phi_'+dataset+'_sample')
+        metrics[dataset+'_cosine_sim_mean'] = getattr(sample_square,'cosine_sim_mean_'+dataset)
+    return metrics
+
+class RunningStats(object):
+    '''
+    RunningStats keeps running means and variances (Welford's algorithm) of named metrics,
+    so confidence intervals can be checked after every batch without storing the samples.
+    
+    Attributes:
+    n, mean, m2 - dicts metric name -> count, running mean, running sum of squared deviations
+    '''
+    def __init__(self):
+        self.n = {}
+        self.mean = {}
+        self.m2 = {}
+
+    def update(self,metrics):
+        # metrics - dict metric name -> scalar; nan / inf values are ignored
+        for name,value in metrics.items():
+            if value is None or not np.isfinite(value):
+                continue
+            n = self.n.get(name,0) + 1
+            delta = value - self.mean.get(name,0.)
+            self.n[name] = n
+            self.mean[name] = self.mean.get(name,0.) + delta/n
+            self.m2[name] = self.m2.get(name,0.) + delta*(value - self.mean[name])
+
+    def sd(self,name):
+        return np.sqrt(self.m2[name]/(self.n[name]-1)) if self.n[name] > 1 else np.inf
+
+    def half_width(self,name,confidence=0.95):
+        # Half width of the t-based confidence interval of the mean
+        n = self.n[name]
+        if n < 2:
+            return np.inf
+        return stats.t.ppf(0.5 + confidence/2,n-1) * self.sd(name)/np.sqrt(n)
+
+    def summary(self,confidence=0.95):
+        rows = []
+        for name in sorted(self.n):
+            hw = self.half_width(name,confidence)
+            rows.append((name,self.n[name],self.mean[name],self.sd(name),hw,self.mean[name]-hw,self.mean[name]+hw))
+        return pd.DataFrame(rows,columns=['metric','n','mean','sd','half_width','ci_low','ci_high'])
+
+def _precision_reached(running_stats,metrics,target_half_width,relative_precision,confidence):
+    for name in metrics:
+        if name not in running_stats.n:
+            return False
+        hw = running_stats.half_width(name,confidence)
+        if target_half_width is not None:
+            target = target_half_width[name] if isinstance(target_half_width,dict) else target_half_width
+        else:
+            target = relative_precision*abs(running_stats.mean[name])
+        if not hw <= target:
+            return False
+    return True
+
+@prof.timed('sequential_sample')
+def sequential_sample(center_points,process_square,
+                      metrics=None,
+                      target_half_width=None,relative_precision=0.05,
+                      confidence=0.95,
+                      batch_size=100,min_squares=30):
+    '''
+    Processes center points in batches until the confidence intervals of the tracked SampleSquare metrics
+    are narrow enough, instead of always using every center point.
+    Inputs:
+    center_points - (n x 2+) numpy array (or iterable) of candidate square centers, e.g. from center_point_sample;
+        n is the maximum number of squares processed
+    process_square - function center_point -> SampleSquare, or None if the square is rejected
+    metrics - list of metric names to track (see square_metrics); default every metric with a finite value in some
+        accepted square, so metrics that are always nan (e.g. phi_sample of one-flight squares) do not block stopping.
+        An explicitly listed metric that is never finite prevents convergence.
+    target_half_width - scalar or dict metric -> scalar, absolute CI half width to reach (overrides relative_precision)
+    relative_precision - CI half width to reach as a fraction of |mean|
+    confidence - confidence level of the intervals
+    batch_size - center points processed between precision checks
+    min_squares - accepted squares required before stopping is allowed
+    Output:
+    sample_squares - list of the accepted SampleSquare objects
+    summary - DataFrame of achieved mean, sd, CI half width and bounds per metric
+    converged - True if the target precision was reached before the center points ran out
+    '''
+    running_stats = RunningStats()
+    sample_squares = []
+    converged = False
+    processed = 0
+    for center_point in center_points:
+        ss = process_square(center_point)
+        processed += 1
+        if ss is not None:
+            running_stats.update(square_metrics(ss))
+            sample_squares.append(ss)
+        if processed % batch_size == 0 and len(sample_squares) >= min_squares:
+            # Metrics tracked by default are the ones with finite values so far
+            tracked = sorted(running_stats.n) if metrics is None else metrics
+            if tracked and _precision_reached(running_stats,tracked,target_half_width,relative_precision,confidence):
+                converged = True
+                break
+
+    logger.info("sequential_sample centers_processed=%d squares=%d converged=%s",
+                processed, len(sample_squares), converged)
+    summary = running_stats.summary(confidence)
+    if metrics is not None:
+        summary = summary[summary['metric'].isin(metrics)].reset_index(drop=True)
+    return sample_squares,summary,converged
+
+
+### CROSS-CAMPAIGN CHANGE DETECTION
+
+# Bits of the packed (cell ix, cell iy, flight code) row keys of CellMoments
+CELL_INDEX_BITS = 24
+FLIGHT_CODE_BITS = 15
+
+class CellMoments(object):
+    '''
+    CellMoments accumulates PlaneMoments per (grid cell, flight) of one dataset while streaming over point tables
+    (flight files or tiles of them), so only one table and the moments are held in memory at a time.
+    Datasets compared with surface_change must use the same cell_size and origin.
+    
+    Attributes:
+    cell_size - scalar side of a grid cell, in point units
+    origin - (x, y) corner of cell (0, 0)
+    flight_ids - list of the flight ids seen, indexed by flight code
+    keys - Int64 numpy array, packed (cell ix, cell iy, flight code) of each row, sorted
+    counts, means, scatter - columnar moments of each row (as from group_moments)
+    '''
+    def __init__(self,cell_size,origin=(0.,0.)):
+        self.cell_size = float(cell_size)
+        self.origin = (float(origin[0]),float(origin[1]))
+        self.flight_ids = []
+        self._flight_codes = {}
+        self._rows = (np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64),np.zeros((0,3)),np.zeros((0,3,3)))
+        self._pending = []
+        self._pending_rows = 0
+
+    def cell_index(self,x,y):
+        # Cell (ix, iy) of coordinates, raises ValueError outside the key range
+        ix = np.floor((np.asarray(x) - self.origin[0]) / self.cell_size).astype(np.int64)
+        iy = np.floor((np.asarray(y) - self.origin[1]) / self.cell_size).astype(np.int64)
+        limit = 1 << (CELL_INDEX_BITS - 1)
+        if ix.size and (min(ix.min(),iy.min()) < -limit or max(ix.max(),iy.max()) >= limit):
+            raise ValueError("points more than %d cells from origin %s, choose an origin nearer the data"
+                             % (limit,self.origin))
+        return ix,iy
+
+    def cell_center(self,ix,iy):
+        return (self.origin[0] + (np.asarray(ix) + .5)*self.cell_size,
+                self.origin[1] + (np.asarray(iy) + .5)*self.cell_size)
+
+    @staticmethod
+    def _pack(ix,iy,flight_codes):
+        offset = 1 << (CELL_INDEX_BITS - 1)
+        return ((ix + offset) << (CELL_INDEX_BITS + FLIGHT_CODE_BITS)) | ((iy + offset) << FLIGHT_CODE_BITS) | flight_codes
+
+    @staticmethod
+    def _unpack(cell_keys):
+        # Cell keys are row keys without the flight code bits
+        offset = 1 << (CELL_INDEX_BITS - 1)
+        mask = (1 << CELL_INDEX_BITS) - 1
+        return (cell_keys >> CELL_INDEX_BITS) - offset,(cell_keys & mask) - offset
+
+    def flight_codes(self,flight_ids):
+        # Codes of flight ids, new ids get the next free code
+        codes = np.empty(len(flight_ids),dtype=np.int64)
+        for i,flight_id in enumerate(flight_ids):
+            if flight_id not in self._flight_codes:
+                if len(self.flight_ids) >= 1 << FLIGHT_CODE_BITS:
+                    raise ValueError("more than %d flights in one dataset" % (1 << FLIGHT_CODE_BITS))
+                self._flight_codes[flight_id] = len(self.flight_ids)
+                self.flight_ids.append(flight_id)
+            codes[i] = self._flight_codes[flight_id]
+        return codes
+
+    def _append(self,keys,counts,means,scatter):
+        self._pending.append((keys,counts,means,scatter))
+        self._pending_rows += keys.shape[0]
+        # Merging once the pending rows outnumber the merged ones keeps the total merge cost linear
+        if self._pending_rows >= self._rows[0].shape[0]:
+            self._consolidate()
+
+    def _consolidate(self):
+        if self._pending:
+            parts = [self._rows] + self._pending
+            self._rows = merge_group_moments(*[np.concatenate([part[k] for part in parts]) for k in range(4)])
+            self._pending = []
+            self._pending_rows = 0
+        return self._rows
+
+    keys = property(lambda self: self._consolidate()[0])
+    counts = property(lambda self: self._consolidate()[1])
+    means = property(lambda self: self._consolidate()[2])
+    scatter = property(lambda self: self._consolidate()[3])
+
+    @prof.timed('CellMoments.add')
+    def add(self,las_points):
+        '''
+        Adds a point table (x_scaled,y_scaled,z_scaled or compact coordinates, and flight_id).
+        Output: self
+        '''
+        if las_points.shape[0] == 0:
+            return self
+        xyz = point_xyz(las_points)
+        ix,iy = self.cell_index(xyz[:,0],xyz[:,1])
+        codes,flight_ids = pd.factorize(las_points['flight_id'])
+        keys = self._pack(ix,iy,self.flight_codes(flight_ids)[codes])
+        unique_keys,group = np.unique(keys,return_inverse=True)
+        self._append(unique_keys,*group_moments(xyz,group.ravel(),unique_keys.shape[0]))
+        return self
+
+    def merge(self,other):
+        '''
+        Adds the moments of another CellMoments on the same grid (e.g. one built by a parallel worker).
+        Output: self
+        '''
+        if other.cell_size != self.cell_size or other.origin != self.origin:
+            raise ValueError("CellMoments grids differ: %s %s vs %s %s"
+                             % (self.cell_size,self.origin,other.cell_size,other.origin))
+        keys,counts,means,scatter = other._consolidate()
+        code_map = self.flight_codes(other.flight_ids)
+        flight_mask = (1 << FLIGHT_CODE_BITS) - 1
+        keys = (keys & ~flight_mask) | code_map[keys & flight_mask]
+        self._append(keys,counts,means,scatter)
+        return self
+
+    @prof.timed('CellMoments.cell_stats')
+    def cell_stats(self,min_points=3,min_flights=1):
+        '''
+        Plane fit of every cell from the moments of all its flights, with the error decomposition
+        of SampleSquare.error_decomp_f: C^2 = sum(n_i*h_i^2)/N, W^2 = sum(n_i*sd_i^2)/N, where h_i and sd_i are the
+        mean and SD of flight i's distances from the cell plane.
+        Inputs:
+        min_points - cells with fewer points are dropped (a plane needs 3)
+        min_flights - cells covered by fewer flights are dropped
+        Output:
+        DataFrame, one row per cell: ix, iy, x, y (cell center), mean_x, mean_y, mean_z (centroid),
+            norm_x, norm_y, norm_z (upward unit normal), num_points, num_flights, C, W
+        '''
+        keys,counts,means,scatter = self._consolidate()
+        row_cells = keys >> FLIGHT_CODE_BITS
+        cells,cell_counts,cell_means,cell_scatter = merge_group_moments(row_cells,counts,means,scatter)
+        normals = np.linalg.eigh(cell_scatter)[1][:,:,0]
+        normals *= np.where(normals[:,2] < 0,-1.,1.)[:,None]
+        # Each row's flight statistics against its cell's plane (PlaneMoments.dist_stats, vectorized)
+        row_cell = np.searchsorted(cells,row_cells)
+        row_normals = normals[row_cell]
+        h = ((means - cell_means[row_cell])*row_normals).sum(axis=1)
+        var = np.maximum(np.einsum('ki,kij,kj->k',row_normals,scatter,row_normals)/counts,0.)
+        num_flights = np.bincount(row_cell,minlength=cells.shape[0])
+        C = np.sqrt(np.bincount(row_cell,counts*h**2,cells.shape[0])/cell_counts)
+        W = np.sqrt(np.bincount(row_cell,counts*var,cells.shape[0])/cell_counts)
+
+        ix,iy = self._unpack(cells)
+        x,y = self.cell_center(ix,iy)
+        stats_df = pd.DataFrame({'ix': ix, 'iy': iy, 'x': x, 'y': y,
+                                 'mean_x': cell_means[:,0], 'mean_y': cell_means[:,1], 'mean_z': cell_means[:,2],
+                                 'norm_x': normals[:,0], 'norm_y': normals[:,1], 'norm_z': normals[:,2],
+                                 'num_points': cell_counts, 'num_flights': num_flights, 'C': C, 'W': W})
+        keep = (cell_counts >= min_points) & (num_flights >= min_flights)
+        logger.info("cell_stats cells=%d kept=%d flights=%d", cells.shape[0], keep.sum(), len(self.flight_ids))
+        return stats_df[keep].reset_index(drop=True)
+
+@prof.timed('dataset_cell_moments')
+def dataset_cell_moments(pt_files,file_dir,cell_size,origin=(0.,0.),bounds=None):
+    '''
+    Streams the flight files of one dataset into a CellMoments, one file in memory at a time.
+    Inputs:
+    pt_files - list of flight files (as for grab_points)
+    file_dir - String, directory of the files
+    cell_size, origin - grid of the CellMoments
+    bounds (optional) - (x_min, y_min, x_max, y_max) tile, points outside are skipped.
+        Tiles aligned to cell edges give disjoint cells, so a large area can be processed tile by tile.
+    Output:
+    CellMoments
+    '''
+    cell_moments = CellMoments(cell_size,origin)
+    for pick in pt_files:
+        las_points = read_flight_file(file_dir,pick)
+        if bounds is not None:
+            x = point_coord(las_points,'x')
+            y = point_coord(las_points,'y')
+            las_points = las_points[(x >= bounds[0]) & (x < bounds[2]) & (y >= bounds[1]) & (y < bounds[3])]
+        cell_moments.add(las_points)
+        logger.info("dataset_cell_moments file=%s points=%d", pick, las_points.shape[0])
+    return cell_moments
+
+@prof.timed('surface_change')
+def surface_change(reference,other,systematic=False):
+    '''
+    Per-cell surface change between two datasets, from their CellMoments.cell_stats tables (same grid).
+    The offset is the distance of the other dataset's cell centroid from the reference cell plane, along the
+    reference normal (positive upward). Its standard error combines both datasets' within-flight scatter,
+    sigma^2 = W_ref^2/N_ref + W_other^2/N_other; with systematic=True the between-flight offsets are added as
+    C^2/num_flights per dataset.
+    Inputs:
+    reference, other - DataFrames from CellMoments.cell_stats
+    systematic - include the C terms in sigma
+    Output:
+    DataFrame, one row per cell in both: ix, iy, x, y, offset, sigma, z_score,
+        normal_angle (degrees between the two cell planes), num_points_ref, num_points_other, C_ref, C_other,
+        W_ref, W_other
+    '''
+    both = reference.merge(other,on=['ix','iy'],suffixes=('_ref','_other'))
+    normal = both[['norm_x_ref','norm_y_ref','norm_z_ref']].values
+    delta = both[['mean_x_other','mean_y_other','mean_z_other']].values - both[['mean_x_ref','mean_y_ref','mean_z_ref']].values
+    offset = (delta*normal).sum(axis=1)
+    variance = both['W_ref']**2/both['num_points_ref'] + both['W_other']**2/both['num_points_other']
+    if systematic:
+        variance = variance + both['C_ref']**2/both['num_flights_ref'] + both['C_other']**2/both['num_flights_other']
+    sigma = np.sqrt(variance.values)
+    cosine = np.abs((normal*both[['norm_x_other','norm_y_other','norm_z_other']].values).sum(axis=1))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        z_score = offset/sigma
+    change = pd.DataFrame({'ix': both['ix'], 'iy': both['iy'], 'x': both['x_ref'], 'y': both['y_ref'],
+                           'offset': offset, 'sigma': sigma, 'z_score': z_score,
+                           'normal_angle': np.degrees(np.arccos(np.clip(cosine,0.,1.))),
+                           'num_points_ref': both['num_points_ref'], 'num_points_other': both['num_points_other'],
+                           'C_ref': both['C_ref'], 'C_other': both['C_other'],
+                           'W_ref': both['W_ref'], 'W_other': both['W_other']})
+    logger.info("surface_change cells_ref=%d cells_other=%d cells_both=%d",
+                reference.shape[0], other.shape[0], change.shape[0])
+    return change
+
+
+### DENSITY PYRAMID
+
+class DensityPyramid(object):
+    '''
+    DensityPyramid holds point counts per (flight_id, return_num) on a grid over a fixed area, with coarser levels
+    of power-of-two cell sizes and summed-area tables, so the point count or density of any axis-aligned
+    rectangle is answered in O(1) instead of rescanning the points (as grab_points does).
+    Counts are built in one streaming pass over the point tables. Rectangle edges inside a cell are handled
+    by assuming uniform density within the cell, so queries aligned to the cells of the level used are exact.
+    Memory is 4 bytes per category per base cell for the counts (plus 8 for each summed-area table built);
+    the count layers grow geometrically as categories appear, and each category is counted into its layer in turn.
+    
+    Attributes:
+    bounds - (x_min, y_min, x_max, y_max) area covered; points outside are counted in num_outside only
+    cell_size - scalar side of a level 0 cell
+    num_levels - Int, level k has cells of cell_size*2**k
+    categories - list of (flight_id, return_num), indexing the first axis of counts
+    counts - (num_categories x ny x nx) uint32 numpy array of level 0 counts, ny and nx multiples of 2**(num_levels-1)
+    num_outside - Int, points outside bounds
+    '''
+    def __init__(self,bounds,cell_size,num_levels=6):
+        self.bounds = tuple(float(b) for b in bounds)
+        self.cell_size = float(cell_size)
+        self.num_levels = num_levels
+        block = 1 << (num_levels - 1)
+        nx = int(np.ceil((self.bounds[2] - self.bounds[0]) / self.cell_size / block))*block
+        ny = int(np.ceil((self.bounds[3] - self.bounds[1]) / self.cell_size / block))*block
+        self.categories = []
+        self._category_codes = {}
+        self._layers = np.zeros((0,ny,nx),dtype=np.uint32)
+        self.num_outside = 0
+        self._tables = {}
+
+    @property
+    def counts(self):
+        return self._layers[:len(self.categories)]
+
+    def _codes(self,categories):
+        # Category codes; new categories take the next count layers, the layer capacity doubles when exhausted
+        for category in categories:
+            if category not in self._category_codes:
+                self._category_codes[category] = len(self.categories)
+                self.categories.append(category)
+        if len(self.categories) > self._layers.shape[0]:
+            layers = np.zeros((max(len(self.categories),2*self._layers.shape[0]),)+self._layers.shape[1:],
+                              dtype=np.uint32)
+            layers[:self._layers.shape[0]] = self._layers
+            self._layers = layers
+        return np.array([self._category_codes[c] for c in categories],dtype=np.int64)
+
+    @prof.timed('DensityPyramid.add')
+    def add(self,las_points):
+        '''
+        Counts a point table (coordinates, flight_id, and return_num or flag_byte). Output: self
+        '''
+        if las_points.shape[0] == 0:
+            return self
+        _,ny,nx = self._layers.shape
+        ix = np.floor((point_coord(las_points,'x') - self.bounds[0]) / self.cell_size)
+        iy = np.floor((point_coord(las_points,'y') - self.bounds[1]) / self.cell_size)
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        self.num_outside += int(inside.size - inside.sum())
+        if 'return_num' in las_points.columns:
+            return_num = las_points['return_num'].values[inside]
+        else:
+            return_num = las_points['flag_byte'].values[inside] % 16
+        category = pd.MultiIndex.from_arrays([las_points['flight_id'].values[inside],return_num])
+        codes,categories = pd.factorize(category)
+        layers = self._codes(list(categories))
+        cells = iy[inside].astype(np.int64)*nx + ix[inside].astype(np.int64)
+        # One category at a time, so the int64 bincount temporary is a single layer
+        order = np.argsort(codes,kind='stable')
+        edges = np.searchsorted(codes[order],np.arange(len(categories)+1))
+        for k,layer in enumerate(layers):
+            layer_counts = self._layers[layer].reshape(-1)
+            np.add(layer_counts,np.bincount(cells[order[edges[k]:edges[k+1]]],minlength=ny*nx),
+                   out=layer_counts,casting='unsafe')
+        self._tables = {}
+        return self
+
+    def level_counts(self,level):
+        # (num_categories x ny/2**level x nx/2**level) counts of one level
+        c,ny,nx = self.counts.shape
+        block = 1 << level
+        return self.counts.reshape(c,ny//block,block,nx//block,block).sum(axis=(2,4),dtype=np.int64)
+
+    def summed_area(self,level=0):
+        '''Summed-area table of a level, table[:,j,i] = count of cells [0,j) x [0,i); built on first use'''
+        if level not in self._tables:
+            counts = self.level_counts(level)
+            table = np.zeros((counts.shape[0],counts.shape[1]+1,counts.shape[2]+1),dtype=np.int64)
+            np.cumsum(np.cumsum(counts,axis=1),axis=2,out=table[:,1:,1:])
+            self._tables[level] = table
+        return self._tables[level]
+
+    def _table_at(self,table,u,v):
+        # Table interpolated at fractional cell coordinates (uniform density within each cell)
+        u = np.clip(u,0,table.shape[2]-1)
+        v = np.clip(v,0,table.shape[1]-1)
+        i = np.minimum(np.floor(u).astype(np.int64),table.shape[2]-2)
+        j = np.minimum(np.floor(v).astype(np.int64),table.shape[1]-2)
+        fu,fv = u - i,v - j
+        return (table[:,j,i]*(1-fu)*(1-fv) + table[:,j,i+1]*fu*(1-fv)
+                + table[:,j+1,i]*(1-fu)*fv + table[:,j+1,i+1]*fu*fv)
+
+    @prof.timed('DensityPyramid.count')
+    def count(self,x_min,y_min,x_max,y_max,level=0):
+        '''
+        Point counts of axis-aligned rectangles, per category.
+        Inputs: rectangle corners (scalars or arrays of m rectangles), level - grid level used
+        Output: DataFrame, one row per rectangle, columns MultiIndex (flight_id, return_num)
+        '''
+        table = self.summed_area(level)
+        size = self.cell_size*(1 << level)
+        u0,u1 = [(np.atleast_1d(np.asarray(x,dtype=np.float64)) - self.bounds[0])/size for x in (x_min,x_max)]
+        v0,v1 = [(np.atleast_1d(np.asarray(y,dtype=np.float64)) - self.bounds[1])/size for y in (y_min,y_max)]
+        counts = (self._table_at(table,u1,v1) - self._table_at(table,u0,v1)
+                  - self._table_at(table,u1,v0) + self._table_at(table,u0,v0))
+        columns = pd.MultiIndex.from_tuples(self.categories,names=['flight_id','return_num'])
+        return pd.DataFrame(counts.T,columns=columns)
+
+    def density(self,x_min,y_min,x_max,y_max,level=0,flight_ids=None,return_nums=None):
+        '''
+        Point density (points per square unit) of axis-aligned rectangles, over the selected flights and returns.
+        Output: numpy array, one density per rectangle
+        '''
+        counts = self.count(x_min,y_min,x_max,y_max,level)
+        keep = np.ones(counts.shape[1],dtype=bool)
+        if flight_ids is not None:
+            keep &= counts.columns.get_level_values('flight_id').isin(flight_ids)
+        if return_nums is not None:
+            keep &= counts.columns.get_level_values('return_num').isin(return_nums)
+        area = (np.asarray(x_max,dtype=np.float64) - x_min)*(np.asarray(y_max,dtype=np.float64) - y_min)
+        return counts.values[:,keep].sum(axis=1)/np.atleast_1d(area)
+
+    def square_density(self,center_points,feet_from_point,level=0,flight_ids=None,return_nums=None):
+        # Density of the squares grab_points would return around each center point
+        center_points = np.atleast_2d(center_points)
+        x,y = center_points[:,0],center_points[:,1]
+        return self.density(x-feet_from_point,y-feet_from_point,x+feet_from_point,y+feet_from_point,
+                            level,flight_ids,return_nums)
+
+    def save(self,path):
+        np.savez_compressed(path,counts=self.counts,bounds=self.bounds,cell_size=self.cell_size,
+                            num_levels=self.num_levels,num_outside=self.num_outside,
+                            categories=np.array(self.categories,dtype=object))
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path,allow_pickle=True) as f:
+            pyramid = cls(f['bounds'],f['cell_size'],int(f['num_levels']))
+            pyramid._layers = f['counts']
+            pyramid.num_outside = int(f['num_outside'])
+            pyramid.categories = [tuple(c) for c in f['categories']]
+        pyramid._category_codes = {c: i for i,c in enumerate(pyramid.categories)}
+        return pyramid
+
+@prof.timed('build_density_pyramid')
+def build_density_pyramid(pt_files,file_dir,bounds,cell_size,num_levels=6):
+    '''
+    Builds a DensityPyramid in one pass over the flight files, one file in memory at a time.
+    Inputs:
+    pt_files - list of flight files (as for grab_points)
+    file_dir - String, directory of the files
+    bounds - (x_min, y_min, x_max, y_max) area covered
+    cell_size - scalar side of a level 0 cell
+    num_levels - Int, number of power-of-two levels
+    Output:
+    DensityPyramid
+    '''
+    pyramid = DensityPyramid(bounds,cell_size,num_levels)
+    for pick in pt_files:
+        pyramid.add(read_flight_file(file_dir,pick))
+        logger.info("build_density_pyramid file=%s categories=%d", pick, len(pyramid.categories))
+    logger.info("build_density_pyramid cells=%d points_outside=%d", pyramid.counts[0].size if pyramid.categories else 0,
+                pyramid.num_outside)
+    return pyramid
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+#profiling_functions.py
+'''
+Lightweight timing and counting hooks for the hot paths in pypwaves_updated and point_density_functions.
+Profiling is off by default; while disabled every hook returns after a single flag check.
+
+Usage:
+    import profiling_functions as prof
+    prof.enable()
+    ... run reads / sampling ...
+    prof.log_summary()
+'''
+
+import time
+import logging
+import functools
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_timings = defaultdict(lambda: [0, 0.0])  # stage name -> [calls, total seconds]
+_counters = defaultdict(int)               # counter name -> running total
+
+
+def enable(reset_stats=False):
+    '''Turn instrumentation on. If reset_stats, previously collected timings and counters are dropped.'''
+    global _enabled
+    if reset_stats:
+        reset()
+    _enabled = True
+
+def disable():
+    '''Turn instrumentation off. Collected timings and counters are kept until reset().'''
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    '''Drop all collected timings and counters.'''
+    _timings.clear()
+    _counters.clear()
+
+
+class _NullTimer(object):
+    '''Shared no-op context manager handed out while profiling is disabled.'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    '''Context manager adding its wall time to the named stage.'''
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stage = _timings[self.name]
+        stage[0] += 1
+        stage[1] += time.perf_counter() - self.start
+        return False
+
+
+def timer(name):
+    '''
+    Context manager timing the enclosed block under the stage name.
+    Example:
+        with prof.timer('grab_points.read_hdf'):
+            las_points = pd.read_hdf(...)
+    '''
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+def timed(name=None):
+    '''
+    Decorator timing every call of the wrapped function under name (default: the function's qualified name).
+    While disabled the wrapper calls straight through.
+    '''
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    '''Add n to the named counter (e.g. bytes read, pulses decoded, points filtered, planes fit).'''
+    if _enabled:
+        _counters[name] += n
+
+
+def summary():
+    '''
+    Returns a plain dict snapshot of collected statistics:
+        {'timings': {stage: {'calls', 'total_s', 'mean_s'}}, 'counters': {name: total}}
+    The dict is picklable, so summaries from pool workers can be sent back and combined with merge_summary.
+    '''
+    timings = {}
+    for stage, (calls, total) in _timings.items():
+        timings[stage] = {'calls': calls,
+                          'total_s': total,
+                          'mean_s': total / calls if calls else 0.0}
+    return {'timings': timings, 'counters': dict(_counters)}
+
+def merge_summary(other):
+    '''Fold a summary() dict (typically from a worker process) into this process's statistics.'''
+    for stage, stats in other.get('timings', {}).items():
+        _timings[stage][0] += stats['calls']
+        _timings[stage][1] += stats['total_s']
+    for counter_name, total in other.get('counters', {}).items():
+        _counters[counter_name] += total
+
+def log_summary(level=logging.INFO):
+    '''Log one line per stage (slowest first) and one line per counter.'''
+    stats = summary()
+    for stage, t in sorted(stats['timings'].items(), key=lambda kv: -kv[1]['total_s']):
+        logger.log(level, "stage=%s calls=%d total_s=%.4f mean_s=%.6f",
+                   stage, t['calls'], t['total_s'], t['mean_s'])
+    for counter_name, total in sorted(stats['counters'].items()):
+        logger.log(level, "counter=%s total=%d", counter_name, total)
+    return stats
@@ -1,23 +1,32 @@
-"""Module :mod:`pypwaves.base` basic functions for opening and displaying pulsewave files"""
-from __future__ import print_function
-from __future__ import division
-from builtins import str
-from builtins import range
-from past.utils import old_div
-from builtins import object,bytes
+"""Module :mod:`pypwaves.base` basic functions for opening and displaying pulsewave files
+   Only NumPy is needed to read and decode files; matplotlib (plotting), scipy (Waves.smooth) and
+   rtree (spatial index) are imported on first use.
+"""
 
 import struct, numpy as np,os, inspect
-import matplotlib.pyplot as plt
-from scipy.signal import savgol_filter
-from rtree import index
+import logging
+import threading
+import queue
+
+import profiling_functions as prof
+from lazy_modules import LazyModule
+
+plt = LazyModule('matplotlib.pyplot')
+
+logger = logging.getLogger(__name__)
 
 
 
 
 class PulseWaves(object):
-    """Pulsewaves class object"""
+    """Pulsewaves class object
+       :param pls_file: String, pathname of the pulsewaves file (*.pls)
+       :param validate: Bool, check the header layout against the .pls and .wvs file sizes (see validate_layout)
+       :param allow_truncated: Bool, open a truncated file up to its last complete pulse instead of raising
+    """
     
-    def __init__(self,pls_file):
+    @prof.timed('PulseWaves.read_header')
+    def __init__(self,pls_file,validate=True,allow_truncated=False):
         pulsebinary =  open(pls_file, 'rb')
               
         #read header
@@ -130,15 +139,101 @@ class PulseWaves(object):
 
     
         #close the pls file
+        self.end_of_vlrs = pulsebinary.tell()
+        prof.count('pls_bytes_read', pulsebinary.tell())
         pulsebinary.close()
+
+        self.num_pulses_header = self.num_pulses
+        self.truncated = False
+        if validate:
+            self.validate_layout(allow_truncated)
+
+    def validate_layout(self, allow_truncated=False):
+        """Check that the pulse records and wave records the header describes fit in the .pls and .wvs files.
+           Costs two file size lookups and one pulse record read, whatever the file size
+           (a truncated .wvs adds a binary search over the pulse records).
+           With allow_truncated, num_pulses is lowered to the last pulse whose pulse and wave records are
+           complete (num_pulses_header keeps the header's count) instead of raising ValueError.
+        """
+        if self.pulse_size < PULSE_RECORD_SIZE:
+            raise ValueError("%s: pulse_size %d is smaller than a pulse record (%d bytes)"
+                             % (self.filename, self.pulse_size, PULSE_RECORD_SIZE))
+        if self.offset_to_pulses < self.end_of_vlrs or self.num_pulses < 0:
+            raise ValueError("%s: header points pulses at byte %d, inside the header/VLRs (%d bytes)"
+                             % (self.filename, self.offset_to_pulses, self.end_of_vlrs))
+
+        pls_size = os.path.getsize(self.filename)
+        complete = max(pls_size - self.offset_to_pulses, 0) // self.pulse_size
+        if complete < self.num_pulses:
+            self._truncate(complete, allow_truncated,
+                           "%s: header lists %d pulses, file holds %d complete pulse records"
+                           % (self.filename, self.num_pulses, complete))
+
+        if not self.num_pulses or not os.path.isfile(self.wave_filename()):
+            return
+        wvs_size = os.path.getsize(self.wave_filename())
+        records = self.pulse_memmap()
+        if records['offset_to_waves'][-1] < wvs_size:
+            # The last record has no successor to end at, its end comes from its segment headers
+            last = pulse_block_from_records(self, np.array(records[-1:]), np.array([self.num_pulses - 1]))
+            end = self._wave_record_end(last['offset_to_waves'][0], last['pulse_descriptor'][0])
+            if end is not None and end <= wvs_size:
+                return
+            self._truncate(self.num_pulses - 1, allow_truncated,
+                           "%s: wave record of the last pulse %d runs past the end of %s (%d bytes)"
+                           % (self.filename, self.num_pulses - 1, self.wave_filename(), wvs_size))
+            return
+        # Wave records are written in pulse order, so pulse i ends where pulse i+1's waves start
+        low, first_outside = 0, self.num_pulses - 1
+        while low < first_outside:
+            mid = (low + first_outside) // 2
+            if records['offset_to_waves'][mid] < wvs_size:
+                low = mid + 1
+            else:
+                first_outside = mid
+        # Pulses before first_outside are complete unless the file ends inside the record just before it
+        complete = first_outside
+        if first_outside > 0 and records['offset_to_waves'][first_outside] > wvs_size:
+            complete -= 1
+        self._truncate(complete, allow_truncated,
+                       "%s: wave records of pulses %d and later lie beyond the end of %s (%d bytes)"
+                       % (self.filename, complete, self.wave_filename(), wvs_size))
+
+    def _wave_record_end(self, offset_to_waves, descriptor_id):
+        """End offset of one pulse's wave record, walked through its segment headers (as decode_wave_block does).
+           Returns None when a segment header lies beyond the end of the .wvs file.
+        """
+        waves = np.memmap(self.wave_filename(), dtype=np.uint8, mode='r')
+        position = int(offset_to_waves)
+        sample_records = self.vlrs[int(descriptor_id)].sampling_records
+        for key in sorted(sample_records.keys()):
+            sample_record = sample_records[key]
+            bytes_count = sample_record.bits_samples // 8
+            position += sample_record.bits_anchor // 8
+            if position + bytes_count > waves.shape[0]:
+                return None
+            num_samples = int.from_bytes(waves[position:position + bytes_count].tobytes(), 'little')
+            # negative (signed) counts are empty segments, as in decode_wave_block
+            if num_samples >= 2**(8*bytes_count - 1):
+                num_samples = 0
+            position += bytes_count + num_samples * (sample_record.bits_per_sample // 8)
+        return position
+
+    def _truncate(self, num_pulses, allow_truncated, message):
+        if not allow_truncated:
+            raise ValueError(message + "; open with allow_truncated=True to read the complete pulses")
+        logger.warning("%s; reading the first %d pulses", message, num_pulses)
+        self.num_pulses = num_pulses
+        self.truncated = True
         
+    @prof.timed('PulseWaves.get_pulse')
     def get_pulse(self,pulse_number):
         """Given pulse number(a) return the corresponding pulse record(s)
         :param pulse_record: Int or list of pulse number or a pulse record object
         """
         
         #check if pulse number if within range of expected number of pulse
-        if pulse_number > self.num_pulses or pulse_number <0:
+        if pulse_number >= self.num_pulses or pulse_number <0:
             print("ERROR: Pulse number outside the range of expected values")
             return
 
@@ -151,6 +246,7 @@ class PulseWaves(object):
 
         return record
                 
+    @prof.timed('PulseWaves.get_waves')
     def get_waves(self,pulse_record, filename = None):    
         """Give pulse record(s) or pulse number(s) this functions return the corresponding waves
         
@@ -198,14 +294,17 @@ class PulseWaves(object):
 
         pulsebinary.close()
 
+    @prof.timed('PulseWaves.create_spatial_index')
     def create_spatial_index(self, overwrite = False):
         """Create and 2D RTree spatial index using last sample coordinates"""
          
         #check if spatial index exists
          
+        from rtree import index
         spatial_index = index.Index(os.path.splitext(self.filename)[0])
+        progress_marks = set((np.linspace(0,1,11) * self.num_pulses).astype(int))
          
-        print("Generating spatial index.....%s points...this may take a while...." % self.num_pulses)
+        logger.info("create_spatial_index file=%s pulses=%d", self.filename, self.num_pulses)
          
         for pulse_record in self.cycle_pulses(0,self.num_pulses):           
             x_last = pulse_record.x_anchor + pulse_record.last_return * pulse_record.dx
@@ -217,9 +316,10 @@ class PulseWaves(object):
             #add pulse to index
             spatial_index.insert(pulse_record.pulse_number,(x_last,y_last))
          
-            #print status update
-            if pulse_record.pulse_number in (np.linspace(0,1,11) * self.num_pulses).astype(int):
-                print("%s percent complete." % int(100*pulse_record.pulse_number/float(self.num_pulses)))
+            #log status update
+            if pulse_record.pulse_number in progress_marks:
+                logger.info("create_spatial_index file=%s percent_complete=%d", self.filename,
+                            int(100*pulse_record.pulse_number/float(self.num_pulses)))
          
         spatial_index.close() 
 
@@ -235,7 +335,7 @@ class PulseWaves(object):
             print("Spatial index not found!!!")
             return 
 
-        
+        from rtree import index
         spatial_index = index.Index(os.path.splitext(self.filename)[0])
 
         intersected_pulses = list(spatial_index.intersection((x-distance,y-distance,x+distance,y+distance)))
@@ -245,6 +345,257 @@ class PulseWaves(object):
 
         return intersected_pulses
 
+    def _check_range(self, start, end):
+        if start < 0 or start > self.num_pulses or end < start:
+            raise ValueError("pulse range [%d, %d) is not within [0, %d)" % (start, end, self.num_pulses))
+
+    @prof.timed('PulseWaves.read_pulse_block')
+    def read_pulse_block(self, start, end):
+        """Read pulses [start, end) in one call and decode them into columnar arrays
+           :param start: Int, first pulse number
+           :param end: Int, one past the last pulse number (clipped to num_pulses)
+           :return: dict of numpy arrays keyed like PulseRecord attributes (see pulse_block_from_records),
+                    empty when start == end
+        """
+        self._check_range(start, end)
+        end = min(end, self.num_pulses)
+
+        with open(self.filename, 'rb') as pulsebinary:
+            pulsebinary.seek(self.offset_to_pulses + start * self.pulse_size)
+            records = np.fromfile(pulsebinary, dtype=pulse_record_dtype(self.pulse_size), count=end - start)
+        prof.count('pls_bytes_read', records.nbytes)
+
+        return pulse_block_from_records(self, records, np.arange(start, start + records.shape[0]))
+
+    def wave_filename(self):
+        """Pathname of the uncompressed waveform file (*.wvs) paired with this pulsewaves file"""
+        return os.path.splitext(self.filename)[0] + '.wvs'
+
+    @prof.timed('PulseWaves.read_wave_block')
+    def read_wave_block(self, pulse_block):
+        """Decode the waves of every pulse in a pulse block (output of read_pulse_block) in one vectorized pass
+           :param pulse_block: dict of pulse arrays, must contain 'pulse_descriptor' and 'offset_to_waves'
+           :return: WaveBlock, one row per (pulse, sampling)
+        """
+        wavebinary = np.memmap(self.wave_filename(), dtype=np.uint8, mode='r')
+        return decode_wave_block(self, pulse_block, wavebinary, pulse_block['offset_to_waves'])
+
+    def _read_scan_chunk(self, pulsebinary, wavebinary, wave_size, start, end, max_read_bytes):
+        """Read pulses [start, end) and their waves with one read per file, then decode them.
+           The waves are read as the single byte range from the chunk's first wave record to the next pulse's
+           offset_to_waves (the end of the file for the last chunk); if that range is not contiguous or exceeds
+           max_read_bytes, the waves are decoded from a memmap of the .wvs file instead.
+        """
+        count = min(end + 1, self.num_pulses) - start
+        pulsebinary.seek(self.offset_to_pulses + start * self.pulse_size)
+        records = np.frombuffer(pulsebinary.read(count * self.pulse_size), dtype=pulse_record_dtype(self.pulse_size))
+        prof.count('pls_bytes_read', records.nbytes)
+        pulse_block = pulse_block_from_records(self, records[:end - start], np.arange(start, end))
+
+        offsets = pulse_block['offset_to_waves']
+        first, last = int(offsets.min()), int(offsets.max())
+        span_end = int(records['offset_to_waves'][-1]) if count > end - start else wave_size
+        if span_end <= last or span_end - first > max_read_bytes:
+            return pulse_block, self.read_wave_block(pulse_block)
+        wavebinary.seek(first)
+        buffer = np.frombuffer(wavebinary.read(span_end - first), dtype=np.uint8)
+        prof.count('wvs_range_reads')
+        return pulse_block, decode_wave_block(self, pulse_block, buffer, offsets - first)
+
+    def scan_blocks(self, start=0, end=None, chunk_size=50000, prefetch=2, max_read_bytes=1 << 28):
+        """Generator over decoded chunks of pulses [start, end) with their waves, in pulse order.
+           A background thread reads and decodes up to prefetch chunks ahead of the consumer, each with one
+           .pls read and one coalesced .wvs range read (see _read_scan_chunk), so I/O overlaps processing.
+           :param chunk_size: Int, pulses per chunk
+           :param prefetch: Int, chunks buffered ahead of the consumer
+           :param max_read_bytes: Int, largest .wvs range read at once
+           :return: yields (pulse_block, wave_block) as read_pulse_block / read_wave_block
+        """
+        end = self.num_pulses if end is None else end
+        self._check_range(start, end)
+        end = min(end, self.num_pulses)
+        chunks = [(s, min(s + chunk_size, end)) for s in range(start, end, chunk_size)]
+        wave_size = os.path.getsize(self.wave_filename())
+        buffered = queue.Queue(maxsize=max(prefetch, 1))
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffered.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def reader():
+            try:
+                with open(self.filename, 'rb') as pulsebinary, open(self.wave_filename(), 'rb') as wavebinary:
+                    for chunk_start, chunk_end in chunks:
+                        if stop.is_set():
+                            return
+                        put(self._read_scan_chunk(pulsebinary, wavebinary, wave_size,
+                                                  chunk_start, chunk_end, max_read_bytes))
+            except Exception as error:
+                put(error)
+            finally:
+                put(done)
+
+        thread = threading.Thread(target=reader, name='pulsewaves-prefetch', daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buffered.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def max_wave_record_bytes(self, descriptor_id):
+        """Upper bound on the size of one pulse's wave record under a pulse descriptor (largest sample counts)"""
+        size = 0
+        for sample_record in self.vlrs[int(descriptor_id)].sampling_records.values():
+            bytes_count = sample_record.bits_samples // 8
+            size += sample_record.bits_anchor // 8 + bytes_count \
+                    + (2**(8*bytes_count - 1) - 1) * (sample_record.bits_per_sample // 8)
+        return size
+
+    @prof.timed('PulseWaves.fetch_waves')
+    def fetch_waves(self, pulse_numbers, max_gap=4096):
+        """Decode the waves of arbitrary pulses (e.g. get_spatial_points output) with few large reads.
+           The wave records are sorted by offset and merged into byte ranges (see plan_wave_reads); each range is
+           read once, offsets are remapped into the concatenated buffer and all records decoded in one pass.
+           A record ends at the next pulse's offset_to_waves, or after max_wave_record_bytes when that is unknown.
+           :param pulse_numbers: Int array of pulse numbers, any order, duplicates allowed
+           :param max_gap: Int, ranges separated by at most max_gap bytes are read as one
+           :return: (pulse_block, wave_block) in the caller's order: row i of pulse_block is pulse_numbers[i]
+        """
+        pulse_numbers = np.asarray(pulse_numbers, dtype=np.int64)
+        if pulse_numbers.shape[0] and (pulse_numbers.min() < 0 or pulse_numbers.max() >= self.num_pulses):
+            raise ValueError("pulse numbers outside [0, %d)" % self.num_pulses)
+        records = self.pulse_memmap()
+        pulse_records = np.array(records[pulse_numbers])
+        prof.count('pls_bytes_read', pulse_records.nbytes)
+        pulse_block = pulse_block_from_records(self, pulse_records, pulse_numbers)
+
+        wave_size = os.path.getsize(self.wave_filename())
+        starts = pulse_block['offset_to_waves'].astype(np.int64)
+        next_pulse = np.minimum(pulse_numbers + 1, self.num_pulses - 1)
+        ends = np.array(records['offset_to_waves'][next_pulse], dtype=np.int64)
+        caps = np.zeros(starts.shape[0], dtype=np.int64)
+        for descriptor_id in np.unique(pulse_block['pulse_descriptor']):
+            caps[pulse_block['pulse_descriptor'] == descriptor_id] = self.max_wave_record_bytes(descriptor_id)
+        unknown = (ends <= starts) | (pulse_numbers == self.num_pulses - 1)
+        ends = np.minimum(np.where(unknown, starts + caps, ends), wave_size)
+
+        ranges, range_index = plan_wave_reads(starts, ends, max_gap)
+        range_length = ranges[:, 1] - ranges[:, 0]
+        range_base = np.concatenate(([0], np.cumsum(range_length)[:-1])).astype(np.int64)
+        buffer = np.empty(range_length.sum(), dtype=np.uint8)
+        with open(self.wave_filename(), 'rb') as wavebinary:
+            for (range_start, _), base, length in zip(ranges, range_base, range_length):
+                wavebinary.seek(range_start)
+                buffer[base:base + length] = np.frombuffer(wavebinary.read(length), dtype=np.uint8)
+        prof.count('wvs_range_reads', ranges.shape[0])
+
+        offsets = range_base[range_index] + starts - ranges[range_index, 0]
+        return pulse_block, decode_wave_block(self, pulse_block, buffer, offsets)
+
+    def pulse_memmap(self):
+        """Memory-map the pulse records as a structured numpy array (pulse_record_dtype), one entry per pulse"""
+        return np.memmap(self.filename, dtype=pulse_record_dtype(self.pulse_size), mode='r',
+                         offset=self.offset_to_pulses, shape=(self.num_pulses,))
+
+    def build_time_index(self, step=4096):
+        """Sample every step-th pulse's gps timestamp so time queries can binary search the pulse block.
+           Pulses are expected in acquisition (gps time) order, as written by the scanner.
+           :param step: Int, pulses between index entries; queries read at most 2*step timestamps
+        """
+        records = self.pulse_memmap()
+        sampled = self.t_scale * np.array(records['gps_timestamp'][::step]) + self.t_offset
+        if np.any(np.diff(sampled) < 0):
+            raise ValueError("Pulses in %s are not in gps time order, cannot build a time index" % self.filename)
+        self.time_index_step = step
+        self.time_index = sampled
+        return sampled
+
+    def _search_time(self, records, t, side):
+        """Pulse number where t would be inserted into the pulse timestamps (np.searchsorted semantics)"""
+        step = self.time_index_step
+        i = np.searchsorted(self.time_index, t, side=side)
+        low = max(i - 1, 0) * step
+        high = min(i * step + 1, self.num_pulses)
+        times = self.t_scale * np.array(records['gps_timestamp'][low:high]) + self.t_offset
+        return low + int(np.searchsorted(times, t, side=side))
+
+    def time_range(self, t_start, t_end):
+        """Pulse number range [start, end) of all pulses with t_start <= gps_timestamp <= t_end.
+           Builds the time index on first use; cost is O(log n) plus two index steps of timestamps.
+        """
+        if not hasattr(self, 'time_index'):
+            self.build_time_index()
+        records = self.pulse_memmap()
+        start = self._search_time(records, t_start, 'left')
+        end = self._search_time(records, t_end, 'right')
+        return start, max(start, end)
+
+    def read_time_range(self, t_start, t_end):
+        """Pulse block (see read_pulse_block) of all pulses with t_start <= gps_timestamp <= t_end"""
+        start, end = self.time_range(t_start, t_end)
+        if start == end:
+            return pulse_block_from_records(self, np.zeros(0, dtype=pulse_record_dtype(self.pulse_size)),
+                                            np.zeros(0, dtype=np.int64))
+        return self.read_pulse_block(start, end)
+
+    def scan_line(self, pulse_number, search_step=4096):
+        """Pulse number range [start, end) of the scan line containing pulse_number.
+           A scan line ends at a pulse with the edge of scan line bit set or where the scan direction changes.
+        """
+        records = self.pulse_memmap()
+
+        def boundaries(low, high):
+            #positions p in [low, high-1) where the scan line ends after pulse p
+            flags = np.array(records['flags'][low:high])
+            edge = (flags[:-1] >> 4) & 1
+            direction = (flags >> 5) & 1
+            return low + np.flatnonzero((edge == 1) | (direction[1:] != direction[:-1]))
+
+        start = 0
+        high = pulse_number + 1
+        while high > 1:
+            low = max(high - search_step, 0)
+            ends = boundaries(low, high)
+            if ends.shape[0]:
+                start = int(ends[-1]) + 1
+                break
+            high = low + 1
+
+        end = self.num_pulses
+        low = pulse_number
+        while low < self.num_pulses - 1:
+            high = min(low + search_step, self.num_pulses)
+            ends = boundaries(low, high)
+            if ends.shape[0]:
+                end = int(ends[0]) + 1
+                break
+            low = high - 1
+        return start, end
+
+    def trajectory(self, step=1000):
+        """Decimated anchor trajectory for plotting and QA: every step-th pulse's time and anchor position
+           :return: dict of numpy arrays gps_timestamp, x_anchor, y_anchor, z_anchor, pulse_number
+        """
+        records = self.pulse_memmap()[::step]
+        return {'gps_timestamp': self.t_scale * np.array(records['gps_timestamp']) + self.t_offset,
+                'x_anchor': self.x_scale * np.array(records['x_anchor']) + self.x_offset,
+                'y_anchor': self.y_scale * np.array(records['y_anchor']) + self.y_offset,
+                'z_anchor': self.z_scale * np.array(records['z_anchor']) + self.z_offset,
+                'pulse_number': np.arange(0, self.num_pulses, step)}
+
 def openPLS(filename):  
     """Open an uncompressed pulsewaves files (*.pls)
        :param filename: pulsewaves file path
@@ -285,11 +636,13 @@ class PulseRecord(object):
         self.facet = 	bits[14:]
         self.intensity = struct.unpack("B", pulsebinary.read(1))[0]
         self.classification = 	struct.unpack("B", pulsebinary.read(1))[0]
+        prof.count('pulses_decoded')
+        prof.count('pls_bytes_read', header.pulse_size)
         
         #calculate direction vector
-        self.dx = old_div((self.x_target - self.x_anchor),1000)
-        self.dy = old_div((self.y_target - self.y_anchor),1000)
-        self.dz = old_div((self.z_target - self.z_anchor),1000)
+        self.dx = (self.x_target - self.x_anchor) / 1000
+        self.dy = (self.y_target - self.y_anchor) / 1000
+        self.dz = (self.z_target - self.z_anchor) / 1000
         
     def table_to_dict(self):
         pulse_record_attrs = ['gps_timestamp', 
@@ -356,6 +709,7 @@ class PulseRecord(object):
         
 class Waves(object):
     
+    @prof.timed('Waves.decode')
     def __init__(self, header, pulse_record):    
         
         #get sample records corresponding to the waveform
@@ -378,16 +732,16 @@ class Waves(object):
         for key in list(sample_records.keys()):
 
             sample_record = sample_records[key]           
-            duration_anchor = struct.unpack("=L", wavebinary.read(old_div(sample_record.bits_anchor,8)))[0]   
+            duration_anchor = struct.unpack("=L", wavebinary.read(sample_record.bits_anchor // 8))[0]   
             # print("Key {} Duration Anchor: {}".format(key,duration_anchor))
-            num_samples = struct.unpack("=h", wavebinary.read(old_div(sample_record.bits_samples,8)))[0] 
+            num_samples = struct.unpack("=h", wavebinary.read(sample_record.bits_samples // 8))[0] 
             #print("bits per sample: ",sample_record.bits_per_sample)
             #print("num samples: ",num_samples)
             #print("bits anchor: ",sample_record.bits_anchor)
             samples= []
             for sample_num in range(num_samples):                 
-                #sample = struct.unpack("=h", wavebinary.read(old_div(sample_record.bits_per_sample,8)))[0]
-                sample = wavebinary.read(old_div(sample_record.bits_per_sample,8))[0]
+                #sample = struct.unpack("=h", wavebinary.read(sample_record.bits_per_sample // 8))[0]
+                sample = wavebinary.read(sample_record.bits_per_sample // 8)[0]
                 #calculate 3 dimensional sample coordinates
                 x = pulse_record.x_anchor + (duration_anchor + sample_num)  * pulse_record.dx
                 y  =pulse_record.y_anchor + (duration_anchor + sample_num)  * pulse_record.dy
@@ -396,6 +750,8 @@ class Waves(object):
             
             self.segments[key] = np.array(samples).T
         
+        prof.count('waves_decoded')
+        prof.count('wvs_bytes_read', 60 + wavebinary.tell() - pulse_record.offset_to_waves)
         wavebinary.close()
         
         
@@ -432,6 +788,7 @@ class Waves(object):
         plt.show()
         plt.close()
      
+    @prof.timed('Waves.smooth')
     def smooth(self, window,polyorder,deriv = 0):
         ''' Use savitzky golay filter to smooth the waveform inplace
         :param window: Int, odd numbered window size
@@ -439,6 +796,7 @@ class Waves(object):
         :param deriv: Int, derivative number
         See scipy.signal.savgolfilter docs for more information
         '''
+        from scipy.signal import savgol_filter
         #cycle through the segments
         for key,value in list(self.segments.items()):
             self.segments[key][3] = savgol_filter(self.segments[key][3],window,polyorder,deriv)
@@ -451,6 +809,186 @@ class Waves(object):
                 print("{:<20} {:<15}".format(key, list(value.keys())))
         
 
+# Byte layout of the fixed part of a pulse record (PulseWaves pulse format 0), little endian.
+PULSE_RECORD_FIELDS = [('gps_timestamp', '<i8', 0),
+                       ('offset_to_waves', '<i8', 8),
+                       ('x_anchor', '<i4', 16),
+                       ('y_anchor', '<i4', 20),
+                       ('z_anchor', '<i4', 24),
+                       ('x_target', '<i4', 28),
+                       ('y_target', '<i4', 32),
+                       ('z_target', '<i4', 36),
+                       ('first_return', '<i2', 40),
+                       ('last_return', '<i2', 42),
+                       ('descriptor_index', 'u1', 44),
+                       ('flags', 'u1', 45),
+                       ('intensity', 'u1', 46),
+                       ('classification', 'u1', 47)]
+
+# Bytes of the fields of a pulse record, pulse_size may add padding
+PULSE_RECORD_SIZE = 48
+
+def pulse_record_dtype(pulse_size):
+    """Numpy structured dtype for one pulse record, padded to the header's pulse_size"""
+    return np.dtype({'names': [f[0] for f in PULSE_RECORD_FIELDS],
+                     'formats': [f[1] for f in PULSE_RECORD_FIELDS],
+                     'offsets': [f[2] for f in PULSE_RECORD_FIELDS],
+                     'itemsize': pulse_size})
+
+def pulse_block_from_records(header, records, pulse_numbers):
+    """Scale raw pulse records (structured array of pulse_record_dtype) the same way PulseRecord does
+       :param header: PulseWaves object supplying scales and offsets
+       :param records: structured numpy array of raw pulse records
+       :param pulse_numbers: Int array, pulse number of each record
+       :return: dict of numpy arrays
+    """
+    block = {}
+    block['gps_timestamp'] = header.t_scale * records['gps_timestamp'] + header.t_offset
+    block['offset_to_waves'] = records['offset_to_waves'].astype(np.int64)
+    for axis in ['x', 'y', 'z']:
+        scale = getattr(header, axis + '_scale')
+        offset = getattr(header, axis + '_offset')
+        block[axis + '_anchor'] = scale * records[axis + '_anchor'] + offset
+        block[axis + '_target'] = scale * records[axis + '_target'] + offset
+    block['first_return'] = records['first_return'].astype(np.int16)
+    block['last_return'] = records['last_return'].astype(np.int16)
+    block['pulse_number'] = np.asarray(pulse_numbers, dtype=np.int64)
+    block['pulse_descriptor'] = 200000 + records['descriptor_index'].astype(np.int64)
+    flags = records['flags']
+    block['edge'] = (flags >> 4) & 1
+    block['scan_direction'] = (flags >> 5) & 1
+    block['facet'] = (flags >> 6) & 3
+    block['intensity'] = records['intensity'].copy()
+    block['classification'] = records['classification'].copy()
+    #calculate direction vector
+    block['dx'] = (block['x_target'] - block['x_anchor']) / 1000
+    block['dy'] = (block['y_target'] - block['y_anchor']) / 1000
+    block['dz'] = (block['z_target'] - block['z_anchor']) / 1000
+    prof.count('pulses_decoded', records.shape[0])
+    return block
+
+def _gather_uint(buffer, positions, num_bytes):
+    """Little endian unsigned integers of num_bytes bytes starting at each of positions in a uint8 buffer"""
+    value = np.zeros(positions.shape[0], dtype=np.int64)
+    for byte in range(num_bytes):
+        value |= buffer[positions + byte].astype(np.int64) << (8 * byte)
+    return value
+
+def plan_wave_reads(starts, ends, max_gap=4096):
+    """Merge byte ranges [starts[i], ends[i]) into few reads: ranges are sorted by start and joined when they
+       overlap or are separated by at most max_gap bytes.
+       :return: (reads, read_index) - (k x 2) Int array of merged [start, end) ranges in file order, and for each
+                input range the row of reads that contains it
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if not starts.shape[0]:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    sorted_starts = starts[order]
+    reach = np.maximum.accumulate(ends[order])
+    new_read = np.concatenate(([True], sorted_starts[1:] > reach[:-1] + max_gap))
+    read_of_sorted = np.cumsum(new_read) - 1
+    first = np.flatnonzero(new_read)
+    last = np.concatenate((first[1:], [order.shape[0]])) - 1
+    reads = np.stack((sorted_starts[first], reach[last]), axis=1)
+    read_index = np.empty(starts.shape[0], dtype=np.int64)
+    read_index[order] = read_of_sorted
+    return reads, read_index
+
+@prof.timed('decode_wave_block')
+def decode_wave_block(header, pulse_block, buffer, offsets):
+    """Vectorized equivalent of Waves for many pulses at once.
+       :param header: PulseWaves object (supplies the pulse descriptors and sampling records)
+       :param pulse_block: dict of pulse arrays, must contain 'pulse_descriptor'
+       :param buffer: uint8 array (or memmap) holding the waves
+       :param offsets: Int array, position in buffer of each pulse's waves (offset_to_waves for a full-file memmap)
+       :return: WaveBlock sorted by pulse then sampling
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    descriptors = pulse_block['pulse_descriptor']
+    parts = []
+    bytes_read = 0
+    for descriptor_id in np.unique(descriptors):
+        pulse_index = np.flatnonzero(descriptors == descriptor_id)
+        sample_records = header.vlrs[int(descriptor_id)].sampling_records
+        position = offsets[pulse_index]
+        for key in sorted(sample_records.keys()):
+            sample_record = sample_records[key]
+            bytes_anchor = sample_record.bits_anchor // 8
+            bytes_count = sample_record.bits_samples // 8
+            bytes_sample = sample_record.bits_per_sample // 8
+
+            duration_anchor = _gather_uint(buffer, position, bytes_anchor)
+            position = position + bytes_anchor
+            num_samples = _gather_uint(buffer, position, bytes_count)
+            # sample counts are signed in Waves ("=h"), treat negative counts as empty segments
+            num_samples = np.where(num_samples >= 2**(8*bytes_count - 1), 0, num_samples)
+            position = position + bytes_count
+
+            starts = np.cumsum(num_samples) - num_samples
+            within = np.arange(num_samples.sum()) - np.repeat(starts, num_samples)
+            # as in Waves, each sample is the first byte of its bits_per_sample field
+            samples = buffer[np.repeat(position, num_samples) + within * bytes_sample]
+            position = position + num_samples * bytes_sample
+
+            parts.append((pulse_index, np.full(pulse_index.shape[0], key),
+                          np.full(pulse_index.shape[0], sample_record.type == 'returning'),
+                          duration_anchor, num_samples, samples))
+            bytes_read += pulse_index.shape[0] * (bytes_anchor + bytes_count) + samples.shape[0] * bytes_sample
+
+    prof.count('waves_decoded', descriptors.shape[0])
+    prof.count('wvs_bytes_read', bytes_read)
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return WaveBlock(empty, empty, np.zeros(0, dtype=bool), empty, empty, np.zeros(0, dtype=np.uint8))
+
+    wave_block = WaveBlock(*[np.concatenate(column) for column in zip(*parts)])
+    return wave_block.take(np.lexsort((wave_block.sampling, wave_block.pulse_index)))
+
+class WaveBlock(object):
+    """Ragged store of decoded wave segments for a block of pulses.
+       Row i is one sampling (segment) of pulse pulse_index[i] of the pulse block it was decoded from;
+       its samples are samples[offsets[i]:offsets[i+1]].
+    """
+
+    def __init__(self, pulse_index, sampling, returning, duration_anchor, lengths, samples):
+        self.pulse_index = np.asarray(pulse_index, dtype=np.int64)
+        self.sampling = np.asarray(sampling, dtype=np.int64)
+        self.returning = np.asarray(returning, dtype=bool)
+        self.duration_anchor = np.asarray(duration_anchor, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths))).astype(np.int64)
+        self.samples = samples
+
+    def __len__(self):
+        return self.lengths.shape[0]
+
+    def segment(self, row):
+        """Samples of one row"""
+        return self.samples[self.offsets[row]:self.offsets[row + 1]]
+
+    def take(self, rows):
+        """New WaveBlock holding the given rows (Int array or boolean mask) in the given order"""
+        rows = np.arange(len(self))[rows]
+        lengths = self.lengths[rows]
+        starts = np.cumsum(lengths) - lengths
+        within = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+        samples = self.samples[np.repeat(self.offsets[rows], lengths) + within]
+        return WaveBlock(self.pulse_index[rows], self.sampling[rows], self.returning[rows],
+                         self.duration_anchor[rows], lengths, samples)
+
+    def to_padded(self, fill=0, dtype=np.float64):
+        """Copy the rows into a (rows x longest row) array padded with fill
+           :return: (padded 2-D array, Int array of row lengths)
+        """
+        padded = np.full((len(self), self.lengths.max() if len(self) else 0), fill, dtype=dtype)
+        row = np.repeat(np.arange(len(self)), self.lengths)
+        column = np.arange(self.samples.shape[0]) - np.repeat(self.offsets[:-1], self.lengths)
+        padded[row, column] = self.samples
+        return padded, self.lengths.copy()
+
+
 class VLR(object):
     """Variable length record (VLR) object"""  
     
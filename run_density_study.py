@@ -0,0 +1,246 @@
+#!/usr/bin/python
+#run_density_study.py
+'''
+Command line pipeline for the point density / accuracy study of Sampling_and_Analysis_SunsetPark.ipynb.
+A site config (JSON, or YAML if PyYAML is installed) lists the datasets and the sample surfaces; the run goes
+through four stages, each of which skips work already on disk so an interrupted run can simply be restarted:
+
+    ingest    - points of every dataset inside each surface's rectangle -> <output_dir>/<surface>/rect_<dataset>.h5
+    index     - MultiDatasetIndex of the rectangles, center_point_sample and select_sample_squares
+                -> <surface>/index.pkl, <surface>/centers.npy
+    sample    - plane fits and SampleSquare statistics of every accepted square, checkpointed per worker
+                (checkpoint_functions) -> <surface>/checkpoint.h5
+    aggregate - squares and flights of all surfaces -> <output_dir>/squares.parquet, flights.parquet
+                (HDF tables if no parquet engine is installed) and summary.csv
+
+Example config:
+{
+    "output_dir": "runs/sunset_park",
+    "feet_from_point": 2.32,
+    "cell_size": 10,
+    "min_flights": 2,
+    "datasets": {
+        "laefer": {"file_dir": "../Data/parking_lot/", "pt_files": "../Data/parking_lot/pt_files.txt"},
+        "nyc": {"file_dir": "../Data/NYC_topo/", "pt_files": ["las_points_NYC_flightid_975172.lz"]}
+    },
+    "surfaces": [
+        {"name": "waterfront_lot", "pt1": [976534.92, 173979.05, 0], "pt2": [976863.17, 174360.18, 0],
+         "pt3": [976595.53720051, 173926.84315177, 0], "u_length": 500.7, "v_length": 80,
+         "num_points": 5000, "method": "uniform", "seed": 27}
+    ]
+}
+Dataset names must be ones SampleSquare knows (checkpoint_functions.DATASETS). pt_files is a list or a text file
+with one filename per line. Optional surface keys: rect_u_length, rect_v_length (rectangle() lengths, default
+u_length, v_length), border, min_distance. Optional top level keys: max_z_above_mean, num_replicates.
+
+Usage:
+    python run_density_study.py --config site.json --workers 8 --memory_limit_gb 16
+'''
+
+import os
+import json
+import pickle
+import logging
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+import point_density_functions as pdf
+import checkpoint_functions as cf
+
+logger = logging.getLogger(__name__)
+
+STAGES = ['ingest','index','sample','aggregate']
+
+
+def load_config(path):
+    '''Reads a JSON or (with PyYAML installed) YAML site config'''
+    with open(path) as config_file:
+        if os.path.splitext(path)[1].lower() in ('.yml','.yaml'):
+            import yaml
+            config = yaml.safe_load(config_file)
+        else:
+            config = json.load(config_file)
+    unknown = set(config['datasets']) - set(cf.DATASETS)
+    if unknown:
+        raise ValueError("datasets %s are not among %s" % (sorted(unknown),cf.DATASETS))
+    return config
+
+def set_memory_limit(memory_limit_gb):
+    '''Caps the address space of this process (Unix only), so a runaway worker fails instead of swapping'''
+    if not memory_limit_gb:
+        return
+    import resource
+    limit = int(memory_limit_gb * 1024**3)
+    _,hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS,(limit if hard == resource.RLIM_INFINITY else min(limit,hard),hard))
+
+def pt_file_list(dataset):
+    pt_files = dataset['pt_files']
+    if isinstance(pt_files,str):
+        return list(pd.read_csv(pt_files,header=None)[0])
+    return list(pt_files)
+
+def surface_dir(config,surface):
+    return os.path.join(config['output_dir'],surface['name'])
+
+def surface_corners(surface):
+    '''pt1, pt2, pt3 of center_point_sample (pt3 defaults to a point along rectangle()'s v direction from pt1)'''
+    pt1 = np.array(surface['pt1'],dtype=np.float64)
+    pt2 = np.array(surface['pt2'],dtype=np.float64)
+    if 'pt3' in surface:
+        return pt1,pt2,np.array(surface['pt3'],dtype=np.float64)
+    _,_,_,unit_v = pdf.rectangle(pt1[:2],pt2[:2],surface['u_length'],surface['v_length'])
+    # center_point_sample scales the unit pt1->pt3 direction by v_length itself
+    pt3 = np.concatenate((pt1[:2] + unit_v*abs(surface['v_length']),pt1[2:]))
+    return pt1,pt2,pt3
+
+
+def ingest(config,surface,overwrite=False):
+    '''Stage 1: rectangle points of every dataset, one HDF file per dataset'''
+    out_dir = surface_dir(config,surface)
+    os.makedirs(out_dir,exist_ok=True)
+    pt1,pt2,_ = surface_corners(surface)
+    uv_inv,w,_,_ = pdf.rectangle(pt1[:2],pt2[:2],surface.get('rect_u_length',surface['u_length']),
+                                 surface.get('rect_v_length',surface['v_length']))
+    for name,dataset in config['datasets'].items():
+        path = os.path.join(out_dir,'rect_%s.h5' % name)
+        if os.path.isfile(path) and not overwrite:
+            logger.info("ingest surface=%s dataset=%s skipped (exists)", surface['name'], name)
+            continue
+        rectangle_points = pdf.grab_points_big_rect(pt_file_list(dataset),dataset['file_dir'],uv_inv,w)
+        # Through write_flight_file so a compact table keeps its scale/offset or origin
+        pdf.write_flight_file(rectangle_points,path + '.tmp')
+        os.replace(path + '.tmp',path)
+        logger.info("ingest surface=%s dataset=%s points=%d", surface['name'], name, rectangle_points.shape[0])
+
+def build_index(config,surface,overwrite=False):
+    '''Stage 2: spatial index of the rectangles and the accepted sample square centers'''
+    out_dir = surface_dir(config,surface)
+    index_path = os.path.join(out_dir,'index.pkl')
+    centers_path = os.path.join(out_dir,'centers.npy')
+    if os.path.isfile(index_path) and os.path.isfile(centers_path) and not overwrite:
+        logger.info("index surface=%s skipped (exists)", surface['name'])
+        return
+    datasets = {name: pdf.read_flight_file(out_dir + os.sep,'rect_%s.h5' % name) for name in config['datasets']}
+    index = pdf.MultiDatasetIndex(datasets,config.get('cell_size',10.))
+
+    pt1,pt2,pt3 = surface_corners(surface)
+    center_points = pdf.center_point_sample(surface['num_points'],pt1,pt2,pt3,
+                                            u_length=surface['u_length'],v_length=surface['v_length'],
+                                            border=surface.get('border',[0.05,0.05]),
+                                            seed=surface.get('seed',27),
+                                            method=surface.get('method','uniform'),
+                                            min_distance=surface.get('min_distance'))
+    max_z = None
+    if config.get('max_z_above_mean') is not None:
+        first = next(iter(config['datasets']))
+        max_z = pdf.point_coord(datasets[first],'z').mean() + config['max_z_above_mean']
+    accepted,_,_ = pdf.select_sample_squares(index,center_points,config['feet_from_point'],
+                                             min_flights=config.get('min_flights',2),max_z=max_z)
+    with open(index_path + '.tmp','wb') as index_file:
+        pickle.dump(index,index_file,protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(index_path + '.tmp',index_path)
+    np.save(centers_path,center_points[accepted])
+    logger.info("index surface=%s centers=%d accepted=%d", surface['name'], len(center_points), accepted.sum())
+
+
+def process_square(index,feet_from_point,seed,num_replicates,center_point):
+    '''SampleSquare of one center point; the -200 subsample is seeded from the square id so reruns match'''
+    square = index.square_points(index.query_square(center_point,feet_from_point))
+    rng = np.random.default_rng([seed,cf.square_id(center_point,feet_from_point)])
+    flight_lists = {name: pdf.create_flight_list(points,rng=rng,num_replicates=num_replicates)
+                    for name,points in square.items() if points.shape[0]}
+    if not flight_lists:
+        return None
+    return pdf.SampleSquare(flight_lists.get('laefer'),flight_lists.get('nyc'),flight_lists.get('usgs'),
+                            center_point[0],center_point[1],center_point[2] if len(center_point) > 2 else None,
+                            feet_from_point)
+
+def sample_worker(out_dir,feet_from_point,seed,num_replicates,worker,num_workers,memory_limit_gb):
+    '''Pool worker of stage 3: processes every num_workers-th center into its own checkpoint shard'''
+    set_memory_limit(memory_limit_gb)
+    with open(os.path.join(out_dir,'index.pkl'),'rb') as index_file:
+        index = pickle.load(index_file)
+    center_points = np.load(os.path.join(out_dir,'centers.npy'))
+    process = functools.partial(process_square,index,feet_from_point,seed,num_replicates)
+    checkpoint = cf.run_sampling(center_points,process,os.path.join(out_dir,'checkpoint.h5'),feet_from_point,
+                                 worker=worker,num_workers=num_workers)
+    return checkpoint.path
+
+def sample(config,surface,workers=1,memory_limit_gb=None):
+    '''Stage 3: sample squares of one surface on a process pool, shards merged into <surface>/checkpoint.h5'''
+    out_dir = surface_dir(config,surface)
+    args = (out_dir,config['feet_from_point'],surface.get('seed',27),config.get('num_replicates',1))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(sample_worker,*args,worker,workers,memory_limit_gb) for worker in range(workers)]
+            shard_paths = [future.result() for future in futures]
+    else:
+        shard_paths = [sample_worker(*args,0,1,None)]
+    # Shards of an earlier run with more workers hold squares this run skipped
+    checkpoint_path = os.path.join(out_dir,'checkpoint.h5')
+    shard_paths += [path for path in cf.existing_shards(checkpoint_path) if path not in shard_paths]
+    cf.merge_checkpoints(shard_paths,checkpoint_path)
+    logger.info("sample surface=%s shards=%d", surface['name'], len(shard_paths))
+
+def write_columnar(df,path):
+    '''Parquet if an engine is installed, otherwise an HDF table with every column queryable'''
+    try:
+        df.to_parquet(path + '.parquet',index=False)
+        return path + '.parquet'
+    except ImportError:
+        df.to_hdf(path + '.h5',key='df',mode='w',format='table',data_columns=True)
+        return path + '.h5'
+
+def aggregate(config):
+    '''Stage 4: squares and flights of all surfaces in columnar files plus a summary of the square metrics'''
+    squares,flights = [],[]
+    for surface in config['surfaces']:
+        surface_squares,surface_flights = cf.SamplingCheckpoint(
+            os.path.join(surface_dir(config,surface),'checkpoint.h5')).load()
+        squares.append(surface_squares.assign(surface=surface['name']))
+        flights.append(surface_flights.assign(surface=surface['name']))
+    squares = pd.concat(squares,ignore_index=True)
+    flights = pd.concat(flights,ignore_index=True)
+    paths = [write_columnar(squares,os.path.join(config['output_dir'],'squares')),
+             write_columnar(flights,os.path.join(config['output_dir'],'flights'))]
+    accepted = squares[squares['accepted'].astype(bool)]
+    summary = accepted.groupby('surface')[cf.METRIC_COLUMNS].mean()
+    summary.loc['all'] = accepted[cf.METRIC_COLUMNS].mean()
+    summary.to_csv(os.path.join(config['output_dir'],'summary.csv'))
+    logger.info("aggregate squares=%d accepted=%d files=%s", squares.shape[0], accepted.shape[0], paths)
+    return summary
+
+
+def run(config,stages=STAGES,workers=1,memory_limit_gb=None,overwrite=False):
+    set_memory_limit(memory_limit_gb)
+    for surface in config['surfaces']:
+        if 'ingest' in stages:
+            ingest(config,surface,overwrite)
+        if 'index' in stages:
+            build_index(config,surface,overwrite)
+        if 'sample' in stages:
+            sample(config,surface,workers,memory_limit_gb)
+    if 'aggregate' in stages:
+        return aggregate(config)
+
+def main():
+    parser = argparse.ArgumentParser(description='Point density / accuracy sampling pipeline')
+    parser.add_argument('--config', required=True, help='JSON or YAML site config')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='stages to run, in order')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for the sample stage')
+    parser.add_argument('--memory_limit_gb', type=float, default=None, help='address space cap per process')
+    parser.add_argument('--overwrite', action='store_true', help='redo ingest/index outputs that already exist')
+    parser.add_argument('--log_level', default='INFO')
+    opt = parser.parse_args()
+
+    logging.basicConfig(level=opt.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    summary = run(load_config(opt.config),opt.stages,opt.workers,opt.memory_limit_gb,opt.overwrite)
+    if summary is not None:
+        print(summary.T)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Writes small synthetic PulseWaves files for the tests: one pulse descriptor with an outgoing (20 samples) and
+a returning (30-79 samples) 8-bit sampling, a known number of Gaussian echoes per returning waveform.
+'''
+
+import struct
+import numpy as np
+
+
+def _header(num_pulses,pulse_size,header_size,offset_to_pulses,times,t_scale):
+    hdr = b'PulseWavesPulse\x00' + struct.pack('=LLLHH',0,0,0,0,0) + bytes(8)
+    hdr += b'sys'.ljust(64,b'\x00') + b'sw'.ljust(64,b'\x00') + struct.pack('HHBB',1,2020,1,0)
+    hdr += struct.pack('H',header_size) + struct.pack('q',offset_to_pulses) + struct.pack('q',num_pulses)
+    hdr += struct.pack('=LLLL',0,0,pulse_size,0) + struct.pack('q',0)
+    hdr += struct.pack('I',1) + struct.pack('!l',0) + struct.pack('dd',t_scale,0.)
+    hdr += struct.pack('qq',int(times[0]/t_scale),int(times[-1]/t_scale))
+    hdr += struct.pack('6d',0.01,0.01,0.01,1000.,2000.,0.) + struct.pack('6d',0,1,0,1,0,1)
+    return hdr
+
+def _descriptor_vlr():
+    vlr = b'PulseWaves_Spec'.ljust(16,b'\x00') + struct.pack('IIq',200001,0,92 + 2*104) + b'desc'.ljust(64,b'\x00')
+    vlr += struct.pack('II',92,0) + struct.pack('=lHHfII',0,0,2,1.,0,0) + b'pd'.ljust(64,b'\x00')
+    for sampling_type in (1,2):
+        vlr += struct.pack('II',104,0) + struct.pack('BBBB',sampling_type,0,0,32) + struct.pack('ff',1.,0.)
+        vlr += struct.pack('BBHI',0,16,1,0) + struct.pack('HHfI',8,0,1.,0) + b'sr'.ljust(64,b'\x00')
+    return vlr
+
+def write_pulsewaves(path,num_pulses=200,seed=0,pulse_size=48,t0=1000.):
+    '''
+    Writes path (.pls) and its .wvs.
+    Output: list of (returning duration_anchor, echo positions in samples) per pulse
+    '''
+    rng = np.random.default_rng(seed)
+    t_scale = 1e-6
+    times = np.sort(t0 + np.cumsum(rng.uniform(1e-5,1e-4,num_pulses)))
+    header_size = 16 + 4*3 + 2*2 + 8 + 64*2 + 2*2 + 2 + 2 + 8 + 8 + 4*4 + 8 + 4 + 4 + 8*4 + 8*12
+    vlr = _descriptor_vlr()
+    offset_to_pulses = header_size + len(vlr)
+    header = _header(num_pulses,pulse_size,header_size,offset_to_pulses,times,t_scale)
+    assert len(header) == header_size
+
+    waves = bytearray(b'PulseWavesWaves\x00' + bytes(44))
+    pulses = bytearray()
+    truth = []
+    for i in range(num_pulses):
+        ax,ay,az = rng.integers(-1000,1000,3)
+        flags = (int(rng.integers(0,2)) << 5) | (int(rng.integers(0,2)) << 4)
+        pulses += struct.pack('<qqiiiiiihhBBBB',int(times[i]/t_scale),len(waves),ax,ay,az,
+                              ax + rng.integers(-500,500),ay + rng.integers(-500,500),az - 100000,
+                              5,60,1,flags,int(rng.integers(0,255)),2) + bytes(pulse_size - 48)
+        outgoing = np.clip(rng.normal(10,1,20) + 80*np.exp(-0.5*((np.arange(20) - 8)/1.5)**2),0,255)
+        waves += struct.pack('=Lh',0,20) + outgoing.astype(np.uint8).tobytes()
+        length = int(rng.integers(30,80))
+        anchor = int(rng.integers(100,200))
+        positions = sorted(rng.uniform(8,length - 8,int(rng.integers(1,3))))
+        if len(positions) == 2 and positions[1] - positions[0] < 8:
+            positions = positions[:1]
+        signal = rng.normal(10,1,length)
+        for position in positions:
+            signal += 120*np.exp(-0.5*((np.arange(length) - position)/2.)**2)
+        waves += struct.pack('=Lh',anchor,length) + np.clip(signal,0,255).astype(np.uint8).tobytes()
+        truth.append((anchor,positions))
+    with open(path,'wb') as pls:
+        pls.write(header + vlr + bytes(pulses))
+    with open(path[:-4] + '.wvs','wb') as wvs:
+        wvs.write(bytes(waves))
+    return truth
+
+def truncate_file(path,size):
+    with open(path,'r+b') as f:
+        f.truncate(size)
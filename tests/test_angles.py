@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import point_density_functions as pdf
+
+
+def straight_flight(flight_id,heading_deg,n=400,seed=0,t0=1000.):
+    # points along a straight line at 60 units/s with scan angles across track
+    rng = np.random.default_rng(seed)
+    heading = np.radians(heading_deg)
+    t = t0 + np.sort(rng.uniform(0,20,n))
+    along = 60.*(t - t0)
+    across = rng.uniform(-50,50,n)
+    x = 980000. + along*np.cos(heading) + across*np.sin(heading)
+    y = 190000. + along*np.sin(heading) - across*np.cos(heading)
+    return pd.DataFrame({'x_scaled': x,'y_scaled': y,'z_scaled': np.full(n,10.),'gps_time': t,
+                         'flight_id': flight_id,'scan_angle_rank': rng.integers(-20,21,n).astype(np.int8)})
+
+def test_flight_headings_recover_direction():
+    points = pd.concat([straight_flight('a',30.),straight_flight('b',-90.,seed=1),
+                        straight_flight('c',180.,seed=2)],ignore_index=True)
+    constant = straight_flight('d',0.,n=20,seed=3).assign(gps_time=5.)
+    headings = pdf.flight_headings(pd.concat([points,constant],ignore_index=True))
+    for flight_id,heading_deg in [('a',30.),('b',-90.),('c',180.)]:
+        expected = [np.cos(np.radians(heading_deg)),np.sin(np.radians(heading_deg))]
+        # the random across-track spread leaves a small error in the fit
+        np.testing.assert_allclose(headings.loc[flight_id],expected,atol=1e-2)
+    assert headings.loc['d'].isna().all()
+
+def test_view_vectors_point_across_track():
+    # flying east, positive scan angles look to the right (south)
+    view = pdf.view_vectors(np.array([0.,30.,-30.]),np.array([1.,0.]))
+    np.testing.assert_allclose(view,[[0,0,-1],[0,-0.5,-np.sqrt(3)/2],[0,0.5,-np.sqrt(3)/2]],atol=1e-12)
+    np.testing.assert_allclose(np.linalg.norm(view,axis=1),1.)
+
+def test_incidence_on_flat_and_tilted_planes():
+    scan_angles = np.array([0.,10.,-10.,25.])
+    view = pdf.view_vectors(scan_angles,np.array([1.,0.]))
+    np.testing.assert_allclose(pdf.incidence_angles(view,np.array([0.,0.,1.])),np.abs(scan_angles),atol=1e-9)
+    # plane tilted 10 degrees to face the right of the flight
+    tilted = np.array([0.,-np.sin(np.radians(10.)),np.cos(np.radians(10.))])
+    np.testing.assert_allclose(pdf.incidence_angles(view,tilted),[10.,20.,0.,35.],atol=1e-5)
+
+def test_add_angle_columns_on_flat_plane():
+    points = pd.concat([straight_flight('a',30.),straight_flight('b',-90.,seed=1)],ignore_index=True)
+    points = pdf.add_angle_columns(points,norm_vector=np.array([0.,0.,1.]))
+    np.testing.assert_allclose(points['scan_angle_deg'],points['scan_angle_rank'])
+    np.testing.assert_allclose(points['incidence_deg'],np.abs(points['scan_angle_rank']),atol=1e-3)
+    view = points[['view_x','view_y','view_z']].to_numpy(dtype=np.float64)
+    np.testing.assert_allclose(np.linalg.norm(view,axis=1),1.,atol=1e-6)
+    # the beam's horizontal part is perpendicular to the flight
+    heading = np.array([np.cos(np.radians(30.)),np.sin(np.radians(30.))])
+    np.testing.assert_allclose(view[points['flight_id'] == 'a',:2] @ heading,0.,atol=1e-2)
+
+def test_scan_angle_fields():
+    points = pd.DataFrame({'scan_angle': np.array([-1000,0,2500],dtype=np.int16)})
+    np.testing.assert_allclose(pdf.scan_angle_degrees(points),[-6.,0.,15.])
+    with pytest.raises(ValueError):
+        pdf.scan_angle_degrees(pd.DataFrame({'x_scaled': [1.]}))
+
+def test_angle_histograms_count_in_range_points():
+    rng = np.random.default_rng(4)
+    angles = np.r_[rng.uniform(0,90,300),0.,5.,90.,95.,-1.,np.nan]
+    points = pd.DataFrame({'flight_id': rng.choice(['a','b','c'],angles.shape[0]),'incidence_deg': angles})
+    histograms = pdf.angle_histograms(points)
+    assert list(histograms.columns) == list(pdf.ANGLE_BINS[:-1])
+    in_range = (angles >= 0) & (angles < 90)
+    for flight_id,row in histograms.iterrows():
+        flight_angles = angles[(points['flight_id'] == flight_id).values]
+        assert row.sum() == ((flight_angles >= 0) & (flight_angles < 90)).sum()
+        expected = [((flight_angles >= low) & (flight_angles < low + 5)).sum() for low in pdf.ANGLE_BINS[:-1]]
+        np.testing.assert_array_equal(row.values,expected)
+    assert histograms.values.sum() == in_range.sum()
@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import point_density_functions as pdf
+
+ORIGIN = (980000.,190000.)
+CELL_SIZE = 4.
+
+
+def surface_points(seed,n=8000,num_flights=4,shift=0.):
+    # tilted plane over 4 x 4 cells, each flight offset vertically
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0,16,n)
+    y = rng.uniform(0,16,n)
+    flight_id = rng.integers(0,num_flights,n)
+    z = 20. + 0.2*x - 0.1*y + 0.03*flight_id + rng.normal(0,0.05,n) + shift
+    return pd.DataFrame({'x_scaled': x + ORIGIN[0],'y_scaled': y + ORIGIN[1],'z_scaled': z,
+                         'flight_id': ['f%d' % f for f in flight_id]})
+
+def cell_moments(*tables):
+    moments = pdf.CellMoments(CELL_SIZE,ORIGIN)
+    for table in tables:
+        moments.add(table)
+    return moments
+
+def chunks(points,num_chunks,seed=0):
+    # uneven chunks in shuffled order
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(points.shape[0])
+    splits = np.sort(rng.choice(np.arange(1,points.shape[0]),num_chunks - 1,replace=False))
+    return [points.iloc[part] for part in np.split(order,splits)]
+
+def assert_stats_equal(a,b):
+    pd.testing.assert_frame_equal(a,b,check_exact=False,rtol=1e-7,atol=1e-9)
+
+def rows_by_flight(moments):
+    # moment rows ordered by (cell, flight id), flight codes depend on the order flights were seen
+    flight_ids = np.array(moments.flight_ids)[moments.keys & ((1 << pdf.FLIGHT_CODE_BITS) - 1)]
+    order = np.lexsort((flight_ids,moments.keys >> pdf.FLIGHT_CODE_BITS))
+    return flight_ids[order],moments.counts[order],moments.means[order],moments.scatter[order]
+
+def test_chunked_moments_match_one_shot():
+    points = surface_points(0)
+    one_shot = cell_moments(points)
+    chunked = cell_moments(*chunks(points,7))
+    flight_ids,counts,means,scatter = rows_by_flight(chunked)
+    expected = rows_by_flight(one_shot)
+    np.testing.assert_array_equal(flight_ids,expected[0])
+    np.testing.assert_array_equal(counts,expected[1])
+    np.testing.assert_allclose(means,expected[2],rtol=0,atol=1e-8)
+    np.testing.assert_allclose(scatter,expected[3],rtol=1e-8,atol=1e-8)
+    assert_stats_equal(chunked.cell_stats(),one_shot.cell_stats())
+
+def test_merge_is_associative():
+    parts = chunks(surface_points(1),3,seed=1)
+    left = cell_moments(parts[0]).merge(cell_moments(parts[1])).merge(cell_moments(parts[2]))
+    right = cell_moments(parts[0]).merge(cell_moments(parts[1]).merge(cell_moments(parts[2])))
+    # flights first seen in a different order get different codes
+    reordered = cell_moments(parts[2]).merge(cell_moments(parts[0])).merge(cell_moments(parts[1]))
+    one_shot = cell_moments(*parts).cell_stats()
+    for merged in (left,right,reordered):
+        assert_stats_equal(merged.cell_stats(),one_shot)
+    expected,actual = rows_by_flight(left),rows_by_flight(right)
+    np.testing.assert_array_equal(actual[0],expected[0])
+    for k in (1,2,3):
+        np.testing.assert_allclose(actual[k],expected[k],rtol=1e-8,atol=1e-8)
+    with pytest.raises(ValueError):
+        left.merge(pdf.CellMoments(CELL_SIZE/2,ORIGIN))
+
+def test_cell_error_decomposition_matches_sample_square():
+    points = surface_points(2)
+    stats = cell_moments(points).cell_stats().set_index(['ix','iy'])
+    for ix,iy in [(0,0),(1,2),(3,3)]:
+        x0,y0 = ORIGIN[0] + ix*CELL_SIZE,ORIGIN[1] + iy*CELL_SIZE
+        x,y = points['x_scaled'],points['y_scaled']
+        cell_points = points[(x >= x0) & (x < x0 + CELL_SIZE) & (y >= y0) & (y < y0 + CELL_SIZE)]
+        flight_list = pdf.create_flight_list(cell_points.copy(),rng=0)
+        C,W,_ = pdf.SampleSquare(flight_list).error_decomp_laefer
+        assert stats.loc[(ix,iy),'num_points'] == cell_points.shape[0]
+        assert stats.loc[(ix,iy),'num_flights'] == 4
+        assert stats.loc[(ix,iy),'C'] == pytest.approx(C,rel=1e-6)
+        assert stats.loc[(ix,iy),'W'] == pytest.approx(W,rel=1e-6)
+
+def test_surface_change_recovers_vertical_offset():
+    reference = cell_moments(surface_points(3)).cell_stats()
+    shifted = cell_moments(surface_points(4,shift=0.3)).cell_stats()
+    unchanged = cell_moments(surface_points(5)).cell_stats()
+    change = pdf.surface_change(reference,shifted)
+    assert change.shape[0] == 16
+    # a vertical shift seen along the plane normal
+    np.testing.assert_allclose(change['offset'],0.3*reference['norm_z'],atol=0.02)
+    assert (change['z_score'] > 10).all()
+    assert (change['normal_angle'] < 2).all()
+    no_change = pdf.surface_change(reference,unchanged,systematic=True)
+    assert (np.abs(no_change['offset']) < 0.03).all()
+    assert (np.abs(no_change['z_score']) < 5).all()
+    assert (no_change['sigma'] > pdf.surface_change(reference,unchanged)['sigma']).all()
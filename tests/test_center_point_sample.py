@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import point_density_functions as pdf
+
+PT1 = np.array([976534.92,173979.05,0.])
+PT2 = np.array([976863.17,174360.18,0.])
+PT3 = np.array([976595.53720051,173926.84315177,0.])
+
+
+def sample(num_points,**kwargs):
+    return pdf.center_point_sample(num_points,PT1,PT2,PT3,u_length=500.7,v_length=80,**kwargs)
+
+def test_uniform_is_seeded_without_global_state():
+    state = np.random.get_state()[1].copy()
+    np.testing.assert_array_equal(sample(50,seed=27),sample(50,seed=27))
+    assert sample(50,seed=27).shape == (50,3)
+    np.testing.assert_array_equal(np.random.get_state()[1],state)
+
+@pytest.mark.parametrize('method',['uniform','stratified','sobol','halton'])
+def test_int_rng_is_reproducible(method):
+    np.testing.assert_array_equal(sample(64,method=method,rng=5),sample(64,method=method,rng=5))
+    np.testing.assert_array_equal(sample(64,method=method,rng=5),
+                                  sample(64,method=method,rng=np.random.default_rng(5)))
+
+def test_poisson_centers_are_separated():
+    min_distance = 4.64
+    centers = sample(400,method='poisson',rng=1,min_distance=min_distance)
+    assert centers.shape == (400,3)
+    separation = np.abs(centers[:,None,:2] - centers[None,:,:2]).max(axis=2)
+    np.fill_diagonal(separation,np.inf)
+    assert separation.min() >= min_distance
+    np.testing.assert_array_equal(centers,sample(400,method='poisson',rng=1,min_distance=min_distance))
+
+def test_poisson_stops_at_max_attempts():
+    centers = sample(100000,method='poisson',rng=2,min_distance=20.,max_attempts=5000)
+    assert 0 < centers.shape[0] < 100000
+
+@pytest.mark.parametrize('method',['uniform','stratified','sobol','poisson'])
+def test_samples_stay_inside_border(method):
+    u = (PT2 - PT1)/np.linalg.norm(PT2 - PT1)*500.7
+    v = (PT3 - PT1)/np.linalg.norm(PT3 - PT1)*80
+    centers = sample(200,method=method,rng=3,min_distance=3.)
+    st = np.linalg.lstsq(np.stack([u,v],axis=1),(centers - PT1).T,rcond=None)[0]
+    assert np.all((st >= 0.05 - 1e-9) & (st <= 0.95 + 1e-9))
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import checkpoint_functions as cf
+
+
+def centers(n=12,seed=0):
+    rng = np.random.default_rng(seed)
+    return np.stack([rng.uniform(980000,980100,n),rng.uniform(190000,190100,n),rng.normal(10,1,n)],axis=1)
+
+class Recorder(object):
+    # process_square stand-in rejecting every square and recording which it was asked for
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self,center_point):
+        self.calls.append(cf.square_id(center_point,2.))
+        return None
+
+def rows(square_ids,datasets=('laefer','nyc')):
+    square_rows,flight_rows = [],[]
+    for sid in square_ids:
+        square_row = dict.fromkeys(cf.METRIC_COLUMNS,1.)
+        square_row.update({'square_id': sid,'x': 1.,'y': 2.,'z': 3.,'feet_from_point': 2.,'accepted': True})
+        square_rows.append(square_row)
+        for dataset in datasets:
+            flight_rows.append({'square_id': sid,'dataset': dataset,'flight_id': 'f%d' % (sid % 3),'num_points': 10,
+                                'h': 0.1,'sd_dist': 0.05,'square_dist': 0.2,'norm_x': 0.,'norm_y': 0.,'norm_z': 1.})
+    return square_rows,flight_rows
+
+def test_square_id_is_stable():
+    # fixed value: ids must not change between processes or releases
+    assert cf.square_id((980000.5,190000.25),2.) == 5873688456818063896
+    assert cf.square_id((980000.5,190000.25,11.),2.) == cf.square_id(np.array([980000.5,190000.25]),2.)
+    assert cf.square_id((980000.5,190000.25),2.) == cf.square_id((980000.50000001,190000.25),2.)
+    assert cf.square_id((980000.5,190000.25),2.) != cf.square_id((980000.5,190000.25),3.)
+    assert cf.square_id((980000.5,190000.25),2.) != cf.square_id((980000.5001,190000.25),2.)
+    assert 0 <= cf.square_id((1.,2.),3.) < 2**63
+
+def test_resume_skips_completed_squares(tmp_path):
+    path = str(tmp_path/'checkpoint.h5')
+    center_points = centers()
+    first = Recorder()
+    cf.run_sampling(center_points[:5],first,path,2.,flush_every=2)
+    assert len(first.calls) == 5
+    again = Recorder()
+    checkpoint = cf.run_sampling(center_points,again,path,2.,flush_every=2)
+    assert again.calls == [cf.square_id(c,2.) for c in center_points[5:]]
+    squares,_ = checkpoint.load()
+    assert sorted(squares['square_id']) == sorted(cf.square_id(c,2.) for c in center_points)
+    assert not squares['accepted'].any()
+
+def test_resume_with_different_num_workers(tmp_path):
+    path = str(tmp_path/'checkpoint.h5')
+    center_points = centers(18)
+    ids = np.array([cf.square_id(c,2.) for c in center_points])
+    # 3-worker run where worker 2 never ran
+    for worker in (0,1):
+        cf.run_sampling(center_points,Recorder(),path,2.,worker=worker,num_workers=3)
+    assert cf.existing_shards(path) == [cf.shard_path(path,0),cf.shard_path(path,1)]
+    calls = []
+    for worker in (0,1):
+        recorder = Recorder()
+        cf.run_sampling(center_points,recorder,path,2.,worker=worker,num_workers=2)
+        calls += recorder.calls
+    assert sorted(calls) == sorted(ids[2::3])
+
+def test_resume_from_merged_file(tmp_path):
+    path = str(tmp_path/'checkpoint.h5')
+    center_points = centers()
+    shard = cf.run_sampling(center_points,Recorder(),path,2.,worker=0,num_workers=1).path
+    cf.merge_checkpoints([shard],path)
+    os.remove(shard)
+    recorder = Recorder()
+    cf.run_sampling(center_points,recorder,path,2.,worker=0,num_workers=4)
+    assert recorder.calls == []
+
+def test_merge_checkpoints_drops_duplicates(tmp_path):
+    shard_paths = [str(tmp_path/'a.h5'),str(tmp_path/'b.h5')]
+    cf.SamplingCheckpoint(shard_paths[0]).append(*rows([1,2,3]))
+    cf.SamplingCheckpoint(shard_paths[1]).append(*rows([3,4]))
+    cf.SamplingCheckpoint(shard_paths[1]).append(*rows([4,5]))
+    out_path = str(tmp_path/'merged.h5')
+    cf.SamplingCheckpoint(out_path).append(*rows([5]))
+    squares,flights = cf.merge_checkpoints(shard_paths,out_path).load()
+    assert sorted(squares['square_id']) == [1,2,3,4,5]
+    assert flights.shape[0] == 2*5
+    assert not flights.duplicated(['square_id','dataset','flight_id']).any()
+    # raw tables hold each square once as well
+    with pd.HDFStore(out_path,mode='r') as store:
+        assert store.select(cf.SQUARE_KEY)['square_id'].is_unique
+
+def test_load_drops_orphan_flight_rows(tmp_path):
+    path = str(tmp_path/'checkpoint.h5')
+    checkpoint = cf.SamplingCheckpoint(path)
+    checkpoint.append(*rows([1,2]))
+    # crash between the flight append and the square append of square 3
+    _,orphans = rows([3])
+    flights = pd.DataFrame(orphans,columns=cf.FLIGHT_COLUMNS)
+    with pd.HDFStore(path,mode='a') as store:
+        store.append(cf.FLIGHT_KEY,flights,format='table',index=False,min_itemsize=cf.MIN_ITEMSIZE)
+    squares,flights = checkpoint.load()
+    assert sorted(squares['square_id']) == [1,2]
+    assert sorted(flights['square_id'].unique()) == [1,2]
+    assert checkpoint.completed_ids() == {1,2}
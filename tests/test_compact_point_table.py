@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+import point_density_functions as pdf
+
+SCALE = [0.01,0.01,0.001]
+OFFSET = [980000.,190000.,0.]
+
+
+def raw_points(n=1000,seed=0):
+    # X,Y,Z as raw_to_df returns them, no attrs
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'X': rng.integers(0,500000,n),
+                         'Y': rng.integers(0,300000,n),
+                         'Z': rng.integers(-5000,90000,n),
+                         'intensity': rng.integers(0,65535,n),
+                         'flag_byte': rng.integers(0,255,n)})
+
+def scaled(raw):
+    return raw[['X','Y','Z']].to_numpy(dtype=np.float64)*SCALE + OFFSET
+
+def test_local_mode_from_raw_xyz_matches_scaled():
+    raw = raw_points()
+    compact = pdf.compact_point_table(raw,'local',SCALE,OFFSET)
+    assert 'X' not in compact.columns
+    np.testing.assert_allclose(pdf.point_xyz(compact),scaled(raw),rtol=0,atol=1e-3)
+
+def test_grid_mode_round_trip():
+    raw = raw_points()
+    compact = pdf.compact_point_table(raw,'grid',SCALE,OFFSET)
+    assert compact['X'].dtype == np.int32 and compact['intensity'].dtype == np.uint16
+    np.testing.assert_allclose(pdf.point_xyz(compact),scaled(raw),rtol=0,atol=1e-9)
+
+def test_grid_to_local_uses_attrs():
+    raw = raw_points()
+    grid = pdf.compact_point_table(raw,'grid',SCALE,OFFSET)
+    local = pdf.compact_point_table(grid,'local')
+    np.testing.assert_allclose(pdf.point_xyz(local),scaled(raw),rtol=0,atol=1e-3)
+
+def test_local_mode_from_scaled_columns():
+    raw = raw_points()
+    xyz = scaled(raw)
+    df = raw.assign(x_scaled=xyz[:,0],y_scaled=xyz[:,1],z_scaled=xyz[:,2])
+    local = pdf.compact_point_table(df,'local')
+    np.testing.assert_allclose(pdf.point_xyz(local),xyz,rtol=0,atol=1e-3)
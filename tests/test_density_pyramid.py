@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import point_density_functions as pdf
+
+BOUNDS = (980000.,190000.,980064.,190032.)
+
+
+def points(seed,n,flight_ids,return_nums=(1,2)):
+    rng = np.random.default_rng(seed)
+    # a few points outside the bounds on every side
+    return pd.DataFrame({'x_scaled': rng.uniform(BOUNDS[0] - 4,BOUNDS[2] + 4,n),
+                         'y_scaled': rng.uniform(BOUNDS[1] - 4,BOUNDS[3] + 4,n),
+                         'z_scaled': rng.normal(10,1,n),
+                         'flight_id': rng.choice(flight_ids,n),'return_num': rng.choice(return_nums,n)})
+
+def brute_count(las_points,x_min,y_min,x_max,y_max):
+    x,y = las_points['x_scaled'],las_points['y_scaled']
+    inside = (x >= x_min) & (x < x_max) & (y >= y_min) & (y < y_max)
+    return las_points[inside].groupby(['flight_id','return_num']).size()
+
+@pytest.fixture(scope='module')
+def chunks():
+    return [points(0,5000,[10,11]),points(1,3000,[11,12]),points(2,4000,[12,13,14],(1,2,3))]
+
+@pytest.fixture(scope='module')
+def pyramid(chunks):
+    pyramid = pdf.DensityPyramid(BOUNDS,1.,num_levels=4)
+    for chunk in chunks:
+        pyramid.add(chunk)
+    return pyramid
+
+def test_aligned_counts_match_brute_force_at_every_level(pyramid,chunks):
+    las_points = pd.concat(chunks,ignore_index=True)
+    for level in range(pyramid.num_levels):
+        size = 1 << level
+        for x_min,y_min,cells in [(BOUNDS[0],BOUNDS[1],4),(BOUNDS[0] + 8,BOUNDS[1] + 16,2)]:
+            x_max,y_max = x_min + cells*size,y_min + cells*size
+            counts = pyramid.count(x_min,y_min,x_max,y_max,level).iloc[0]
+            expected = brute_count(las_points,x_min,y_min,x_max,y_max).reindex(counts.index,fill_value=0)
+            np.testing.assert_allclose(counts.values,expected.values,atol=1e-6)
+
+def test_counts_and_outside_cover_all_points(pyramid,chunks):
+    assert pyramid.counts.sum() + pyramid.num_outside == sum(chunk.shape[0] for chunk in chunks)
+    assert pyramid.counts.shape[0] == len(pyramid.categories)
+    for level in range(pyramid.num_levels):
+        np.testing.assert_array_equal(pyramid.level_counts(level).sum(axis=(1,2)),pyramid.counts.sum(axis=(1,2)))
+
+def test_unaligned_rectangle_close_to_brute_force(pyramid,chunks):
+    las_points = pd.concat(chunks,ignore_index=True)
+    counts = pyramid.count(BOUNDS[0] + 3.3,BOUNDS[1] + 2.7,BOUNDS[0] + 40.6,BOUNDS[1] + 29.2).iloc[0]
+    expected = brute_count(las_points,BOUNDS[0] + 3.3,BOUNDS[1] + 2.7,BOUNDS[0] + 40.6,BOUNDS[1] + 29.2)
+    np.testing.assert_allclose(counts.sum(),expected.sum(),rtol=0.02)
+
+def test_density_selects_flights_and_returns(pyramid,chunks):
+    las_points = pd.concat(chunks,ignore_index=True)
+    x_min,y_min,x_max,y_max = BOUNDS[0],BOUNDS[1],BOUNDS[0] + 32,BOUNDS[1] + 16
+    density = pyramid.density(x_min,y_min,x_max,y_max,flight_ids=[11,12],return_nums=[1])
+    expected = brute_count(las_points,x_min,y_min,x_max,y_max)
+    expected = expected[expected.index.isin([11,12],level=0) & expected.index.isin([1],level=1)].sum()
+    np.testing.assert_allclose(density,[expected/(32*16)])
+
+def test_save_load_round_trip(pyramid,tmp_path):
+    path = str(tmp_path/'pyramid.npz')
+    pyramid.save(path)
+    loaded = pdf.DensityPyramid.load(path)
+    assert loaded.categories == pyramid.categories
+    np.testing.assert_array_equal(loaded.counts,pyramid.counts)
+    pd.testing.assert_frame_equal(loaded.count(BOUNDS[0],BOUNDS[1],BOUNDS[2],BOUNDS[3]),
+                                  pyramid.count(BOUNDS[0],BOUNDS[1],BOUNDS[2],BOUNDS[3]))
+    # categories added after loading keep their counts apart
+    loaded.add(points(3,500,[99]))
+    assert loaded.counts.shape[0] == len(pyramid.categories) + 2
+    np.testing.assert_array_equal(loaded.counts[:len(pyramid.categories)],pyramid.counts)
+
+def test_many_categories_grow_layers_geometrically():
+    pyramid = pdf.DensityPyramid(BOUNDS,2.,num_levels=2)
+    total = 0
+    capacities = set()
+    for flight_id in range(40):
+        chunk = points(flight_id,200,[flight_id],(1,))
+        pyramid.add(chunk)
+        total += chunk.shape[0]
+        capacities.add(pyramid._layers.shape[0])
+    assert len(pyramid.categories) == 40
+    assert pyramid._layers.shape[0] < 80
+    assert len(capacities) <= 7
+    assert pyramid.counts.sum() + pyramid.num_outside == total
+    counts = pyramid.count(*BOUNDS).iloc[0]
+    assert (counts.values > 0).all()
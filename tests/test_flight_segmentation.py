@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import flight_segmentation as fs
+
+CHUNK_SIZE = 250
+
+
+def flight_points(seed):
+    '''Points of four flights in time order; the second gap falls exactly on a chunk boundary'''
+    rng = np.random.default_rng(seed)
+    sizes = [300,200,330,170]
+    starts = [1000.,1000. + 2*fs.GAP_SECONDS,1000. + 5*fs.GAP_SECONDS,1000. + 9*fs.GAP_SECONDS]
+    times = np.concatenate([start + np.sort(rng.uniform(0,fs.GAP_SECONDS/2,size)) for start,size in zip(starts,sizes)])
+    assert times[CHUNK_SIZE*2] - times[CHUNK_SIZE*2 - 1] > fs.GAP_SECONDS
+    flight = np.repeat(np.arange(4),sizes)
+    points = pd.DataFrame({'gps_time': times,'x_scaled': rng.uniform(0,100,times.shape[0]),
+                           'z_scaled': rng.normal(10,1,times.shape[0]),'true_flight': flight})
+    return points,sizes
+
+@pytest.mark.parametrize('fmt',['table','fixed'])
+@pytest.mark.parametrize('shuffle',[False,True])
+def test_segment_flights_sorts_and_splits_at_gaps(tmp_path,fmt,shuffle):
+    points,sizes = flight_points(0)
+    if shuffle:
+        points = points.sample(frac=1,random_state=1).reset_index(drop=True)
+    in_path = str(tmp_path/'points.lz')
+    out_path = str(tmp_path/'points_flight_id.lz')
+    run_dir = str(tmp_path/'runs')
+    points.to_hdf(in_path,key='df',format=fmt)
+    flights = fs.segment_flights(in_path,out_path,run_dir,chunk_size=CHUNK_SIZE,merge_rows=90)
+    out = pd.read_hdf(out_path,'df')
+
+    assert out.shape[0] == points.shape[0]
+    assert (np.diff(out['gps_time'].values) >= 0).all()
+    np.testing.assert_array_equal(np.sort(out['gps_time'].values),np.sort(points['gps_time'].values))
+    # flight ids change at every gap and only there
+    gaps = np.diff(out['gps_time'].values) > fs.GAP_SECONDS
+    np.testing.assert_array_equal(np.diff(out['flight_id'].values) != 0,gaps)
+    np.testing.assert_array_equal(out['flight_id'].values,out['true_flight'].values)
+    np.testing.assert_array_equal(flights['flight_id'],np.arange(4))
+    np.testing.assert_array_equal(flights['num_points'],sizes)
+    assert not os.path.exists(run_dir) or not os.listdir(run_dir)
+
+def test_keep_runs_leaves_sorted_runs(tmp_path):
+    points,_ = flight_points(2)
+    points = points.sample(frac=1,random_state=3).reset_index(drop=True)
+    in_path = str(tmp_path/'points.lz')
+    run_dir = str(tmp_path/'runs')
+    points.to_hdf(in_path,key='df',format='table')
+    fs.segment_flights(in_path,str(tmp_path/'out.lz'),run_dir,chunk_size=CHUNK_SIZE,keep_runs=True)
+    runs = sorted(os.listdir(run_dir))
+    assert len(runs) == -(-points.shape[0] // CHUNK_SIZE)
+    for run in runs:
+        records = np.load(os.path.join(run_dir,run))
+        assert (np.diff(records['gps_time']) >= 0).all()
+
+def test_segmenter_continues_flights_across_blocks():
+    segmenter = fs.FlightSegmenter(gap_seconds=1.)
+    ids = np.concatenate([segmenter.assign(np.array([0.,0.5,0.9])),segmenter.assign(np.array([1.5,5.,5.2])),
+                          segmenter.assign(np.zeros(0)),segmenter.assign(np.array([6.5]))])
+    np.testing.assert_array_equal(ids,[0,0,0,0,1,1,2])
+    summary = segmenter.summary()
+    np.testing.assert_array_equal(summary['num_points'],[4,2,1])
+    np.testing.assert_array_equal(summary['end_time'],[1.5,5.2,6.5])
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import pypwaves_updated as pw
+import waveform_functions as wf
+from synthetic_pulsewaves import write_pulsewaves
+
+NUM_PULSES = 300
+
+
+@pytest.fixture(scope='module')
+def pulsewave(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('pulsewaves')/'synthetic.pls')
+    write_pulsewaves(path,NUM_PULSES,seed=5)
+    return pw.PulseWaves(path)
+
+def pulse_times(pulsewave):
+    records = pulsewave.pulse_memmap()
+    return pulsewave.t_scale*records['gps_timestamp'].astype(np.float64) + pulsewave.t_offset
+
+def brute_join(point_times,times,tolerance):
+    dt = np.abs(point_times[:,None] - times[None,:])
+    nearest = dt.argmin(axis=1)
+    return np.where(dt[np.arange(point_times.shape[0]),nearest] <= tolerance,nearest,-1)
+
+def test_join_matches_brute_force(pulsewave):
+    rng = np.random.default_rng(0)
+    times = pulse_times(pulsewave)
+    pulses = rng.integers(0,NUM_PULSES,500)
+    # matched points jitter around their pulse time, the rest fall between pulses or off the ends
+    point_times = np.r_[times[pulses] + rng.uniform(-5e-7,5e-7,500),
+                        (times[:-1] + times[1:])[:50]/2,times[0] - 1.,times[-1] + 1.]
+    order = rng.permutation(point_times.shape[0])
+    point_times = point_times[order]
+    pulse_index = wf.join_points_to_pulses(point_times,pulsewave)
+    np.testing.assert_array_equal(pulse_index,brute_join(point_times,times,1e-6))
+    assert (pulse_index[order < 500] >= 0).all()
+    assert (pulse_index[order >= 500] == -1).all()
+
+def test_join_applies_time_offset(pulsewave):
+    times = pulse_times(pulsewave)
+    pulse_index = wf.join_points_to_pulses(times[::7] - 1e9,pulsewave,time_offset=1e9)
+    np.testing.assert_array_equal(pulse_index,np.arange(NUM_PULSES)[::7])
+    assert (wf.join_points_to_pulses(times[::7] - 1e9,pulsewave) == -1).all()
+
+def test_join_empty_points(pulsewave):
+    assert wf.join_points_to_pulses(np.zeros(0),pulsewave).shape == (0,)
+
+def test_add_pulse_index_column(pulsewave):
+    times = pulse_times(pulsewave)
+    las_points = pd.DataFrame({'gps_time': np.r_[times[[3,1,250]],times[0] - 1.],'z_scaled': np.arange(4.)})
+    las_points = wf.add_pulse_index(las_points,pulsewave,column='pulse')
+    np.testing.assert_array_equal(las_points['pulse'],[3,1,250,-1])
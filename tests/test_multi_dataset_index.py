@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+import point_density_functions as pdf
+
+
+def dataset(seed,n,num_flights,x0=980000.,y0=190000.):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'x_scaled': rng.uniform(x0,x0 + 100,n),'y_scaled': rng.uniform(y0,y0 + 60,n),
+                         'z_scaled': rng.normal(10,1,n),'flight_id': rng.integers(0,num_flights,n)})
+
+def make_index(cell_size=5.):
+    datasets = {'laefer': dataset(0,20000,4),'nyc': dataset(1,8000,2)}
+    return pdf.MultiDatasetIndex(datasets,cell_size),datasets
+
+def centers(n=300,seed=2):
+    rng = np.random.default_rng(seed)
+    # some centers off the data to get empty squares
+    return np.stack([rng.uniform(979990,980110,n),rng.uniform(189990,190070,n)],axis=1)
+
+def test_membership_matches_query_square():
+    index,_ = make_index()
+    center_points = centers()
+    square_index,counts = index.membership(center_points,2.,batch_size=64)
+    for i,center_point in enumerate(center_points):
+        expected = index.query_square(center_point,2.)
+        np.testing.assert_array_equal(square_index[i],expected)
+        np.testing.assert_array_equal(counts[i],np.bincount(index.group[expected],minlength=index.groups.shape[0]))
+
+def test_query_square_matches_brute_force():
+    index,datasets = make_index()
+    for center_point in centers(20,3):
+        square = index.square_points(index.query_square(center_point,3.))
+        for name,points in datasets.items():
+            x,y = points['x_scaled'],points['y_scaled']
+            inside = (x < center_point[0] + 3) & (x > center_point[0] - 3) & (y < center_point[1] + 3) & (y > center_point[1] - 3)
+            assert square[name].shape[0] == inside.sum()
+
+def test_select_sample_squares_with_empty_squares_and_max_z():
+    index,_ = make_index()
+    center_points = np.vstack([centers(50),[[970000.,180000.]]])
+    accepted,square_index,flight_counts = pdf.select_sample_squares(index,center_points,2.,min_flights=0,max_z=13.)
+    assert square_index[-1].size == 0 and accepted[-1]
+    z = pdf.point_coord(index.points,'z')
+    for i in np.flatnonzero(~accepted):
+        assert z[square_index[i]].max() >= 13.
+
+def test_min_flights_per_dataset():
+    index,_ = make_index()
+    center_points = centers(100)
+    accepted,_,flight_counts = pdf.select_sample_squares(index,center_points,2.,min_flights={'laefer': 4,'nyc': 2})
+    np.testing.assert_array_equal(accepted,(flight_counts['laefer'] >= 4).to_numpy() & (flight_counts['nyc'] >= 2).to_numpy())
+
+def test_compact_datasets_on_different_grids():
+    plain = {'laefer': dataset(0,5000,3),'nyc': dataset(1,3000,2)}
+    compact = {'laefer': pdf.compact_point_table(plain['laefer'],'grid',[.001]*3,[979000.,189000.,0.]),
+               'nyc': pdf.compact_point_table(plain['nyc'],'local')}
+    center_points = centers(50)
+    _,plain_counts = pdf.MultiDatasetIndex(plain,5.).membership(center_points,2.)
+    _,compact_counts = pdf.MultiDatasetIndex(compact,5.).membership(center_points,2.)
+    # grid quantization may move a point across a square edge
+    assert np.abs(plain_counts - compact_counts).sum() <= 5
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import point_density_functions as pdf
+
+
+def square_points(seed=0,n=3000,num_flights=4):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-2,2,n) + 980000.
+    y = rng.uniform(-2,2,n) + 190000.
+    flight_id = rng.integers(0,num_flights,n)
+    z = 0.2*(x - 980000.) - 0.1*(y - 190000.) + 0.03*flight_id + rng.normal(0,0.05,n) + 20.
+    return pd.DataFrame({'x_scaled': x,'y_scaled': y,'z_scaled': z,'flight_id': flight_id})
+
+def test_flight_list_matches_point_fits():
+    points = square_points()
+    flight_list = pdf.create_flight_list(points,rng=1)
+    norm_vector_full,_,_,_ = pdf.plane_fit(points.copy())
+    shift = pdf.point_xyz(points).mean(axis=0)
+    assert abs(flight_list[0].norm_vector @ norm_vector_full) == pytest.approx(1.)
+    for flight in flight_list[2:]:
+        flight_points = points[points['flight_id'] == flight.flight_id].copy()
+        _,_,fitted,_ = pdf.plane_fit(flight_points,flight_list[0].norm_vector,shift)
+        expected = pdf.FlightPath(flight.flight_id,None,fitted)
+        assert flight.num_points == expected.num_points
+        assert flight.h == pytest.approx(expected.h,abs=1e-8)
+        assert flight.sd_dist == pytest.approx(expected.sd_dist,rel=1e-6)
+        assert flight.square_dist == pytest.approx(expected.square_dist,rel=1e-6)
+
+def test_group_moments_merge_matches_all_points():
+    points = square_points(1)
+    xyz = pdf.point_xyz(points)
+    codes,_ = pd.factorize(points['flight_id'])
+    combined = pdf.PlaneMoments.combine(pdf.PlaneMoments.from_groups(xyz,codes,codes.max() + 1))
+    direct = pdf.PlaneMoments.from_points(xyz)
+    assert combined.count == direct.count
+    np.testing.assert_allclose(combined.mean,direct.mean,rtol=0,atol=1e-8)
+    np.testing.assert_allclose(combined.scatter,direct.scatter,rtol=1e-8,atol=1e-8)
+
+def test_replicates_are_reproducible_and_match_plane_fit():
+    points = square_points(2)
+    xyz = pdf.point_xyz(points)
+    idx = pdf.subsample_replicates(xyz.shape[0],500,8,rng=5)
+    np.testing.assert_array_equal(idx,pdf.subsample_replicates(xyz.shape[0],500,8,rng=5))
+    assert all(np.unique(row).shape[0] == 500 for row in idx)
+    norm_vectors,sd_dist,_ = pdf.replicate_plane_fits(xyz,idx)
+    for r in (0,7):
+        subsample = points.iloc[idx[r]].copy()
+        norm_vector,_,fitted,_ = pdf.plane_fit(subsample)
+        assert abs(norm_vectors[r] @ norm_vector) == pytest.approx(1.)
+        assert sd_dist[r] == pytest.approx(np.std(fitted['dist_from_plane']),rel=1e-6)
+
+def test_sampled_flight_carries_replicates():
+    flight_list = pdf.create_flight_list(square_points(3),rng=4,num_replicates=10)
+    assert flight_list[1].sd_dist_replicates.shape == (10,)
+    assert flight_list[1].sd_dist == pytest.approx(flight_list[1].sd_dist_replicates[0])
+    assert flight_list[0].sd_dist_replicates is None
+
+def test_cached_sample_respects_sampling_parameters():
+    points = square_points(4)
+    cache = pdf.PlaneFitCache()
+    key = cache.square_key('laefer',(0.,0.),2.)
+    first = pdf.create_flight_list(points,cache,key,rng=1)
+    again = pdf.create_flight_list(points,cache,key,rng=1)
+    assert again[1].sd_dist == first[1].sd_dist
+    replicated = pdf.create_flight_list(points,cache,key,rng=2,num_replicates=10)
+    assert replicated[1].sd_dist_replicates.shape == (10,)
+    uncached = pdf.create_flight_list(points,rng=2,num_replicates=10)
+    np.testing.assert_allclose(replicated[1].sd_dist_replicates,uncached[1].sd_dist_replicates)
+
+def test_cache_needs_square_key():
+    with pytest.raises(ValueError,match='square_key'):
+        pdf.create_flight_list(square_points(5),cache=pdf.PlaneFitCache())
+
+def test_cache_reuses_flight_fits(tmp_path):
+    points = square_points(6)
+    path = str(tmp_path/'fits.pkl')
+    cache = pdf.PlaneFitCache(path=path)
+    key = cache.square_key('nyc',(1.,2.),2.32,data_version='v1')
+    first = pdf.create_flight_list(points,cache,key,rng=3)
+    cache.save()
+    reloaded = pdf.PlaneFitCache(path=path)
+    second = pdf.create_flight_list(points,reloaded,key,rng=3)
+    assert reloaded.misses == 0 and reloaded.hits == len(first) - 1
+    for a,b in zip(first,second):
+        assert (a.flight_id,a.num_points) == (b.flight_id,b.num_points)
+        assert a.sd_dist == pytest.approx(b.sd_dist) and a.h == pytest.approx(b.h)
+
+def test_cache_is_bounded():
+    cache = pdf.PlaneFitCache(maxsize=3)
+    for i in range(5):
+        cache.put(('laefer',i),pdf.PlaneMoments(1,np.zeros(3),np.zeros((3,3))))
+    assert len(cache) == 3 and cache.get(('laefer',0)) is None and cache.get(('laefer',4)) is not None
+
+def test_unseeded_sample_is_not_cached():
+    points = square_points(7)
+    cache = pdf.PlaneFitCache()
+    key = cache.square_key('laefer',(0.,0.),2.)
+    draws = {pdf.create_flight_list(points,cache,key)[1].sd_dist for _ in range(4)}
+    assert len(draws) > 1
+    assert not any(-200 in cached_key for cached_key in cache._fits)
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+
+import pypwaves_updated as pw
+import waveform_functions as wf
+from synthetic_pulsewaves import write_pulsewaves,truncate_file
+
+NUM_PULSES = 2000
+
+
+@pytest.fixture
+def pls_file(tmp_path):
+    path = str(tmp_path/'synthetic.pls')
+    write_pulsewaves(path,NUM_PULSES,seed=7)
+    return path
+
+def wave_offsets(pls_file):
+    return np.array(pw.PulseWaves(pls_file,validate=False).pulse_memmap()['offset_to_waves'])
+
+def wvs(pls_file):
+    return os.path.splitext(pls_file)[0] + '.wvs'
+
+def test_complete_file(pls_file):
+    pulsewave = pw.PulseWaves(pls_file)
+    assert pulsewave.num_pulses == NUM_PULSES and not pulsewave.truncated
+
+def test_truncated_wvs_raises_without_allow_truncated(pls_file):
+    truncate_file(wvs(pls_file),wave_offsets(pls_file)[1500])
+    with pytest.raises(ValueError):
+        pw.PulseWaves(pls_file)
+
+def test_wvs_ending_on_record_boundary(pls_file):
+    truncate_file(wvs(pls_file),wave_offsets(pls_file)[1500])
+    pulsewave = pw.PulseWaves(pls_file,allow_truncated=True)
+    assert pulsewave.num_pulses == 1500 and pulsewave.truncated
+
+def test_wvs_ending_inside_a_record(pls_file):
+    truncate_file(wvs(pls_file),wave_offsets(pls_file)[1500] + 5)
+    assert pw.PulseWaves(pls_file,allow_truncated=True).num_pulses == 1500
+
+def test_wvs_ending_inside_the_last_record(pls_file):
+    truncate_file(wvs(pls_file),os.path.getsize(wvs(pls_file)) - 3)
+    assert pw.PulseWaves(pls_file,allow_truncated=True).num_pulses == NUM_PULSES - 1
+
+def test_truncated_pls(pls_file):
+    truncate_file(pls_file,os.path.getsize(pls_file) - 100)
+    pulsewave = pw.PulseWaves(pls_file,allow_truncated=True)
+    assert pulsewave.num_pulses == NUM_PULSES - 3 and pulsewave.num_pulses_header == NUM_PULSES
+
+def test_truncated_file_decodes_with_workers(pls_file):
+    truncate_file(wvs(pls_file),wave_offsets(pls_file)[1500] + 5)
+    pulsewave = pw.PulseWaves(pls_file,allow_truncated=True)
+    serial = wf.extract_pulse_features(pulsewave,chunk_size=400)
+    parallel = wf.extract_pulse_features(pulsewave,chunk_size=400,workers=2)
+    assert serial['pulse_number'].shape[0] == 1500
+    for name in wf.PULSE_FEATURE_COLUMNS:
+        np.testing.assert_array_equal(serial[name],parallel[name])
+    echoes = wf.extract_echoes(pulsewave,chunk_size=400,workers=2)
+    assert echoes['pulse_number'].max() < 1500
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+import pypwaves_updated as pw
+from synthetic_pulsewaves import write_pulsewaves
+
+NUM_PULSES = 250
+
+
+@pytest.fixture(scope='module')
+def pulsewave(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('pulsewaves')/'synthetic.pls')
+    write_pulsewaves(path,NUM_PULSES,seed=7)
+    pulsewave = pw.PulseWaves(path)
+    # a small index step so queries cross index entries
+    pulsewave.build_time_index(step=16)
+    return pulsewave
+
+def pulse_times(pulsewave):
+    return pulsewave.t_scale*pulsewave.pulse_memmap()['gps_timestamp'].astype(np.float64) + pulsewave.t_offset
+
+def brute_scan_line(pulsewave,pulse_number):
+    flags = np.array(pulsewave.pulse_memmap()['flags']).astype(np.int64)
+    edge = (flags >> 4) & 1
+    direction = (flags >> 5) & 1
+    # the scan line ends after pulse p
+    ends = np.flatnonzero((edge[:-1] == 1) | (direction[1:] != direction[:-1]))
+    before = ends[ends < pulse_number]
+    after = ends[ends >= pulse_number]
+    return (int(before[-1]) + 1 if before.shape[0] else 0,int(after[0]) + 1 if after.shape[0] else NUM_PULSES)
+
+def test_time_range_matches_brute_force(pulsewave):
+    times = pulse_times(pulsewave)
+    queries = [(times[10],times[40]),                              # exact pulse times
+               ((times[10] + times[11])/2,(times[99] + times[100])/2),
+               ((times[20] + times[21])/2,(times[20] + times[21])/2),  # empty, between two pulses
+               (times[50],times[30]),                              # empty, reversed
+               (times[0] - 1.,times[0] - 0.5),                     # before the first pulse
+               (times[0] - 1.,times[5]),
+               (times[-1] + 0.5,times[-1] + 1.),                   # after the last pulse
+               (times[-3],times[-1] + 1.),
+               (times[0] - 1.,times[-1] + 1.)]
+    for t_start,t_end in queries:
+        start = int(np.searchsorted(times,t_start,side='left'))
+        end = max(start,int(np.searchsorted(times,t_end,side='right')))
+        assert pulsewave.time_range(t_start,t_end) == (start,end)
+        pulse_block = pulsewave.read_time_range(t_start,t_end)
+        np.testing.assert_array_equal(pulse_block['pulse_number'],np.arange(start,end))
+
+def test_time_range_empty_block(pulsewave):
+    times = pulse_times(pulsewave)
+    pulse_block = pulsewave.read_time_range(times[-1] + 0.5,times[-1] + 1.)
+    assert pulse_block['pulse_number'].shape[0] == 0 and pulse_block['gps_timestamp'].shape[0] == 0
+
+@pytest.mark.parametrize('search_step',[3,4096])
+def test_scan_line_matches_brute_force(pulsewave,search_step):
+    for pulse_number in [0,1,57,123,NUM_PULSES - 2,NUM_PULSES - 1]:
+        start,end = pulsewave.scan_line(pulse_number,search_step)
+        assert (start,end) == brute_scan_line(pulsewave,pulse_number)
+        assert start <= pulse_number < end
+
+def test_scan_lines_partition_pulses(pulsewave):
+    pulse_number,lines = 0,[]
+    while pulse_number < NUM_PULSES:
+        start,end = pulsewave.scan_line(pulse_number,search_step=5)
+        assert start == pulse_number
+        lines.append((start,end))
+        pulse_number = end
+    assert lines[-1][1] == NUM_PULSES
+
+@pytest.mark.parametrize('step',[1,7,NUM_PULSES + 1])
+def test_trajectory_matches_pulse_records(pulsewave,step):
+    trajectory = pulsewave.trajectory(step)
+    np.testing.assert_array_equal(trajectory['pulse_number'],np.arange(0,NUM_PULSES,step))
+    for i,pulse_number in enumerate(trajectory['pulse_number'][:20]):
+        record = pulsewave.get_pulse(int(pulse_number))
+        assert trajectory['gps_timestamp'][i] == pytest.approx(record.gps_timestamp)
+        assert trajectory['x_anchor'][i] == pytest.approx(record.x_anchor)
+        assert trajectory['y_anchor'][i] == pytest.approx(record.y_anchor)
+        assert trajectory['z_anchor'][i] == pytest.approx(record.z_anchor)
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import point_density_functions as pdf
+import checkpoint_functions as cf
+import run_density_study as rds
+
+
+def write_flights(file_dir,dataset,num_flights,compact,seed):
+    # Synthetic flight files of a gently sloped plane, compact ones each on their own grid offset
+    rng = np.random.default_rng(seed)
+    pt_files = []
+    for f in range(num_flights):
+        n = 20000
+        x = rng.uniform(0,120,n)
+        y = rng.uniform(0,60,n)
+        z = 0.01*x + rng.normal(0,.05,n) + 0.02*f
+        df = pd.DataFrame({'x_scaled': x,'y_scaled': y,'z_scaled': z,'flight_id': f,
+                           'gps_time': np.sort(rng.uniform(0,10,n))})
+        if compact:
+            df = pdf.compact_point_table(df,'grid',[0.001,0.001,0.001],[-10.*f,-5.,-1.])
+        pick = 'las_points_%s_%d.lz' % (dataset,f)
+        pdf.write_flight_file(df,os.path.join(file_dir,pick),complib='zlib')
+        pt_files.append(pick)
+    return pt_files
+
+def site_config(tmp_path,compact):
+    os.makedirs(str(tmp_path),exist_ok=True)
+    file_dir = str(tmp_path) + os.sep
+    datasets = {name: {'file_dir': file_dir,'pt_files': write_flights(file_dir,name,num_flights,compact,seed)}
+                for seed,(name,num_flights) in enumerate([('laefer',3),('nyc',2)])}
+    return {'output_dir': str(tmp_path/'run'),'feet_from_point': 2.,'cell_size': 5,'min_flights': 2,
+            'datasets': datasets,
+            'surfaces': [{'name': 'lot','pt1': [10,10,0],'pt2': [10,50,0],'u_length': 40,'v_length': -60,
+                          'num_points': 30,'seed': 3}]}
+
+@pytest.mark.parametrize('compact',[False,True])
+def test_pipeline_runs_and_resumes(tmp_path,compact):
+    config = site_config(tmp_path,compact)
+    summary = rds.run(config)
+    assert np.isfinite(summary.loc['all','laefer_W'])
+    checkpoint = cf.SamplingCheckpoint(os.path.join(config['output_dir'],'lot','checkpoint.h5'))
+    squares,flights = checkpoint.load()
+    assert squares['accepted'].any()
+    # Rectangle files keep the compact representation
+    rect = pdf.read_flight_file(os.path.join(config['output_dir'],'lot') + os.sep,'rect_laefer.h5')
+    assert ('x_scaled' in rect.columns) != compact
+
+    # A rerun finds every square done and leaves the results unchanged
+    rds.run(config)
+    squares_again,_ = checkpoint.load()
+    assert len(squares_again) == len(squares)
+
+def test_compact_and_plain_inputs_agree(tmp_path):
+    plain = rds.run(site_config(tmp_path/'plain',False))
+    compact = rds.run(site_config(tmp_path/'compact',True))
+    # phi_sample comes from a random subsample, which grid quantization of the points can change
+    columns = [column for column in plain.columns if not column.endswith('phi_sample')]
+    np.testing.assert_allclose(compact[columns].values.astype(float),plain[columns].values.astype(float),
+                               rtol=0.02,atol=1e-4)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scipy.signal import savgol_filter
+
+import waveform_functions as wf
+
+
+def ragged_block(seed=0,num_rows=40,max_length=60):
+    # rows of every length from 1 to 15 (around the window sizes used below) and random longer ones
+    rng = np.random.default_rng(seed)
+    lengths = np.r_[np.arange(1,16),rng.integers(16,max_length + 1,num_rows - 15)]
+    padded = np.full((num_rows,max_length),7.)
+    for i,length in enumerate(lengths):
+        padded[i,:length] = 50*np.exp(-0.5*((np.arange(length) - length/2)/3.)**2) + rng.normal(0,2,length)
+    return padded,lengths
+
+@pytest.mark.parametrize('window,polyorder,deriv',[(5,2,0),(7,3,0),(11,2,0),(15,3,0),(3,1,1),(5,2,1),(9,4,2)])
+def test_savgol_block_matches_savgol_filter(window,polyorder,deriv):
+    padded,lengths = ragged_block()
+    smoothed = wf.savgol_block(padded,lengths,window,polyorder,deriv,delta=0.5,chunk_rows=7,fill=-1.)
+    assert smoothed.shape == padded.shape
+    for i,length in enumerate(lengths):
+        if length >= window:
+            expected = savgol_filter(padded[i,:length],window,polyorder,deriv=deriv,delta=0.5)
+            np.testing.assert_allclose(smoothed[i,:length],expected,rtol=1e-9,atol=1e-9)
+        elif deriv == 0:
+            np.testing.assert_array_equal(smoothed[i,:length],padded[i,:length])
+        else:
+            assert np.isnan(smoothed[i,:length]).all()
+        assert (smoothed[i,length:] == -1.).all()
+
+def test_savgol_block_window_wider_than_block():
+    padded,lengths = ragged_block(1)
+    padded,lengths = padded[:10,:10],lengths[:10]
+    smoothed = wf.savgol_block(padded,lengths,11,2)
+    for i,length in enumerate(lengths):
+        np.testing.assert_array_equal(smoothed[i,:length],padded[i,:length])
+        assert (smoothed[i,length:] == 0.).all()
+
+def test_savgol_block_integer_samples():
+    padded,lengths = ragged_block(2)
+    samples = np.clip(padded,0,255).astype(np.uint8)
+    smoothed = wf.savgol_block(samples,lengths,7,2)
+    for i in np.flatnonzero(lengths >= 7):
+        np.testing.assert_allclose(smoothed[i,:lengths[i]],savgol_filter(samples[i,:lengths[i]].astype(np.float64),7,2),
+                                   rtol=1e-9,atol=1e-9)
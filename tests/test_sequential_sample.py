@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from scipy import stats
+
+import point_density_functions as pdf
+
+
+@pytest.fixture
+def metric_squares(monkeypatch):
+    # process_square returns the metrics dict itself
+    monkeypatch.setattr(pdf,'square_metrics',dict)
+
+class Squares(object):
+    # every third center is rejected, accepted squares get a normal 'a' and an always-nan 'phi_sample'
+    def __init__(self,seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.calls = 0
+
+    def __call__(self,center_point):
+        self.calls += 1
+        if self.calls % 3 == 0:
+            return None
+        return {'a': self.rng.normal(10,1),'phi_sample': np.nan}
+
+def test_running_stats_match_numpy():
+    rng = np.random.default_rng(0)
+    values = rng.normal(5,2,200)
+    values[::17] = np.nan
+    running_stats = pdf.RunningStats()
+    for value in values:
+        running_stats.update({'a': value,'b': 2*value})
+    finite = values[np.isfinite(values)]
+    assert running_stats.n['a'] == finite.shape[0]
+    assert running_stats.mean['a'] == pytest.approx(np.mean(finite))
+    assert running_stats.sd('a') == pytest.approx(np.std(finite,ddof=1))
+    assert running_stats.sd('b') == pytest.approx(np.std(2*finite,ddof=1))
+    n = finite.shape[0]
+    assert running_stats.half_width('a',0.9) == pytest.approx(stats.t.ppf(0.95,n-1)*np.std(finite,ddof=1)/np.sqrt(n))
+    summary = running_stats.summary().set_index('metric')
+    assert summary.loc['a','ci_low'] < np.mean(finite) < summary.loc['a','ci_high']
+
+def test_single_value_has_infinite_interval():
+    running_stats = pdf.RunningStats()
+    running_stats.update({'a': 1.})
+    assert running_stats.sd('a') == np.inf and running_stats.half_width('a') == np.inf
+
+def test_stops_at_first_batch_boundary_after_min_squares(metric_squares):
+    squares = Squares()
+    sample_squares,summary,converged = pdf.sequential_sample(np.zeros((1000,2)),squares,metrics=['a'],
+                                                             relative_precision=10.,batch_size=25,min_squares=30)
+    # 30 accepted squares take 45 centers, the next check is after 50
+    assert converged and squares.calls == 50 and len(sample_squares) == 34
+    assert list(summary['metric']) == ['a']
+
+@pytest.mark.parametrize('batch_size',[7,40])
+def test_stops_only_at_batch_boundaries(metric_squares,batch_size):
+    squares = Squares(1)
+    sample_squares,summary,converged = pdf.sequential_sample(np.zeros((5000,2)),squares,metrics=['a'],
+                                                             relative_precision=0.01,batch_size=batch_size,
+                                                             min_squares=30)
+    assert converged and squares.calls % batch_size == 0 and len(sample_squares) >= 30
+    assert summary['half_width'][0] <= 0.01*summary['mean'][0]
+
+def test_not_converged_when_centers_run_out(metric_squares):
+    squares = Squares(2)
+    sample_squares,summary,converged = pdf.sequential_sample(np.zeros((100,2)),squares,metrics=['a'],
+                                                             target_half_width=1e-6,batch_size=10,min_squares=5)
+    assert not converged and squares.calls == 100 and len(sample_squares) == 67
+    assert summary['n'][0] == 67
+
+def test_default_metrics_skip_always_nan_metrics(metric_squares):
+    squares = Squares(3)
+    sample_squares,summary,converged = pdf.sequential_sample(np.zeros((5000,2)),squares,relative_precision=0.02,
+                                                             batch_size=20,min_squares=30)
+    assert converged and squares.calls < 5000
+    assert list(summary['metric']) == ['a']
+    # listed explicitly, a metric that is never finite blocks convergence
+    squares = Squares(3)
+    _,_,converged = pdf.sequential_sample(np.zeros((500,2)),squares,metrics=['a','phi_sample'],
+                                          relative_precision=0.02,batch_size=20,min_squares=30)
+    assert not converged and squares.calls == 500
@@ -0,0 +1,147 @@
+import threading
+import time
+import warnings
+
+import numpy as np
+import pytest
+
+import pypwaves_updated as pw
+import waveform_functions as wf
+from synthetic_pulsewaves import write_pulsewaves
+
+NUM_PULSES = 60
+
+
+@pytest.fixture(scope='module')
+def pulsewave(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('pulsewaves')/'synthetic.pls')
+    truth = write_pulsewaves(path,NUM_PULSES,seed=3)
+    pulsewave = pw.PulseWaves(path)
+    pulsewave.truth = truth
+    return pulsewave
+
+def test_wave_block_matches_waves(pulsewave):
+    pulse_block = pulsewave.read_pulse_block(0,NUM_PULSES)
+    wave_block = pulsewave.read_wave_block(pulse_block)
+    assert len(wave_block) == 2*NUM_PULSES
+    for row in range(len(wave_block)):
+        pulse_number = int(wave_block.pulse_index[row])
+        segment = pulsewave.get_waves(pulse_number).segments[int(wave_block.sampling[row])]
+        np.testing.assert_array_equal(wave_block.segment(row),segment[3])
+
+def test_pulse_block_matches_pulse_records(pulsewave):
+    pulse_block = pulsewave.read_pulse_block(10,20)
+    for i,pulse_number in enumerate(range(10,20)):
+        record = pulsewave.get_pulse(pulse_number)
+        assert pulse_block['offset_to_waves'][i] == record.offset_to_waves
+        assert pulse_block['gps_timestamp'][i] == pytest.approx(record.gps_timestamp)
+        assert pulse_block['x_anchor'][i] == pytest.approx(record.x_anchor)
+
+def test_read_pulse_block_range_errors(pulsewave):
+    with pytest.raises(ValueError,match=r'\[0, %d\)' % NUM_PULSES):
+        pulsewave.read_pulse_block(NUM_PULSES + 1,NUM_PULSES + 5)
+    with pytest.raises(ValueError):
+        pulsewave.read_pulse_block(-1,5)
+    with pytest.raises(ValueError):
+        pulsewave.read_pulse_block(8,5)
+    assert pulsewave.read_pulse_block(5,5)['pulse_number'].shape[0] == 0
+
+def test_empty_take(pulsewave):
+    wave_block = pulsewave.read_wave_block(pulsewave.read_pulse_block(0,5))
+    empty = wave_block.take(np.zeros(len(wave_block),dtype=bool))
+    assert len(empty) == 0 and empty.samples.shape[0] == 0
+    assert len(wave_block.take(np.array([],dtype=np.int64))) == 0
+
+def test_blocks_without_returning_waves(pulsewave):
+    pulse_block = pulsewave.read_pulse_block(0,5)
+    wave_block = pulsewave.read_wave_block(pulse_block)
+    outgoing = wave_block.take(~wave_block.returning)
+    echoes = wf.echoes_from_block(pulse_block,outgoing)
+    assert all(echoes[column].shape[0] == 0 for column in wf.ECHO_COLUMNS)
+    features = wf.pulse_features_from_block(pulse_block,outgoing)
+    assert np.all(features['num_echoes'] == 0) and np.all(np.isnan(features['peak_amplitude']))
+
+def test_echoes_found_at_synthetic_positions(pulsewave):
+    echoes = wf.extract_echoes(pulsewave,chunk_size=25)
+    counts = np.bincount(echoes['pulse_number'].astype(np.int64),minlength=NUM_PULSES)
+    expected = np.array([len(positions) for _,positions in pulsewave.truth])
+    assert np.mean(counts == expected) > 0.9
+
+def test_empty_returning_rows_do_not_warn(pulsewave):
+    pulse_block = pulsewave.read_pulse_block(0,3)
+    wave_block = pulsewave.read_wave_block(pulse_block)
+    returning = wave_block.take(wave_block.returning)
+    # pulse 1's returning waveform made empty
+    lengths = np.where(returning.pulse_index == 1,0,returning.lengths)
+    keep = np.repeat(returning.pulse_index != 1,returning.lengths)
+    block = pw.WaveBlock(returning.pulse_index,returning.sampling,returning.returning,
+                         returning.duration_anchor,lengths,returning.samples[keep])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        features = wf.pulse_features_from_block(pulse_block,block)
+        echoes = wf.echoes_from_block(pulse_block,block)
+    assert features['num_echoes'][1] == 0 and np.isnan(features['peak_amplitude'][1])
+    assert features['num_echoes'][0] > 0 and 1 not in echoes['pulse_number']
+
+@pytest.mark.parametrize('max_gap',[0,1 << 20])
+def test_fetch_waves_matches_get_waves(pulsewave,max_gap):
+    pulse_numbers = np.array([NUM_PULSES - 1,17,3,17,40,2,3,NUM_PULSES - 1,0])
+    pulse_block,wave_block = pulsewave.fetch_waves(pulse_numbers,max_gap=max_gap)
+    np.testing.assert_array_equal(pulse_block['pulse_number'],pulse_numbers)
+    assert len(wave_block) == 2*pulse_numbers.shape[0]
+    for row in range(len(wave_block)):
+        pulse_number = int(pulse_numbers[wave_block.pulse_index[row]])
+        segment = pulsewave.get_waves(pulse_number).segments[int(wave_block.sampling[row])]
+        np.testing.assert_array_equal(wave_block.segment(row),segment[3])
+
+def test_fetch_waves_no_pulses_and_errors(pulsewave):
+    pulse_block,wave_block = pulsewave.fetch_waves(np.zeros(0,dtype=np.int64))
+    assert pulse_block['pulse_number'].shape[0] == 0 and len(wave_block) == 0
+    with pytest.raises(ValueError):
+        pulsewave.fetch_waves([0,NUM_PULSES])
+
+def test_plan_wave_reads_merges_within_max_gap():
+    starts = np.array([30,0,12,5,41])
+    ends = np.array([40,10,20,8,50])
+    reads,read_index = pw.plan_wave_reads(starts,ends,max_gap=2)
+    np.testing.assert_array_equal(reads,[[0,20],[30,50]])
+    np.testing.assert_array_equal(read_index,[1,0,0,0,1])
+    reads,read_index = pw.plan_wave_reads(starts,ends,max_gap=0)
+    np.testing.assert_array_equal(reads,[[0,10],[12,20],[30,40],[41,50]])
+    np.testing.assert_array_equal(read_index,[2,0,1,0,3])
+    # a gap of exactly max_gap is merged, one byte more is not
+    np.testing.assert_array_equal(pw.plan_wave_reads(starts,ends,max_gap=10)[0],[[0,50]])
+    np.testing.assert_array_equal(pw.plan_wave_reads(starts,ends,max_gap=9)[0],[[0,20],[30,50]])
+    for read,start,end in zip(read_index,starts,ends):
+        assert reads[read,0] <= start and end <= reads[read,1]
+    reads,read_index = pw.plan_wave_reads([],[])
+    assert reads.shape == (0,2) and read_index.shape == (0,)
+
+def test_scan_blocks_match_read_wave_block(pulsewave):
+    start,end = 3,NUM_PULSES - 2
+    chunks = list(pulsewave.scan_blocks(start,end,chunk_size=7,prefetch=2))
+    assert len(chunks) == -(-(end - start) // 7)
+    pulse_block = pulsewave.read_pulse_block(start,end)
+    wave_block = pulsewave.read_wave_block(pulse_block)
+    for column in pulse_block:
+        np.testing.assert_array_equal(np.concatenate([chunk[0][column] for chunk in chunks]),pulse_block[column])
+    first_row = np.cumsum([0] + [chunk[0]['pulse_number'].shape[0] for chunk in chunks[:-1]])
+    np.testing.assert_array_equal(np.concatenate([chunk[1].pulse_index + first
+                                                  for chunk,first in zip(chunks,first_row)]),wave_block.pulse_index)
+    for attribute in ('sampling','returning','duration_anchor','lengths','samples'):
+        np.testing.assert_array_equal(np.concatenate([getattr(chunk[1],attribute) for chunk in chunks]),
+                                      getattr(wave_block,attribute))
+
+def test_scan_blocks_closed_early_stops_reader(pulsewave):
+    def consume():
+        scan = pulsewave.scan_blocks(chunk_size=2,prefetch=1)
+        next(scan)
+        # the reader is blocked on the full queue when the consumer goes away
+        time.sleep(0.3)
+        scan.close()
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    consumer.join(timeout=10)
+    assert not consumer.is_alive()
+    assert not any(thread.name == 'pulsewaves-prefetch' for thread in threading.enumerate())
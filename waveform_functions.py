@@ -0,0 +1,500 @@
+#!/usr/bin/python
+#waveform_functions.py
+'''
+Batched processing of decoded PulseWaves waveforms (see PulseWaves.read_pulse_block / read_wave_block).
+Waveforms are handled many at a time as padded 2-D blocks instead of one Waves object per pulse.
+'''
+
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import pypwaves_updated as pw
+import profiling_functions as prof
+
+# 1.4826 * MAD estimates the standard deviation of gaussian noise
+MAD_TO_SD = 1.4826
+# Waveform samples are integer counts, so the noise floor is never taken below one count
+MIN_NOISE = 1.0
+
+ECHO_COLUMNS = ['pulse_number', 'gps_timestamp', 'sampling', 'echo_number', 'num_echoes',
+                'position', 'x', 'y', 'z', 'amplitude', 'width']
+# Per-pulse features of extract_pulse_features and their storage dtypes
+PULSE_FEATURE_DTYPES = [('pulse_number', np.int64),
+                        ('peak_amplitude', np.float32),
+                        ('echo_width', np.float32),
+                        ('num_echoes', np.int16),
+                        ('energy', np.float32),
+                        ('rise_time', np.float32)]
+PULSE_FEATURE_COLUMNS = [name for name, _ in PULSE_FEATURE_DTYPES]
+
+
+def _savgol_edge_operators(window, polyorder, deriv, delta):
+    '''
+    Linear operators reproducing savgol_filter(mode='interp') at the edges of a row: a polynomial is fitted to the
+    first (last) window samples and evaluated at the first (last) window//2 positions.
+    Output: (left, right) - (window//2 x window) numpy arrays applied to the first / last window samples of a row
+    '''
+    half = window // 2
+    t = np.arange(window, dtype=np.float64)
+    powers = np.arange(polyorder + 1)
+    fit = np.linalg.pinv(t[:, None] ** powers)            # samples -> polynomial coefficients
+    # d^deriv/dt^deriv of t**k is k!/(k-deriv)! * t**(k-deriv)
+    factor = np.array([np.prod(np.arange(k - deriv + 1, k + 1)) if k >= deriv else 0. for k in powers])
+    exponent = np.maximum(powers - deriv, 0)
+
+    def evaluate(positions):
+        return (factor * positions[:, None] ** exponent) @ fit / delta ** deriv
+
+    return evaluate(t[:half]), evaluate(t[window - half:])
+
+@prof.timed('savgol_block')
+def savgol_block(padded, lengths, window, polyorder, deriv=0, delta=1., chunk_rows=20000, fill=0.):
+    '''
+    Savitzky-Golay smoothing (or derivative) of every row of a padded block of waveforms in one convolution.
+    Each row gives the same result as savgol_filter(row[:length], window, polyorder, deriv, delta) (mode='interp');
+    rows shorter than window are returned unsmoothed for deriv=0 and as nan otherwise.
+    Inputs:
+        padded - (rows x samples) numpy array, row i is valid up to lengths[i]
+        lengths - Int array, valid length of each row
+        window - Int, odd numbered window size
+        polyorder - Int, smoothing polynomial order
+        deriv - Int, derivative number
+        delta - sample spacing, used when deriv > 0
+        chunk_rows - rows filtered per convolution call, bounds temporary memory
+        fill - value written past the end of each row
+    Output:
+        (rows x samples) float64 numpy array
+    '''
+    from scipy.signal import savgol_coeffs
+    from scipy.ndimage import convolve1d
+    lengths = np.asarray(lengths, dtype=np.int64)
+    half = window // 2
+    coeffs = savgol_coeffs(window, polyorder, deriv=deriv, delta=delta)
+    left, right = _savgol_edge_operators(window, polyorder, deriv, delta)
+    smoothed = np.empty(padded.shape, dtype=np.float64)
+    window_columns = np.arange(window)
+
+    for start in range(0, padded.shape[0], chunk_rows):
+        stop = min(start + chunk_rows, padded.shape[0])
+        block = padded[start:stop].astype(np.float64)
+        chunk_lengths = lengths[start:stop]
+        result = convolve1d(block, coeffs, axis=1, mode='constant')
+
+        rows = np.flatnonzero(chunk_lengths >= window)
+        if window <= block.shape[1]:
+            result[rows, :half] = block[rows, :window] @ left.T
+            tail = chunk_lengths[rows, None] - window + window_columns
+            tail_values = block[rows[:, None], tail] @ right.T
+            result[rows[:, None], tail[:, window - half:]] = tail_values
+
+        short = chunk_lengths < window
+        result[short] = block[short] if deriv == 0 else np.nan
+        result[np.arange(block.shape[1])[None, :] >= chunk_lengths[:, None]] = fill
+        smoothed[start:stop] = result
+    return smoothed
+
+def smooth_wave_block(wave_block, window, polyorder, deriv=0, delta=1., chunk_rows=20000):
+    '''
+    Savitzky-Golay smoothing of every row of a ragged WaveBlock (see savgol_block), chunk_rows rows at a time.
+    Output: WaveBlock with the same rows and float64 smoothed samples
+    '''
+    samples = np.empty(wave_block.samples.shape[0], dtype=np.float64)
+    for start in range(0, len(wave_block), chunk_rows):
+        rows = np.arange(start, min(start + chunk_rows, len(wave_block)))
+        chunk = wave_block.take(rows)
+        padded, lengths = chunk.to_padded()
+        smoothed = savgol_block(padded, lengths, window, polyorder, deriv, delta, chunk_rows)
+        valid = np.arange(padded.shape[1])[None, :] < lengths[:, None]
+        samples[wave_block.offsets[rows[0]]:wave_block.offsets[rows[-1] + 1]] = smoothed[valid]
+    return pw.WaveBlock(wave_block.pulse_index, wave_block.sampling, wave_block.returning,
+                        wave_block.duration_anchor, wave_block.lengths, samples)
+
+def find_echoes(smoothed, lengths, noise_factor=3., min_amplitude=None):
+    '''
+    Finds local maxima above the noise floor in every row of a smoothed, padded block of waveforms.
+    Each peak is refined with a 3-point gaussian fit (parabola through the log amplitudes).
+    Inputs:
+        smoothed - (rows x samples) numpy array of smoothed waveforms
+        lengths - Int array, valid length of each row
+        noise_factor - peaks must exceed the row baseline by noise_factor * noise SD (ignored if min_amplitude given)
+        min_amplitude - scalar, fixed amplitude above baseline a peak must exceed
+    Output:
+        dict of per-echo numpy arrays:
+            row - row of the block the echo came from
+            position - sub-sample peak position (sample units from the start of the row)
+            amplitude - gaussian amplitude above the row baseline
+            width - gaussian sigma in samples (nan if the 3-point fit is degenerate)
+            baseline - row baseline (median of the row)
+    '''
+    valid = np.arange(smoothed.shape[1])[None, :] < np.asarray(lengths)[:, None]
+    masked = np.where(valid, smoothed, np.nan)
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        # empty rows have nan baselines ("All-NaN slice" warnings) and never hold peaks
+        warnings.simplefilter('ignore', RuntimeWarning)
+        baseline = np.nanmedian(masked, axis=1)
+        noise = MAD_TO_SD * np.nanmedian(np.abs(masked - baseline[:, None]), axis=1)
+    if min_amplitude is None:
+        threshold = noise_factor * np.maximum(noise, MIN_NOISE)
+    else:
+        threshold = np.full(smoothed.shape[0], float(min_amplitude))
+
+    center = masked[:, 1:-1]
+    with np.errstate(invalid='ignore'):
+        is_peak = (center > masked[:, :-2]) & (center >= masked[:, 2:]) \
+                  & (center - baseline[:, None] > threshold[:, None])
+    rows, columns = np.nonzero(is_peak)
+    columns = columns + 1
+
+    # Gaussian through 3 points: log amplitude is a parabola in sample position
+    with np.errstate(all='ignore'):
+        log_left = np.log(masked[rows, columns - 1] - baseline[rows])
+        log_mid = np.log(masked[rows, columns] - baseline[rows])
+        log_right = np.log(masked[rows, columns + 1] - baseline[rows])
+        curvature = log_left - 2 * log_mid + log_right
+        fit_ok = np.isfinite(curvature) & (curvature < 0)
+        shift = np.where(fit_ok, 0.5 * (log_left - log_right) / curvature, 0.)
+        width = np.where(fit_ok, np.sqrt(-1. / curvature), np.nan)
+        amplitude = np.where(fit_ok, np.exp(log_mid - 0.25 * (log_left - log_right) * shift),
+                             masked[rows, columns] - baseline[rows])
+
+    return {'row': rows,
+            'position': columns + shift,
+            'amplitude': amplitude,
+            'width': width,
+            'baseline': baseline[rows]}
+
+def _gaussian_sum(x, baseline, *params):
+    '''Sum of gaussians; params is a flat sequence of (amplitude, position, width) triples'''
+    model = np.full(x.shape[0], baseline, dtype=np.float64)
+    for i in range(0, len(params), 3):
+        model += params[i] * np.exp(-0.5 * ((x - params[i + 1]) / params[i + 2])**2)
+    return model
+
+def fit_gaussians(padded, lengths, echoes, max_iterations=200):
+    '''
+    Refines the echoes of find_echoes with a least-squares fit of one gaussian per echo (plus a constant baseline)
+    to the raw waveform of each row. Rows whose fit fails keep their 3-point estimates.
+    Inputs:
+        padded - (rows x samples) numpy array of raw waveforms
+        lengths - Int array, valid length of each row
+        echoes - dict output of find_echoes (updated in place and returned)
+    '''
+    from scipy.optimize import curve_fit
+    order = np.argsort(echoes['row'], kind='stable')
+    rows = echoes['row'][order]
+    bounds = np.flatnonzero(np.diff(np.concatenate(([-1], rows, [-1]))))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        echo_index = order[start:stop]
+        row = rows[start]
+        y = padded[row, :lengths[row]].astype(np.float64)
+        x = np.arange(y.shape[0], dtype=np.float64)
+        width_guess = np.where(np.isfinite(echoes['width'][echo_index]), echoes['width'][echo_index], 1.)
+        p0 = [echoes['baseline'][echo_index[0]]]
+        lower, upper = [-np.inf], [np.inf]
+        for i, width in zip(echo_index, width_guess):
+            p0 += [max(echoes['amplitude'][i], MIN_NOISE), echoes['position'][i], max(width, 0.5)]
+            lower += [0., 0., 0.3]
+            upper += [np.inf, float(y.shape[0]), float(y.shape[0])]
+        try:
+            params, _ = curve_fit(_gaussian_sum, x, y, p0=p0, bounds=(lower, upper), max_nfev=max_iterations)
+        except (RuntimeError, ValueError):
+            continue
+        echoes['baseline'][echo_index] = params[0]
+        echoes['amplitude'][echo_index] = params[1::3]
+        echoes['position'][echo_index] = params[2::3]
+        echoes['width'][echo_index] = params[3::3]
+    return echoes
+
+@prof.timed('echoes_from_block')
+def echoes_from_block(pulse_block, wave_block,
+                      window=5, polyorder=2,
+                      noise_factor=3., min_amplitude=None,
+                      gaussian_fit=False):
+    '''
+    Turns the returning waveforms of a decoded block of pulses into discrete echoes.
+    Inputs:
+        pulse_block - dict of pulse arrays (PulseWaves.read_pulse_block)
+        wave_block - WaveBlock decoded from pulse_block (PulseWaves.read_wave_block)
+        window, polyorder - Savitzky-Golay smoothing parameters (see Waves.smooth)
+        noise_factor, min_amplitude - detection threshold (see find_echoes)
+        gaussian_fit - if True, refine echoes with a full gaussian decomposition (slower)
+    Output:
+        dict of per-echo numpy arrays (ECHO_COLUMNS). position is in samples from the pulse anchor,
+        so x = x_anchor + position * dx as in Waves; width is the gaussian sigma in samples.
+    '''
+    returning = wave_block.take(wave_block.returning)
+    padded, lengths = returning.to_padded()
+    smoothed = savgol_block(padded, lengths, window, polyorder)
+    echoes = find_echoes(smoothed, lengths, noise_factor, min_amplitude)
+    if gaussian_fit:
+        echoes = fit_gaussians(padded, lengths, echoes)
+    prof.count('echoes_found', echoes['row'].shape[0])
+
+    # Echoes come out of find_echoes ordered by row, then by position within the row
+    row = echoes['row']
+    pulse_index = returning.pulse_index[row]
+    first_of_row = np.concatenate(([True], row[1:] != row[:-1]))
+    group_start = np.maximum.accumulate(np.where(first_of_row, np.arange(row.shape[0]), 0))
+    echo_number = np.arange(row.shape[0]) - group_start + 1
+    num_echoes = np.bincount(row, minlength=len(returning))[row]
+
+    position = returning.duration_anchor[row] + echoes['position']
+    return {'pulse_number': pulse_block['pulse_number'][pulse_index],
+            'gps_timestamp': pulse_block['gps_timestamp'][pulse_index],
+            'sampling': returning.sampling[row],
+            'echo_number': echo_number,
+            'num_echoes': num_echoes,
+            'position': position,
+            'x': pulse_block['x_anchor'][pulse_index] + position * pulse_block['dx'][pulse_index],
+            'y': pulse_block['y_anchor'][pulse_index] + position * pulse_block['dy'][pulse_index],
+            'z': pulse_block['z_anchor'][pulse_index] + position * pulse_block['dz'][pulse_index],
+            'amplitude': echoes['amplitude'],
+            'width': echoes['width']}
+
+def _last_per_group(group, key):
+    '''Index of the element with the largest key in each group (groups in increasing order)'''
+    order = np.lexsort((key, group))
+    last = np.concatenate((group[order][1:] != group[order][:-1], [True])) if group.shape[0] else np.zeros(0, bool)
+    return order[last]
+
+@prof.timed('pulse_features_from_block')
+def pulse_features_from_block(pulse_block, wave_block,
+                              window=5, polyorder=2,
+                              noise_factor=3., min_amplitude=None,
+                              rise_levels=(0.1, 0.9)):
+    '''
+    Per-pulse waveform features of a decoded block of pulses, computed on all returning waveforms at once.
+    Pulses with several returning segments take amplitude, width and rise time from the strongest segment
+    and add up energy and echo counts.
+    Inputs:
+        pulse_block, wave_block - as in echoes_from_block
+        window, polyorder, noise_factor, min_amplitude - smoothing and echo detection (see echoes_from_block)
+        rise_levels - fractions of the peak between which the leading edge rise time is measured
+    Output:
+        dict of numpy arrays (PULSE_FEATURE_DTYPES), one entry per pulse of pulse_block:
+            peak_amplitude - smoothed peak above the waveform baseline (nan without a returning waveform)
+            echo_width - gaussian sigma of the strongest echo, in samples (nan without echoes)
+            num_echoes - echoes found (find_echoes)
+            energy - sum of the raw samples above the baseline
+            rise_time - samples from rise_levels[0] to rise_levels[1] of the peak on the leading edge
+    '''
+    num_pulses = pulse_block['pulse_number'].shape[0]
+    features = {'pulse_number': pulse_block['pulse_number'].astype(np.int64)}
+    for name, dtype in PULSE_FEATURE_DTYPES[1:]:
+        features[name] = np.zeros(num_pulses, dtype=dtype) if name in ('num_echoes', 'energy') \
+            else np.full(num_pulses, np.nan, dtype=dtype)
+    returning = wave_block.take(wave_block.returning)
+    if not len(returning):
+        return features
+    padded, lengths = returning.to_padded()
+    smoothed = savgol_block(padded, lengths, window, polyorder)
+    echoes = find_echoes(smoothed, lengths, noise_factor, min_amplitude)
+
+    columns = np.arange(padded.shape[1])[None, :]
+    valid = columns < lengths[:, None]
+    with warnings.catch_warnings():
+        # as in find_echoes, empty rows get a nan baseline and no features
+        warnings.simplefilter('ignore', RuntimeWarning)
+        baseline = np.nanmedian(np.where(valid, smoothed, np.nan), axis=1)
+    above = np.where(valid, smoothed - baseline[:, None], -np.inf)
+    peak_column = np.argmax(above, axis=1)
+    peak = above[np.arange(len(returning)), peak_column]
+    energy = np.where(valid, np.maximum(padded - baseline[:, None], 0), 0).sum(axis=1)
+
+    # Leading edge: last sample before the peak still under each level
+    leading = valid & (columns <= peak_column[:, None])
+    crossings = []
+    for level in rise_levels:
+        under = leading & (above < level * peak[:, None])
+        crossings.append(np.where(under, columns, -1).max(axis=1))
+    rise_time = np.where(crossings[0] >= 0, crossings[1] - crossings[0], np.nan).astype(np.float64)
+
+    row_width = np.full(len(returning), np.nan)
+    strongest_echo = _last_per_group(echoes['row'], echoes['amplitude'])
+    row_width[echoes['row'][strongest_echo]] = echoes['width'][strongest_echo]
+
+    pulse_index = returning.pulse_index
+    strongest_row = _last_per_group(pulse_index, peak)
+    pulses = pulse_index[strongest_row]
+    # empty waveforms have no peak (-inf above the baseline)
+    features['peak_amplitude'][pulses] = np.where(np.isfinite(peak[strongest_row]), peak[strongest_row], np.nan)
+    features['echo_width'][pulses] = row_width[strongest_row]
+    features['rise_time'][pulses] = rise_time[strongest_row]
+    features['energy'][:] = np.bincount(pulse_index, weights=energy, minlength=num_pulses)
+    features['num_echoes'][:] = np.bincount(pulse_index[echoes['row']], minlength=num_pulses)
+    return features
+
+def _concatenate_columns(chunks, columns):
+    '''Concatenate a list of dicts of arrays column by column'''
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in columns}
+
+def _worker_source(pulsewave):
+    '''What a worker needs to reopen pulsewave as the caller opened it (including a truncated pulse count)'''
+    return pulsewave.filename, pulsewave.truncated, pulsewave.num_pulses
+
+def _open_source(source):
+    pls_file, allow_truncated, num_pulses = source
+    pulsewave = pw.PulseWaves(pls_file, allow_truncated=allow_truncated)
+    pulsewave.num_pulses = min(pulsewave.num_pulses, num_pulses)
+    return pulsewave
+
+def _echo_chunk(source, start, end, kwargs):
+    '''Worker: open the pulsewaves file and extract the echoes of pulses [start, end)'''
+    pulsewave = _open_source(source)
+    pulse_block = pulsewave.read_pulse_block(start, end)
+    wave_block = pulsewave.read_wave_block(pulse_block)
+    return echoes_from_block(pulse_block, wave_block, **kwargs)
+
+def _pulse_chunks(num_pulses, start, end, chunk_size):
+    end = num_pulses if end is None else min(end, num_pulses)
+    return [(s, min(s + chunk_size, end)) for s in range(start, end, chunk_size)]
+
+def extract_echoes(pulsewave, start=0, end=None, chunk_size=50000, workers=1, **kwargs):
+    '''
+    Extracts echoes (discrete returns) from the waveforms of pulses [start, end) of a pulsewaves file.
+    The pulse range is split into chunks of chunk_size pulses; with workers > 1 chunks run on a process pool.
+    Inputs:
+        pulsewave - PulseWaves object
+        start, end - pulse number range (end defaults to the last pulse)
+        chunk_size - pulses decoded per chunk, bounds the memory used by each worker
+        workers - number of worker processes
+        kwargs - passed on to echoes_from_block (window, polyorder, noise_factor, min_amplitude, gaussian_fit)
+    Output:
+        dict of per-echo numpy arrays (ECHO_COLUMNS), ordered by pulse number
+    '''
+    chunks = _pulse_chunks(pulsewave.num_pulses, start, end, chunk_size)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_echo_chunk, [_worker_source(pulsewave)] * len(chunks),
+                                    [c[0] for c in chunks], [c[1] for c in chunks], [kwargs] * len(chunks)))
+    else:
+        results = []
+        for chunk_start, chunk_end in chunks:
+            pulse_block = pulsewave.read_pulse_block(chunk_start, chunk_end)
+            results.append(echoes_from_block(pulse_block, pulsewave.read_wave_block(pulse_block), **kwargs))
+    if not results:
+        return {column: np.zeros(0) for column in ECHO_COLUMNS}
+    return _concatenate_columns(results, ECHO_COLUMNS)
+
+def _feature_chunk(source, start, end, kwargs):
+    '''Worker: open the pulsewaves file and compute the features of pulses [start, end)'''
+    pulsewave = _open_source(source)
+    pulse_block = pulsewave.read_pulse_block(start, end)
+    wave_block = pulsewave.read_wave_block(pulse_block)
+    return start, pulse_features_from_block(pulse_block, wave_block, **kwargs)
+
+def extract_pulse_features(pulsewave, start=0, end=None, chunk_size=50000, workers=1, output_dir=None, **kwargs):
+    '''
+    Per-pulse waveform features (pulse_features_from_block) of pulses [start, end) of a pulsewaves file,
+    as columnar arrays aligned to pulse numbers: entry i belongs to pulse start + i.
+    Chunks of chunk_size pulses are decoded one at a time per worker and written into the output columns
+    as they complete, so memory stays bounded by the chunk size and the output columns.
+    Inputs:
+        pulsewave - PulseWaves object
+        start, end - pulse number range (end defaults to the last pulse)
+        chunk_size - pulses decoded per chunk
+        workers - number of worker processes
+        output_dir - optional directory; columns are then written to <output_dir>/<column>.npy and returned
+            as memory maps instead of being held in memory
+        kwargs - passed on to pulse_features_from_block
+    Output:
+        dict of numpy arrays (PULSE_FEATURE_DTYPES)
+    '''
+    chunks = _pulse_chunks(pulsewave.num_pulses, start, end, chunk_size)
+    num_pulses = chunks[-1][1] - start if chunks else 0
+    if output_dir is None:
+        features = {name: np.zeros(num_pulses, dtype=dtype) for name, dtype in PULSE_FEATURE_DTYPES}
+    else:
+        features = {name: np.lib.format.open_memmap(os.path.join(output_dir, name + '.npy'), mode='w+',
+                                                    dtype=dtype, shape=(num_pulses,))
+                    for name, dtype in PULSE_FEATURE_DTYPES}
+
+    def store(chunk_start, chunk_features):
+        for name in PULSE_FEATURE_COLUMNS:
+            column = chunk_features[name]
+            features[name][chunk_start - start:chunk_start - start + column.shape[0]] = column
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk_start, chunk_features in pool.map(_feature_chunk, [_worker_source(pulsewave)] * len(chunks),
+                                                        [c[0] for c in chunks], [c[1] for c in chunks],
+                                                        [kwargs] * len(chunks)):
+                store(chunk_start, chunk_features)
+    else:
+        for chunk_start, chunk_end in chunks:
+            pulse_block = pulsewave.read_pulse_block(chunk_start, chunk_end)
+            store(chunk_start, pulse_features_from_block(pulse_block, pulsewave.read_wave_block(pulse_block),
+                                                         **kwargs))
+    if output_dir is not None:
+        for column in features.values():
+            column.flush()
+    return features
+
+
+### JOINING LAS POINTS TO PULSES
+
+def _search_pulse_times(pulsewave, records, t):
+    '''
+    Vectorized PulseWaves._search_time(side='left') for an array of times: the time index narrows every query to
+    one index step, then a binary search over the memory-mapped timestamps runs for all queries at once.
+    '''
+    step = pulsewave.time_index_step
+    i = np.searchsorted(pulsewave.time_index, t, side='left')
+    low = np.maximum(i - 1, 0) * step
+    high = np.minimum(i * step + 1, pulsewave.num_pulses)
+    for _ in range(int(np.ceil(np.log2(2 * step + 1)))):
+        active = np.flatnonzero(low < high)
+        if not active.shape[0]:
+            break
+        mid = (low[active] + high[active]) // 2
+        below = pulsewave.t_scale * records['gps_timestamp'][mid] + pulsewave.t_offset < t[active]
+        low[active] = np.where(below, mid + 1, low[active])
+        high[active] = np.where(below, high[active], mid)
+    return low
+
+@prof.timed('join_points_to_pulses')
+def join_points_to_pulses(point_times, pulsewave, tolerance=1e-6, time_offset=0.):
+    '''
+    Matches LAS points to the pulses they came from by gps time: each point gets the pulse with the nearest
+    gps_timestamp, if it is within tolerance. Points are sorted by time and searched against the time-ordered
+    pulse records in one vectorized pass, reading only the timestamps the search touches.
+    Inputs:
+        point_times - array of LAS gps_time values
+        pulsewave - PulseWaves object, pulses in gps time order (see PulseWaves.build_time_index)
+        tolerance - seconds, largest time difference accepted as a match
+        time_offset - seconds added to point_times to bring them to the pulse time base
+            (e.g. 1e9 when the LAS file uses adjusted standard GPS time and the pulses do not)
+    Output:
+        Int numpy array of pulse numbers aligned with point_times, -1 where no pulse is within tolerance
+    '''
+    point_times = np.asarray(point_times, dtype=np.float64) + time_offset
+    pulse_index = np.full(point_times.shape[0], -1, dtype=np.int64)
+    if not pulsewave.num_pulses or not point_times.shape[0]:
+        return pulse_index
+    if not hasattr(pulsewave, 'time_index'):
+        pulsewave.build_time_index()
+    records = pulsewave.pulse_memmap()
+
+    order = np.argsort(point_times, kind='stable')
+    t = point_times[order]
+    after = _search_pulse_times(pulsewave, records, t)
+    after = np.minimum(after, pulsewave.num_pulses - 1)
+    before = np.maximum(after - 1, 0)
+    t_after = pulsewave.t_scale * records['gps_timestamp'][after] + pulsewave.t_offset
+    t_before = pulsewave.t_scale * records['gps_timestamp'][before] + pulsewave.t_offset
+    nearest = np.where(np.abs(t - t_before) <= np.abs(t_after - t), before, after)
+    dt = np.minimum(np.abs(t - t_before), np.abs(t_after - t))
+    pulse_index[order] = np.where(dt <= tolerance, nearest, -1)
+    prof.count('points_joined', int((pulse_index >= 0).sum()))
+    return pulse_index
+
+def add_pulse_index(las_points, pulsewave, tolerance=1e-6, time_offset=0., column='pulse_number'):
+    '''
+    Adds the join_points_to_pulses result to a point table (DataFrame with gps_time) as column, -1 if unmatched.
+    Pulse attributes (pulse_block / echo / feature arrays indexed by pulse number) can then be attached with
+    values[las_points[column]] on the matched rows.
+    '''
+    las_points[column] = join_points_to_pulses(las_points['gps_time'].to_numpy(), pulsewave, tolerance, time_offset)
+    return las_points